@@ -1,35 +1,117 @@
+import os
 import logging
 import ast
-import pandas as pd
-import xarray as xr
+import time
+import inspect
+import functools
 import numpy as np
-from ops_qc.utils import load_yaml
-import ops_qc.qc_tests_df as qc_tests
+from concurrent.futures import ThreadPoolExecutor
+import ops_qc
+from ops_qc.cache import ContentCache, content_key, array_digest
+from ops_qc.utils import load_yaml, LazyModule
+from ops_qc.context import QcContext
+from ops_qc.scheduler import QcScheduler, StepError
+from ops_qc.registry import default_registry
 
-class QcApply(object):
+xr = LazyModule("xarray")
+
+# Increment when a change outside the qc test functions themselves (i.e. to
+# their helper functions in ops_qc.utils, or the land mask shapefile) would
+# change their flags, so cached flags aren't reused.
+QC_CACHE_VERSION = "1"
+
+
+@functools.lru_cache(maxsize=None)
+def _test_source(qc_test):
+    """Source code of a qc test, including its default parameters"""
+    return inspect.getsource(inspect.unwrap(qc_test))
+
+
+@functools.lru_cache(maxsize=32)
+def _read_attr_file(attr_file, mtime):
+    return load_yaml(attr_file, 'qc_attr_info'), load_yaml(attr_file, 'qc_flag_info')
+
+
+def load_attr_file(attr_file):
+    """
+    Returns the qc_attr_info and qc_flag_info dictionaries of attribute file
+    attr_file, parsed once per process (and again if the file changes).
+    The dictionaries are shared, don't modify them.
+    """
+    return _read_attr_file(os.path.abspath(attr_file), os.path.getmtime(attr_file))
+
+
+class QcApply(QcContext):
     """
     Base class for observational data quality control.  Takes xarray dataset containing
     measurements from Mangōpare/Moana sensor and applies automatic quality control tests.
-    Converts dataset to dataframe for consistency with BDC QC code.
+    The tests run against the dataset's arrays and write their flags to self.flags
+    (see ops_qc.context.QcContext).  Tests written for the dataframe versions,
+    self.df and self.qcdf, still work; self.df is only made if a test uses it.
+    Tests (and steps) run in the order of ops_qc.scheduler.QcScheduler, so each
+    one runs after the tests and steps it depends on.
     Inputs:
         ds -- dataframe with LONGITUDE, LATITUDE, DATETIME, PRESSURE, TEMPERATURE
-        test_list -- list of qc tests in qc_test_df.py to apply to xarray dataset
+        test_list -- list of qc tests to apply to xarray dataset (tests in
+            qc_test_df.py, or registered by other packages, see ops_qc.registry),
+            run in dependency order.  Unknown tests, or tests with flags that
+            have no attributes, raise ValueError before any test is run.
         save_flags -- boolean, save all qc test flags (true) or only global qc flags (false)
         attr_file -- yaml file that contains global and variable attribute information
         overwrite_flags -- boolean, overwrite flags if a qc test has already
-            been performed and is in self.qcdf (true) or skip test if already exists (false)
+            been performed and is in self.flags (true) or skip test if already exists (false)
+        time_tests -- boolean, record the run time of each qc test in seconds in
+            self.test_timings
+        steps -- dictionary of name: ops_qc.scheduler.QcStep, processing steps run
+            between the tests that need them (i.e. position calculations).  A step
+            that fails raises StepError.
+        test_requires -- dictionary of test name: declarations added to those of the
+            test, see ops_qc.context.qc_test
+        threads -- number of threads to run tests that don't depend on each other
+            with, at the same time, the tests with the highest cost hints first
+        cache_dir -- if set, the flags of each qc test are cached in cache_dir, keyed
+            by the test's source code and default parameters, the package version
+            and the columns, flags and attributes the test reads.  Tests already
+            run on the same inputs load their flags instead of running again.
+            Only tests with declarations (see ops_qc.context.qc_test) are cached.
+            The key doesn't cover code and data outside the test function, i.e.
+            the ops_qc.utils position helpers or point_on_land's shapefile,
+            so changes to those need a QC_CACHE_VERSION increment (or an
+            empty cache_dir) to take effect.
+            Whether each test was a cache "hit" or "miss" is kept in
+            self.cache_results.
+        cache_max_bytes -- maximum size of cache_dir before the least recently
+            used entries are removed
+        registry -- ops_qc.registry.QcRegistry the tests are in, default
+            ops_qc.registry.default_registry()
+        validated -- boolean, test_list was already checked with validate_tests
+            (i.e. by QcWrapper, once for all files) so run() doesn't check it again
+
+    Flags made by the tests, and the variable qc flags, are uint8 in the
+    returned dataset; QC_FLAG is int.
 
     To-do:
         At some point might change all QC to ds so we don't have to switch
         back and forth.  Or change all qc flags to a list/dict which would make way more sense.
     """
 
+    # the wrapper can pass processing steps (see steps) to run between the tests
+    runs_steps = True
+
     def __init__(self,
                  ds,
                  test_list=None,
                  save_flags=False,
                  attr_file='attribute_list.yml',
                  overwrite_flags=True,
+                 time_tests=False,
+                 steps=None,
+                 test_requires=None,
+                 threads=1,
+                 cache_dir=None,
+                 cache_max_bytes=1024**3,
+                 registry=None,
+                 validated=False,
                  logger=logging):
 
         self.ds = ds
@@ -37,47 +119,181 @@ class QcApply(object):
         self.save_flags = save_flags
         self.attr_file = attr_file
         self.overwrite_flags = overwrite_flags
+        self.time_tests = time_tests
+        self.test_timings = {}
+        self.steps = steps or {}
+        self.test_requires = test_requires or {}
+        self.threads = threads
+        self.cache_dir = cache_dir
+        self.cache_results = {}
+        self.registry = registry or default_registry()
+        self.validated = validated
+        self._flag_attrs = None
         self.logger = logging
-        self.df = self.ds.to_dataframe().reset_index()
+        self._cache = ContentCache.shared(cache_dir, cache_max_bytes, logger=self.logger) if cache_dir else None
+        self._digests = {}
+        # most tests make one or two flags, plus the category flags
+        QcContext.__init__(self, ds, flag_capacity=2 * len(test_list or []) + 8)
         self.flag_category = {}
 
     def _run_qc_tests(self):
         """
         Applies all qc tests from test_list and saves flags in
-        self.qcdf dataframe.  Should probably be saving flags
-        to a dict instead...
+        self.flags
         """
         self._success_tests = []
         self._tests_not_applied = []
-        # initialize dataframe to hold qc flags
-        self.qcdf = pd.DataFrame()
-        for test_name in self.test_list:
-            try:
-                # from qc_tests_df import *
-                # needed for this to work
-                #test_name()
-
-                # use this if importing module only
-                qc_test = getattr(qc_tests, test_name)
-                qc_test(self)
-                self._success_tests.append(test_name)
-            except Exception as exc:
-                self._tests_not_applied.append(test_name)
-                self.logger.error(
-                    'Could not apply QC test {}.  Traceback: {}'.format(test_name, exc))
-
-
-    def _merge_df_and_ds(self):
+        self.flags = {}
+        categories = self._qc_attr_info() if self.steps else {}
+        scheduler = QcScheduler(
+            self.test_list, self.steps, categories, self.test_requires,
+            registry=self.registry, logger=self.logger)
+        self._scheduler = scheduler
+        for stage in scheduler.plan():
+            stage = [name for name in stage if self._should_run(scheduler, name)]
+            if len(stage) > 1 and self.threads > 1:
+                self._run_stage(scheduler, stage)
+                continue
+            for name in stage:
+                if name in self.steps:
+                    self._run_step(name)
+                else:
+                    self._record_test(name, self._apply_test(name))
+
+    def _should_run(self, scheduler, name):
+        """
+        Skips tests for another gear class, and tests whose flags are
+        already in the dataset when not overwriting flags
+        """
+        if name in self.steps:
+            return True
+        requires = scheduler.test_requires(name) or {}
+        gear_class = self.ds.attrs.get('gear_class')
+        if requires.get('gear_class') and gear_class and gear_class not in requires['gear_class']:
+            return False
+        produces = requires.get('produces')
+        if not self.overwrite_flags and produces and all(flag in self.ds.data_vars for flag in produces):
+            self.logger.info(f'Not applying qc test {name} since its flags already exist.')
+            return False
+        return True
+
+    def _apply_test(self, test_name):
+        """Runs one qc test, returns the exception if it failed"""
+        try:
+            qc_test = self.registry.get(test_name).func
+            if self.time_tests:
+                start = time.perf_counter()
+                self._run_cached(test_name, qc_test)
+                self.test_timings[test_name] = time.perf_counter() - start
+            else:
+                self._run_cached(test_name, qc_test)
+        except Exception as exc:
+            return exc
+
+    def _run_cached(self, test_name, qc_test):
+        """
+        Runs qc_test, or with a cache, loads its flags if it was already run on
+        the same inputs and otherwise runs it and caches its flags
+        """
+        requires = self._scheduler.test_requires(test_name) if self._cache else None
+        key = self._cache_key(test_name, qc_test, requires) if requires else None
+        if key is None:
+            qc_test(self)
+            return
+        cached = self._cache.get(key)
+        if cached is not None:
+            flags, metadata = cached
+            for name in metadata['flags']:
+                self.flags[name] = flags[name]
+            self.cache_results[test_name] = 'hit'
+            return
+        self.cache_results[test_name] = 'miss'
+        qc_test(self)
+        produced = [name for name in self.flags if name in requires.get('produces', [])]
+        self._cache.put(key, {name: self.flags[name] for name in produced}, {'flags': produced})
+
+    def _cache_key(self, test_name, qc_test, requires):
+        """
+        Cache key of a qc test's flags, None if an input can't be digested
+        (i.e. an array of strings)
+        """
+        # flags are nobs long even for tests that only read attributes
+        parts = [QC_CACHE_VERSION, ops_qc.__version__, test_name, _test_source(qc_test), self.nobs]
+        for name in requires.get('columns', []):
+            if name not in self._digests:
+                # columns only change in steps, so they are digested once
+                self._digests[name] = array_digest(self.column(name)) if self.has_column(name) else 'missing'
+            parts += [f'column:{name}', self._digests[name]]
+        for name in requires.get('flags', []):
+            # tests read flags from self.flags or, i.e. category flags merged
+            # by a step, from the dataset, which can differ
+            flag = array_digest(self.flags[name]) if name in self.flags else 'missing'
+            variable = array_digest(self.ds[name].values) if name in self.ds.variables else 'missing'
+            parts += [f'flag:{name}', flag, variable]
+        for name in requires.get('attrs', []):
+            parts += [f'attr:{name}', repr(self.ds.attrs.get(name, 'missing'))]
+        if None in parts:
+            return None
+        return content_key(*parts)
+
+    def _record_test(self, test_name, exc):
+        if exc is None:
+            self._success_tests.append(test_name)
+        else:
+            self._tests_not_applied.append(test_name)
+            self.logger.error(
+                'Could not apply QC test {}.  Traceback: {}'.format(test_name, exc))
+        # flags written to self.qcdf by dataframe tests
+        self._sync_qcdf()
+
+    def _run_stage(self, scheduler, stage):
+        """
+        Runs tests that don't depend on each other in threads, then puts
+        their flags in the order they would have had running one by one
+        """
+        existing = set(self.flags)
+        # slowest first, so they don't hold up the end of the stage
+        by_cost = sorted(stage, key=scheduler.cost, reverse=True)
+        with ThreadPoolExecutor(max_workers=self.threads) as executor:
+            results = dict(zip(by_cost, executor.map(self._apply_test, by_cost)))
+        for test_name in stage:
+            self._record_test(test_name, results[test_name])
+        produced = [
+            name for test_name in stage
+            for name in (scheduler.test_requires(test_name) or {}).get('produces', [])
+        ]
+        new = [name for name in self.flags if name not in existing]
+        for name in sorted(new, key=lambda name: produced.index(name) if name in produced else len(produced)):
+            self.flags.move_to_end(name)
+
+    def _run_step(self, name):
+        """
+        Merges the flags so far into self.ds, then runs step name on it
+        """
+        try:
+            self._sync_qcdf()
+            self._load_qc_attrs()
+            self._global_qc_flag()
+            self._merge_df_and_ds(test_attrs=False)
+            self.ds = self.steps[name](self.ds)
+            self._df = None
+            self._digests = {}
+        except Exception as exc:
+            self.logger.error(f'Could not run step {name}: {exc}')
+            raise StepError(str(exc))
+
+    def _merge_df_and_ds(self, test_attrs=True):
         """
         Converts pandas dataframe back to xarray, adds back in
-        attributes from original ds.  Updates attributes.
+        attributes from original ds.  Updates attributes, and the
+        lists of tests applied and failed if test_attrs.
         """
         try:
-            if len(self.qcdf.keys()) > 0:
+            if len(self.flags) > 0:
                 # if save_flags, add all qc_flags to ds
                 # otherwise, only save global qc_flag
                 if self.save_flags:
-                    flag_list = self.qcdf.keys()
+                    flag_list = list(self.flags)
                 else:
                     flag_list = self.global_flag_list
                 for flag_name in flag_list:
@@ -86,14 +302,20 @@ class QcApply(object):
                         continue
                         self.logger.info(f'Not applying qc flag {flag_name} since it already exists.')
                     if (flag_name in varlist) and (flag_name in self.global_flag_list):
-                        new = np.array(self.qcdf[flag_name])
+                        new = self.flags[flag_name]
                         old = self.ds[flag_name]
                         self.ds[flag_name] = xr.where(old>new,old,new)
                     else:
                         self.ds[flag_name] = xr.Variable(
-                            dims='DATETIME', data=self.qcdf[flag_name])
+                            dims='DATETIME', data=self.flags[flag_name])
                     self._assign_qc_attributes(
                         self.flag_attrs, flag_name, self.qc_flag_info)
+                if not test_attrs:
+                    return
+                # tests are recorded in the order they ran, list them in test_list order
+                order = {name: i for i, name in enumerate(self.test_list or [])}
+                self._success_tests.sort(key=lambda name: order.get(name, len(order)))
+                self._tests_not_applied.sort(key=lambda name: order.get(name, len(order)))
                 if 'qc_tests_applied' in self.ds.attrs:
                     old = ast.literal_eval(self.ds.attrs['qc_tests_applied'])
                     self._success_tests = old+self._success_tests
@@ -107,14 +329,34 @@ class QcApply(object):
             self.logger.error(
                 'Could not apply attributes to qc flags. Traceback: {}'.format(exc))
 
+    @classmethod
+    def validate_tests(cls, test_list, attr_file='attribute_list.yml', registry=None, logger=logging):
+        """
+        Raises ValueError if a test in test_list isn't registered, or makes
+        flags that have no attributes in attr_file or the registry, so a run
+        fails before any file is processed instead of on every file
+        """
+        registry = registry or default_registry()
+        try:
+            registry.validate(test_list, load_attr_file(attr_file)[0])
+        except Exception as exc:
+            logger.error(f'Invalid qc test list: {exc}')
+            raise ValueError(f'Invalid qc test list due to: {exc}')
+
+    def _qc_attr_info(self):
+        """qc_attr_info of the registered tests, updated from attr_file"""
+        if self._flag_attrs is None:
+            self._flag_attrs = self.registry.attr_info(load_attr_file(self.attr_file)[0])
+        return self._flag_attrs
+
     def _load_qc_attrs(self):
         """
         Loads qc variable attributes from attribute_list file
         """
         try:
-            self.flag_attrs = load_yaml(self.attr_file, 'qc_attr_info')
-            self.qc_flag_info = load_yaml(self.attr_file, 'qc_flag_info')
-            for flag_name in self.qcdf.keys():
+            self.flag_attrs = self._qc_attr_info()
+            self.qc_flag_info = load_attr_file(self.attr_file)[1]
+            for flag_name in self.flag_names():
                 self.flag_category.update(
                     {flag_name: self.flag_attrs[flag_name][1]})
         except Exception as exc:
@@ -144,31 +386,26 @@ class QcApply(object):
 
     def _global_qc_flag(self):
         """
-        Individual QC tests record qc flag in flag_* column.
+        Individual QC tests record qc flag in flag_* arrays.
         Take the maximum value to determine overall qc flag
-        for each measurement.
+        for each measurement.  Missing (nan) flags are ignored.
         """
         try:
-            self.qcdf['QC_FLAG'] = np.zeros_like(self.df['LONGITUDE'])
-            self.qcdf['QC_FLAG'] = self.qcdf.max(axis=1).astype('int')
-            self.global_flag_list = ['QC_FLAG']
-            for flag_name, category in self.flag_category.items():
-                if category == 'None':
-                    continue
-                if category not in self.global_flag_list:
-                    self.global_flag_list.append(category)
-                if category not in list(self.qcdf.keys()):
-                    self.qcdf[category] = self.qcdf[flag_name]
-                    continue
-                self.qcdf[category] = self.qcdf[[
-                    category, flag_name]].max(axis=1)
+            self._sync_qcdf()
+            qc_flag, category_flags = self.flags.group_max(self.flag_category)
+            self.flags['QC_FLAG'] = qc_flag
+            self.global_flag_list = ['QC_FLAG'] + list(category_flags)
+            for category, flag in category_flags.items():
+                self.flags[category] = flag
         except Exception as exc:
             self.logger.error(
                 'Unable to calculate global quality control flag. Traceback: {}'.format(exc))
 
     def run(self):
         try:
-            if self.test_list:
+            if self.test_list and not self.validated:
+                self.validate_tests(self.test_list, self.attr_file, self.registry, self.logger)
+            if self.test_list or self.steps:
                 self._run_qc_tests()
             else:
                 self.logger.error('No QC tests in list of tests, skipping QC')
@@ -179,6 +416,8 @@ class QcApply(object):
                 self.logger.error('Unable to apply the following qc tests: {}'.format(
                     self._tests_not_applied))
             return(self.ds)
+        except StepError:
+            raise
         except Exception as exc:
             self.logger.error('QC testing failed.  Traceback: {}'.format(exc))
             raise type(exc)(f'QC testing failed due to: {exc}')
@@ -0,0 +1,163 @@
+import os
+import logging
+from ops_qc.encoding import netcdf_encoding, ENCODING_PRESETS
+from ops_qc.ragged import to_ragged
+from ops_qc.utils import LazyModule
+
+pd = LazyModule("pandas")
+xr = LazyModule("xarray")
+
+"""
+Zarr archive of qc'd deployments.  Each deployment is its own group,
+deployments/<deployment id>, holding the per-observation variables as chunked
+arrays and the deployment metadata (the netcdf global attributes) as group
+attributes.  Since deployments never share arrays, separate processes can
+write different deployments to the same archive at the same time.
+
+Requires the optional zarr package.
+"""
+
+DEPLOYMENTS = "deployments"
+
+
+def _import_zarr():
+    try:
+        import zarr
+    except ImportError as exc:
+        raise ImportError(
+            f"zarr output needs the zarr package (pip install 'zarr<3'): {exc}"
+        )
+    return zarr
+
+
+def zarr_encoding(ds, preset="default", chunksize=10000, logger=logging):
+    """
+    Zarr version of ops_qc.encoding.netcdf_encoding: keeps the preset's
+    dtypes and fill values, and chunks every variable along its first
+    dimension by the preset chunksize (or chunksize).  Compression is left
+    to zarr's default compressor.
+    """
+    encoding = {}
+    if not isinstance(preset, dict):
+        preset = ENCODING_PRESETS[preset]
+    chunksize = preset.get("chunksize", chunksize)
+    netcdf = netcdf_encoding(ds, preset, logger=logger)
+    for name, var in ds.variables.items():
+        var_encoding = {
+            k: v for k, v in netcdf.get(name, {}).items() if k in ["dtype", "_FillValue"]
+        }
+        if var.ndim and all(var.shape):
+            var_encoding["chunks"] = (min(chunksize, var.shape[0]),) + var.shape[1:]
+        if var_encoding:
+            encoding[name] = var_encoding
+    return encoding
+
+
+def _json_attr(value):
+    """
+    Attribute value zarr can store as json, netcdf allows bytes (i.e. the
+    flag_values lists of bytes made by QcApply)
+    """
+    if isinstance(value, bytes):
+        return value.decode()
+    if isinstance(value, (list, tuple)):
+        return [_json_attr(item) for item in value]
+    return value
+
+
+class ZarrArchive(object):
+    """
+    Local zarr store of qc'd deployments.
+    Inputs:
+        store -- path of the zarr store (a directory), created if it doesn't exist
+        encoding -- encoding preset name or dictionary, see ops_qc.encoding
+        chunksize -- chunk length of the per-observation arrays, unless set by encoding
+
+    Usage:
+        archive = ZarrArchive("qc_archive.zarr")
+        archive.write("MOANA_0038_13_210624041106_qc_210624", ds)
+        archive.consolidate()
+        archive.index()  # deployment metadata, one row per deployment
+        archive.load()   # all (or some) deployments as one ragged array dataset
+    """
+
+    def __init__(self, store, encoding="default", chunksize=10000, logger=logging):
+        self.store = store
+        self.encoding = encoding
+        self.chunksize = chunksize
+        self.logger = logger
+        zarr = _import_zarr()
+        # create the root groups once, before any deployment is written
+        zarr.open_group(self.store, mode="a").require_group(DEPLOYMENTS)
+
+    def path(self, deployment):
+        return os.path.join(self.store, DEPLOYMENTS, deployment)
+
+    def write(self, deployment, ds):
+        """
+        Writes (or replaces) one deployment, returns its group path
+        """
+        ds = ds.copy()
+        ds.attrs = {k: _json_attr(v) for k, v in ds.attrs.items()}
+        for var in ds.variables.values():
+            var.attrs = {k: _json_attr(v) for k, v in var.attrs.items()}
+        ds.to_zarr(
+            self.store,
+            group=f"{DEPLOYMENTS}/{deployment}",
+            mode="w",
+            encoding=zarr_encoding(ds, self.encoding, self.chunksize, self.logger),
+            consolidated=True,
+        )
+        return self.path(deployment)
+
+    def deployments(self):
+        path = os.path.join(self.store, DEPLOYMENTS)
+        return sorted(
+            name for name in os.listdir(path)
+            if os.path.isdir(os.path.join(path, name))
+        )
+
+    def consolidate(self):
+        """
+        Consolidates the metadata of the whole archive into the root of the
+        store so bulk reads only read one metadata file.  Run by one process
+        after all writes.
+        """
+        zarr = _import_zarr()
+        zarr.consolidate_metadata(self.store)
+
+    def _root(self):
+        zarr = _import_zarr()
+        if os.path.isfile(os.path.join(self.store, ".zmetadata")):
+            return zarr.open_consolidated(self.store, mode="r")
+        return zarr.open_group(self.store, mode="r")
+
+    def index(self):
+        """
+        Returns the deployment metadata as a dataframe, one row per deployment.
+        Deployments written after the last consolidate() are included.
+        """
+        root = self._root()
+        rows = {}
+        for deployment in self.deployments():
+            try:
+                group = root[DEPLOYMENTS][deployment]
+            except KeyError:
+                group = _import_zarr().open_group(self.path(deployment), mode="r")
+            rows[deployment] = dict(group.attrs)
+        return pd.DataFrame.from_dict(rows, orient="index")
+
+    def open(self, deployment):
+        """Opens one deployment lazily"""
+        return xr.open_zarr(
+            self.store, group=f"{DEPLOYMENTS}/{deployment}", consolidated=True
+        )
+
+    def load(self, deployments=None, time_dim="DATETIME"):
+        """
+        Loads deployments (default all) into one contiguous ragged array
+        dataset, see ops_qc.ragged
+        """
+        deployments = deployments or self.deployments()
+        datasets = [self.open(deployment).load() for deployment in deployments]
+        return to_ragged(datasets, deployments, time_dim=time_dim)
@@ -0,0 +1,424 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import argparse
+import subprocess
+import datetime as dt
+import numpy as np
+import pandas as pd
+import xarray as xr
+import ops_qc
+from ops_qc.registry import default_registry
+from ops_qc.synthetic import SyntheticMangopare
+from ops_qc.readers import MangopareStandardReader, MangopareMetadataReader
+from ops_qc.preprocess import PreProcessMangopare
+from ops_qc.apply_qc import QcApply
+from ops_qc.wrapper import QcWrapper
+from ops_qc.publish import Wrapper as PublishWrapper
+
+"""
+Performance benchmarks for the qc chain, run on synthetic data (see
+ops_qc.synthetic).  Times the import of each scheduler entry point, the
+readers, preprocessing, each qc test, QcApply, QcWrapper and publish.Wrapper
+over a range of input sizes and writes the results to a json file so runs on
+different commits can be compared:
+
+    python -m ops_qc.benchmark --sizes quick --out-file before.json
+    (change things)
+    python -m ops_qc.benchmark --sizes quick --out-file after.json --baseline before.json
+"""
+
+SIZES = {
+    "quick": {"rows": [1000, 10000], "files": [1, 10]},
+    "full": {
+        "rows": [1000, 10000, 100000, 1000000],
+        "files": [1, 10, 100, 1000, 10000],
+    },
+}
+COMPONENTS = [
+    "startup", "reader", "metadata", "preprocess", "qc_tests", "qc_apply", "wrapper", "publish",
+]
+# pycallables run by the operational scheduler, each one started in a new process
+ENTRY_POINTS = [
+    "ops_qc.wrapper.QcWrapper",
+    "ops_qc.publish.Wrapper",
+    "ops_qc.newfiles.ListIncomingFiles",
+    "ops_qc.transfer.Wrapper",
+    "ops_qc.fishserve.CheckFishserve",
+]
+# dependencies that should only be imported when a job uses them
+HEAVY_MODULES = ["pandas", "xarray", "gsw", "seawater", "shapely", "shapefile", "requests", "zarr"]
+# run with python -c, prints the import time and the heavy modules imported
+STARTUP_SCRIPT = """
+import sys, json, time, importlib
+start = time.perf_counter()
+module, name = sys.argv[1].rsplit(".", 1)
+getattr(importlib.import_module(module), name)
+seconds = time.perf_counter() - start
+print(json.dumps({"seconds": seconds, "modules": [m for m in sys.argv[2:] if m in sys.modules]}))
+"""
+QC_TESTS = default_registry().names()
+# qc tests are timed on up to COST_ROW_BUDGET / their cost hint rows (see
+# ops_qc.context.qc_test), so slow tests skip the largest sizes
+COST_ROW_BUDGET = 3000000
+# same as the operational test lists
+TEST_LIST_1 = [
+    "impossible_date", "impossible_location", "impossible_speed", "timing_gap",
+    "global_range", "remove_ref_location", "spike", "temp_drift",
+    "reset_code_check", "check_timestamp_overflow",
+]
+TEST_LIST_2 = ["start_end_dist_check"]
+ATTR_FILE = os.path.join(os.path.dirname(os.path.realpath(__file__)), "attribute_list.yml")
+PUBLISH_ATTR_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "THREDDS", "attribute_list.yml"
+)
+# seconds between synthetic observations
+SAMPLE_SECONDS = 4
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def environment():
+    """Where the benchmark was run, saved with the results"""
+    return {
+        "created": dt.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "commit": _git_commit(),
+        "ops_qc": ops_qc.__version__,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "xarray": xr.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+class Benchmark(object):
+    """
+    Times the qc chain on synthetic data of increasing size.
+    Inputs:
+        out_file -- json file the results are written to
+        rows -- numbers of observations per file for the single file benchmarks
+            (reader, preprocess, qc_tests, qc_apply)
+        files -- numbers of files for the multi-file benchmarks (wrapper, publish),
+            also the number of sensors in the fisher metadata for metadata
+        file_rows -- observations per file for the multi-file benchmarks
+        repeat -- number of times each benchmark is run, the best and median
+            times are saved
+        components -- which of COMPONENTS to run.  "startup" times importing each of
+            ENTRY_POINTS in a new process and saves the HEAVY_MODULES it imported.
+        test_list -- qc tests timed one by one, default all registered tests.
+            Each test is run after the flags of TEST_LIST_1 are set, since some
+            tests combine earlier flags.
+        test_max_rows -- dictionary of qc test name: largest number of rows to
+            run it on, default COST_ROW_BUDGET / the test's cost hint
+        work_dir -- directory for the synthetic input and output files, default
+            a temporary directory that is removed afterwards
+        seed -- random seed for the synthetic data
+
+    Returns (from run):
+        dictionary with "environment" and "results", one result per component,
+            benchmark and size, also written to out_file
+    """
+
+    def __init__(
+        self,
+        out_file="benchmark_results.json",
+        rows=SIZES["quick"]["rows"],
+        files=SIZES["quick"]["files"],
+        file_rows=1000,
+        repeat=3,
+        components=COMPONENTS,
+        test_list=QC_TESTS,
+        test_max_rows={},
+        work_dir=None,
+        seed=0,
+        logger=logging,
+    ):
+        self.out_file = out_file
+        self.rows = rows
+        self.files = files
+        self.file_rows = file_rows
+        self.repeat = repeat
+        self.components = components
+        self.test_list = test_list
+        self.test_max_rows = test_max_rows
+        self.work_dir = work_dir
+        self.seed = seed
+        self.logger = logger
+        self.results = []
+
+    def _generate(self, name, nfiles, rows, nsensors=None):
+        """Synthetic files with about rows observations each, in one haul"""
+        minutes = rows * SAMPLE_SECONDS / 60
+        return SyntheticMangopare(
+            os.path.join(self.work_dir, name),
+            nfiles=nfiles,
+            nsensors=nsensors,
+            hauls=(1, 1),
+            haul_minutes=(minutes, minutes),
+            max_depth=(20, 20),
+            sample_seconds=SAMPLE_SECONDS,
+            anomaly_rate=0,
+            seed=self.seed,
+            logger=self.logger,
+        ).run()
+
+    def _time(self, func, setup=None):
+        """
+        Runs setup() (not timed) and func(setup result) repeat times.
+        Returns the times in seconds and the last result of func.
+        """
+        times = []
+        result = None
+        for _ in range(self.repeat):
+            arg = setup() if setup else None
+            start = time.perf_counter()
+            result = func(arg) if setup else func()
+            times.append(time.perf_counter() - start)
+        return times, result
+
+    def _record(self, component, name, rows, nfiles, times=None, error=None, **extra):
+        result = {
+            "component": component,
+            "name": name,
+            "rows": int(rows),
+            "files": int(nfiles),
+            "repeat": len(times) if times else 0,
+            "best_s": None,
+            "median_s": None,
+            "rows_per_s": None,
+            "files_per_s": None,
+            "error": error,
+        }
+        if times:
+            best = min(times)
+            result.update({
+                "best_s": best,
+                "median_s": float(np.median(times)),
+                "rows_per_s": rows / best if best and rows else None,
+                "files_per_s": nfiles / best if best and nfiles else None,
+            })
+        self.results.append(result)
+        result.update(extra)
+        self.logger.info(
+            f"{component} {name} rows={rows} files={nfiles}: "
+            f"{result['best_s'] if error is None else error}")
+        return result
+
+    def _run_benchmark(self, component, name, rows, nfiles, func, setup=None):
+        try:
+            times, result = self._time(func, setup)
+        except Exception as exc:
+            self.logger.error(f"Benchmark {component} {name} failed: {exc}")
+            self._record(component, name, rows, nfiles, error=str(exc))
+            return None
+        self._record(component, name, rows, nfiles, times)
+        return result
+
+    def _startup_time(self, entry_point):
+        """Import time of entry_point in a new python process"""
+        proc = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT, entry_point] + HEAVY_MODULES,
+            capture_output=True, text=True, check=True,
+        )
+        return json.loads(proc.stdout.strip().splitlines()[-1])
+
+    def _startup(self):
+        """Time to import each of ENTRY_POINTS, and which heavy modules that imports"""
+        for entry_point in ENTRY_POINTS:
+            try:
+                runs = [self._startup_time(entry_point) for _ in range(self.repeat)]
+            except Exception as exc:
+                self.logger.error(f"Benchmark startup {entry_point} failed: {exc}")
+                self._record("startup", entry_point, 0, 0, error=str(exc))
+                continue
+            self._record(
+                "startup", entry_point, 0, 0, [run["seconds"] for run in runs],
+                modules=runs[-1]["modules"])
+
+    def _single_file(self, rows):
+        """reader, preprocess, qc_tests and qc_apply on one file of rows observations"""
+        (filename,), metafile = self._generate(f"rows_{rows}", 1, rows)
+        fisher_metadata = MangopareMetadataReader(metafile, logger=self.logger).run()
+        ds = MangopareStandardReader(filename).run()
+        nrows = ds.sizes["DATETIME"]
+        if "reader" in self.components:
+            self._run_benchmark(
+                "reader", "MangopareStandardReader.run", nrows, 1,
+                lambda: MangopareStandardReader(filename).run())
+        ds, _ = PreProcessMangopare(
+            ds.copy(deep=True), fisher_metadata, attr_file=ATTR_FILE, status_dict={}
+        ).run()
+        if "preprocess" in self.components:
+            self._run_benchmark(
+                "preprocess", "PreProcessMangopare.run", nrows, 1,
+                lambda raw: PreProcessMangopare(
+                    raw, fisher_metadata, attr_file=ATTR_FILE, status_dict={}).run(),
+                setup=lambda: MangopareStandardReader(filename).run())
+        if "qc_tests" in self.components:
+            qc = QcApply(ds, test_list=TEST_LIST_1, attr_file=ATTR_FILE)
+            qc._run_qc_tests()
+            flags = qc.flags
+
+            def setup():
+                qc.flags = {name: flag.copy() for name, flag in flags.items()}
+                return qc
+
+            registry = default_registry()
+            for test_name in self.test_list:
+                max_rows = COST_ROW_BUDGET / registry.cost(test_name)
+                if nrows > self.test_max_rows.get(test_name, max_rows):
+                    continue
+
+                self._run_benchmark(
+                    "qc_tests", test_name, nrows, 1,
+                    registry.get(test_name).func, setup=setup)
+        if "qc_apply" in self.components:
+            self._run_benchmark(
+                "qc_apply", "QcApply.run", nrows, 1,
+                lambda ds_p: QcApply(ds_p, TEST_LIST_1, attr_file=ATTR_FILE).run(),
+                setup=lambda: ds.copy(deep=True))
+
+    def _multi_file(self, nfiles):
+        """metadata, wrapper and publish on nfiles files of file_rows observations"""
+        nsensors = max(1, nfiles // 10)
+        filelist, metafile = self._generate(f"files_{nfiles}", nfiles, self.file_rows)
+        if "metadata" in self.components:
+            # one metadata row per file, the size of a large fisher database
+            _, big_metafile = self._generate(f"metadata_{nfiles}", 1, 10, nsensors=nfiles)
+            self._run_benchmark(
+                "metadata", "MangopareMetadataReader.run", nfiles, 1,
+                lambda: MangopareMetadataReader(big_metafile, logger=self.logger).run())
+        rows = nfiles * self.file_rows
+        qc_files = []
+        if "wrapper" in self.components or "publish" in self.components:
+            out_dir = os.path.join(self.work_dir, f"qc_{nfiles}") + "/"
+
+            def setup():
+                shutil.rmtree(out_dir, ignore_errors=True)
+                return QcWrapper(
+                    filelist=filelist,
+                    out_dir=out_dir,
+                    test_list_1=TEST_LIST_1,
+                    test_list_2=TEST_LIST_2,
+                    fishing_metafile=metafile,
+                    logger=self.logger,
+                )
+
+            if "wrapper" in self.components:
+                qc_files = self._run_benchmark(
+                    "wrapper", "QcWrapper.run", rows, nfiles,
+                    lambda wrapper: wrapper.run(), setup=setup) or []
+            else:
+                # publish input only
+                qc_files = setup().run()
+        if "publish" in self.components and qc_files:
+            out_dir = os.path.join(self.work_dir, f"published_{nfiles}") + "/"
+
+            def setup():
+                shutil.rmtree(out_dir, ignore_errors=True)
+                return PublishWrapper(
+                    filelist=qc_files, out_dir=out_dir, attr_file=PUBLISH_ATTR_FILE,
+                    logger=self.logger)
+
+            self._run_benchmark(
+                "publish", "publish.Wrapper.run", rows, len(qc_files),
+                lambda wrapper: wrapper.run(), setup=setup)
+
+    def save(self):
+        results = {"environment": environment(), "results": self.results}
+        with open(self.out_file, "w") as f:
+            json.dump(results, f, indent=2)
+        return results
+
+    def run(self):
+        self.results = []
+        remove_work_dir = self.work_dir is None
+        if remove_work_dir:
+            self.work_dir = tempfile.mkdtemp(prefix="ops_qc_benchmark_")
+        try:
+            if "startup" in self.components:
+                self._startup()
+            for rows in self.rows:
+                self._single_file(rows)
+            for nfiles in self.files:
+                self._multi_file(nfiles)
+        finally:
+            if remove_work_dir:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+                self.work_dir = None
+        return self.save()
+
+
+def load_results(filename):
+    """Results of a benchmark json file as a dataframe"""
+    with open(filename) as f:
+        return pd.DataFrame(json.load(f)["results"])
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Compares two benchmark json files.  Returns a dataframe with the best
+    times of both and their ratio (current / baseline) for every benchmark
+    in both, and a "regression" column that is True where current is more
+    than threshold (fraction) slower.
+    """
+    keys = ["component", "name", "rows", "files"]
+    df = pd.merge(
+        load_results(baseline)[keys + ["best_s"]],
+        load_results(current)[keys + ["best_s"]],
+        on=keys,
+        suffixes=("_baseline", "_current"),
+    ).dropna(subset=["best_s_baseline", "best_s_current"])
+    df["ratio"] = df["best_s_current"] / df["best_s_baseline"]
+    df["regression"] = df["ratio"] > 1 + threshold
+    return df
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ops_qc qc chain on synthetic data")
+    parser.add_argument("--out-file", default="benchmark_results.json")
+    parser.add_argument("--sizes", choices=list(SIZES), default="quick")
+    parser.add_argument("--rows", type=int, nargs="+", help="overrides --sizes")
+    parser.add_argument("--files", type=int, nargs="+", help="overrides --sizes")
+    parser.add_argument("--file-rows", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--components", nargs="+", choices=COMPONENTS, default=COMPONENTS)
+    parser.add_argument("--work-dir", help="keep the synthetic files here")
+    parser.add_argument("--baseline", help="benchmark json file to compare the results with")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.WARNING)
+    Benchmark(
+        out_file=args.out_file,
+        rows=args.rows or SIZES[args.sizes]["rows"],
+        files=args.files or SIZES[args.sizes]["files"],
+        file_rows=args.file_rows,
+        repeat=args.repeat,
+        components=args.components,
+        work_dir=args.work_dir,
+    ).run()
+    if args.baseline:
+        df = compare(args.baseline, args.out_file, args.threshold)
+        print(df.to_string(index=False))
+        return int(df["regression"].any())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,170 @@
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import numpy as np
+
+"""
+Small on-disk cache for numpy arrays, used to skip repeated work when
+reprocessing files that have not changed.  Entries are stored as one .npz
+file per key in cache_dir and evicted least recently used first once the
+cache grows past max_bytes.
+"""
+
+
+def content_key(*parts):
+    """
+    Returns a hex digest for any number of bytes/str parts, i.e. the raw
+    file contents followed by a version string and reader options.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode()
+        digest.update(len(part).to_bytes(8, "little"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+def array_digest(values):
+    """
+    Returns a hex digest of a numpy array's dtype, shape and values, or None
+    for object arrays (i.e. strings), which have no fixed byte representation
+    """
+    values = np.ascontiguousarray(values)
+    if values.dtype == object:
+        return None
+    digest = hashlib.sha256(f"{values.dtype.str}{values.shape}".encode())
+    digest.update(values.reshape(-1).view(np.uint8))
+    return digest.hexdigest()
+
+
+def file_digest(filename, blocksize=1024**2):
+    """
+    Returns the sha256 hex digest of a file's contents, read in blocks
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ContentCache(object):
+    """
+    Content-addressed cache of numpy arrays.
+    Inputs:
+        cache_dir -- directory to store cache entries in, created if needed
+        max_bytes -- maximum total size of the cache, oldest entries (by last
+            access) are removed once this is exceeded
+    Each entry is a dictionary of name: numpy array plus an optional
+    json-serialisable dictionary of metadata.  Arrays of dtype object can't
+    be stored (pickle is never used), put() skips those entries.
+    Use ContentCache.shared() to reuse one instance per cache_dir, so the
+    running size estimate is kept between files instead of rescanning
+    cache_dir on every put().  The estimate only counts this process's
+    writes, cache_dir is rescanned whenever it says max_bytes is exceeded.
+    """
+
+    suffix = ".npz"
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, cache_dir, max_bytes=1024**3, logger=logging):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.logger = logger
+        self._size = None
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @classmethod
+    def shared(cls, cache_dir, max_bytes=1024**3, logger=logging):
+        """
+        Returns the cache for cache_dir and max_bytes, made the first time
+        it is asked for in this process
+        """
+        key = (os.path.abspath(cache_dir), max_bytes)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(cache_dir, max_bytes, logger=logger)
+            return cls._shared[key]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        """
+        Returns (arrays, metadata) for key, or None if not cached
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+            # mtime records last access for eviction
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except Exception as exc:
+            self.logger.error(f"Could not read cache entry {path}: {exc}")
+            return None
+        metadata = json.loads(str(arrays.pop("__metadata__", "{}")))
+        return arrays, metadata
+
+    def put(self, key, arrays, metadata=None):
+        """
+        Stores arrays and metadata under key.  Written to a temporary file
+        first so an interrupted write never leaves a partial entry.
+        """
+        if any(np.asarray(values).dtype == object for values in arrays.values()):
+            self.logger.info(f"Not caching {key}, contains object arrays")
+            return False
+        arrays = dict(arrays, __metadata__=np.array(json.dumps(metadata or {})))
+        fd, tmpfile = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmpfile, self._path(key))
+        except Exception as exc:
+            self.logger.error(f"Could not write cache entry {key}: {exc}")
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+            return False
+        with self._lock:
+            if self._size is not None:
+                self._size += os.path.getsize(self._path(key))
+            self._evict()
+        return True
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(self.suffix):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except FileNotFoundError:
+                    # evicted by another process
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def _evict(self):
+        """
+        Removes least recently used entries until the cache is under
+        max_bytes.  Only rescans cache_dir once the running size estimate
+        says the limit is exceeded.
+        """
+        if self._size is not None and self._size <= self.max_bytes:
+            return
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if self._size <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                pass
+            self._size -= size
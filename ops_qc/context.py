@@ -0,0 +1,319 @@
+import functools
+import threading
+from collections.abc import MutableMapping
+import numpy as np
+from ops_qc.utils import LazyModule
+
+pd = LazyModule("pandas")
+
+"""
+Array interface the qc tests in qc_tests_df run against.  Sensor columns are
+read straight from the dataset's own numpy buffers and each test writes its
+flag into a row of a preallocated uint8 matrix (FlagMatrix), so applying the
+tests needs no Dataset -> DataFrame conversion and no flag copies.
+
+The old interface (self.df, a dataframe of the dataset, and self.qcdf, a
+dataframe of flags) still works, for tests written against it: self.df is
+built the first time it is used, and flags written to self.qcdf are taken
+back into the flag arrays after each test.
+"""
+
+
+class FlagMatrix(MutableMapping):
+    """
+    Flags of one deployment, stored as the rows of preallocated
+    (capacity x nobs) uint8 matrices with a name -> row index.  Works like a
+    dictionary of flag arrays in the order the flags were added: getting a
+    flag returns its row (a view), setting one copies the values into its row.
+    Flags that aren't uint8 (i.e. the int QC_FLAG, or float flags with nans
+    from dataframe tests) are kept as they are, outside the matrix.
+    Inputs:
+        nobs -- number of observations (matrix columns)
+        capacity -- rows per matrix, another matrix is added when all rows
+            are used so rows already handed out stay valid
+    """
+
+    def __init__(self, nobs, capacity=32):
+        self.nobs = nobs
+        self.capacity = max(1, capacity)
+        self.blocks = []
+        self.index = {}
+        self.other = {}
+        self._names = {}
+        # rows are never reused: rows of deleted or replaced flags are left
+        # unused, as views of them may still be held
+        self._next_row = 0
+        # tests run in threads (see QcApply threads) add flags at the same time
+        self._lock = threading.Lock()
+
+    def _row(self, i):
+        return self.blocks[i // self.capacity][i % self.capacity]
+
+    def _new_row(self, name):
+        with self._lock:
+            if name in self.index:
+                return self._row(self.index[name])
+            i = self._next_row
+            self._next_row += 1
+            if i // self.capacity == len(self.blocks):
+                self.blocks.append(np.empty((self.capacity, self.nobs), dtype=np.uint8))
+            self.index[name] = i
+            self.other.pop(name, None)
+            self._names.setdefault(name)
+            return self._row(i)
+
+    def new(self, name, value=1):
+        """Returns the row for flag name filled with value"""
+        row = self._new_row(name)
+        row[:] = value
+        return row
+
+    def __getitem__(self, name):
+        if name in self.index:
+            return self._row(self.index[name])
+        return self.other[name]
+
+    def __setitem__(self, name, values):
+        values = np.asarray(values)
+        if values.dtype == np.uint8 and values.shape == (self.nobs,):
+            self._new_row(name)[:] = values
+            return
+        with self._lock:
+            if name in self.index:
+                # the row is left unused
+                del self.index[name]
+            self.other[name] = values
+            self._names.setdefault(name)
+
+    def __delitem__(self, name):
+        with self._lock:
+            del self._names[name]
+            if name in self.index:
+                del self.index[name]
+            else:
+                del self.other[name]
+
+    def move_to_end(self, name):
+        """Moves flag name to the end of the flag order"""
+        with self._lock:
+            del self._names[name]
+            self._names[name] = None
+
+    def __iter__(self):
+        return iter(list(self._names))
+
+    def __len__(self):
+        return len(self._names)
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def group_max(self, groups):
+        """
+        Maximum of all flags and of groups of flags, in one pass over the
+        flags.  Missing (nan) values are ignored.
+        Inputs:
+            groups -- dictionary of flag name: group name, flags with group
+                "None" or not in groups are only in the maximum of all flags
+        Returns:
+            maximum of all flags as int (0 where there are no flags),
+            dictionary of group name: maximum of its flags, in the order the
+                groups first appear in the flags
+        """
+        total = np.zeros(self.nobs, dtype=np.uint8)
+        total_other = np.zeros(self.nobs)
+        group_max = {}
+        for name in self:
+            values = self[name]
+            if name in self.index:
+                np.maximum(total, values, out=total)
+            else:
+                total_other = np.fmax(total_other, values)
+            group = groups.get(name, "None")
+            if group == "None":
+                continue
+            if group not in group_max:
+                group_max[group] = values.copy()
+            elif values.dtype == np.uint8 and group_max[group].dtype == np.uint8:
+                np.maximum(group_max[group], values, out=group_max[group])
+            else:
+                group_max[group] = np.fmax(group_max[group], values)
+        if self.other:
+            total = np.fmax(total, total_other)
+        return total.astype("int"), group_max
+
+
+class QcContext(object):
+    """
+    Sensor data and qc flags of one deployment.
+    Inputs:
+        ds -- xarray dataset with one dimension, time_dim
+        time_dim -- name of the observation dimension
+        flag_capacity -- number of flags the flag matrix is allocated for,
+            more are added as needed
+
+    Usage (in a qc test):
+        temp = self.column("TEMPERATURE")    # numpy view, not a copy
+        flag = self.new_flag("flag_x")       # uint8 ones, a row of self.flags
+        flag[temp > 30] = 3
+    """
+
+    def __init__(self, ds, time_dim="DATETIME", flag_capacity=32):
+        self.ds = ds
+        self.time_dim = time_dim
+        self.nobs = ds.sizes[time_dim]
+        self.flag_capacity = flag_capacity
+        self.flags = {}
+        self._df = None
+        self._qcdf = None
+
+    @property
+    def flags(self):
+        """FlagMatrix of flag name: flag array, in the order the flags were made"""
+        return self._flags
+
+    @flags.setter
+    def flags(self, flags):
+        if not isinstance(flags, FlagMatrix):
+            matrix = FlagMatrix(self.nobs, self.flag_capacity)
+            matrix.update(flags)
+            flags = matrix
+        self._flags = flags
+
+    def column(self, name):
+        """Values of variable name as a numpy array (the dataset's buffer)"""
+        return self.ds[name].values
+
+    def has_column(self, name):
+        return name in self.ds.variables
+
+    def new_flag(self, name, value=1, dtype="uint8"):
+        """Returns a new flag array filled with value, replacing flag name if it exists"""
+        self._sync_qcdf()
+        if np.dtype(dtype) == np.uint8:
+            return self.flags.new(name, value)
+        self.flags[name] = np.full(self.nobs, value, dtype=dtype)
+        return self.flags[name]
+
+    def flag(self, name):
+        self._sync_qcdf()
+        return self.flags[name]
+
+    def flag_names(self):
+        self._sync_qcdf()
+        return list(self.flags)
+
+    @property
+    def df(self):
+        """The dataset as a dataframe, only made when a test uses it"""
+        if self._df is None:
+            self._df = self.ds.to_dataframe().reset_index()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+
+    @property
+    def qcdf(self):
+        """The flags as a dataframe, changes are taken back into self.flags"""
+        if self._qcdf is None:
+            self._qcdf = pd.DataFrame(dict(self.flags)) if self.flags else pd.DataFrame()
+        return self._qcdf
+
+    @qcdf.setter
+    def qcdf(self, qcdf):
+        self._qcdf = qcdf
+        self._sync_qcdf()
+
+    def _sync_qcdf(self):
+        """Takes the flags of a dataframe made by self.qcdf back into self.flags"""
+        if self._qcdf is not None:
+            self.flags = {name: self._qcdf[name].to_numpy() for name in self._qcdf.columns}
+            self._qcdf = None
+
+
+class DataFrameContext(object):
+    """
+    QcContext interface for objects that only have the df and qcdf
+    dataframes (i.e. unit tests calling a qc test directly).  Other
+    attributes are those of the wrapped object.  New flags are added to
+    its qcdf by flush().
+    """
+
+    def __init__(self, obj):
+        self.__dict__["_obj"] = obj
+        self.__dict__["flags"] = {}
+
+    def __getattr__(self, attr):
+        return getattr(self._obj, attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._obj, attr, value)
+
+    @property
+    def nobs(self):
+        return len(self._obj.df)
+
+    def column(self, name):
+        return np.asarray(self._obj.df[name])
+
+    def has_column(self, name):
+        return name in self._obj.df
+
+    def new_flag(self, name, value=1, dtype="uint8"):
+        flag = np.full(self.nobs, value, dtype=dtype)
+        self.flags[name] = flag
+        return flag
+
+    def flag(self, name):
+        if name in self.flags:
+            return self.flags[name]
+        return self._obj.qcdf[name].to_numpy()
+
+    def flag_names(self):
+        return list(dict.fromkeys(list(self._obj.qcdf.columns) + list(self.flags)))
+
+    def flush(self):
+        for name, flag in self.flags.items():
+            self._obj.qcdf[name] = flag
+        self.flags.clear()
+
+
+def qc_test(func=None, cost=1, **requires):
+    """
+    Decorator for qc tests written against QcContext, so they can also be
+    called with an object that only has df and qcdf dataframes.  Keyword
+    arguments declare what the test reads and makes, so ops_qc.scheduler
+    can order the tests (tests without them run in their test_list position):
+        columns -- dataset variables the test reads
+        flags -- flags of other tests (or flag categories) the test reads
+        attrs -- dataset attributes the test reads
+        produces -- flags the test makes with its default arguments
+        gear_class -- gear classes the test applies to, datasets with another
+            gear_class attribute are not tested
+        after -- names of tests or steps the test has to run after
+    cost is a hint of the test's run time per observation relative to a
+    vectorised test (1), used to start slow tests first and by the benchmark
+    (see ops_qc.registry), it isn't a declaration.
+
+    Usage:
+        @qc_test(columns=["TEMPERATURE"], produces=["flag_x"])
+        def test_x(self, flag_name="flag_x"):
+    """
+    if func is None:
+        return functools.partial(qc_test, cost=cost, **requires)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        if isinstance(self, QcContext):
+            return func(self, *args, **kwargs)
+        context = DataFrameContext(self)
+        try:
+            return func(context, *args, **kwargs)
+        finally:
+            context.flush()
+
+    wrapper.requires = requires or None
+    wrapper.cost = cost
+    return wrapper
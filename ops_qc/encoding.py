@@ -0,0 +1,81 @@
+import logging
+import numpy as np
+
+"""
+Named netcdf encoding presets for QC and publication output.  A preset is
+a dictionary with any of:
+    complevel -- zlib compression level 1-9, 0 or missing for no compression
+    shuffle -- boolean, apply the HDF5 shuffle filter before compressing
+    chunksize -- chunk length along each dimension (capped at the dimension length)
+    float_dtype -- dtype for floating point data variables (i.e. TEMPERATURE,
+        PRESSURE, DEPTH).  Coordinates (LATITUDE, LONGITUDE) keep their dtype.
+    flag_dtype -- dtype for quality flags (QC_FLAG, *_QC and flag_* variables)
+"""
+
+ENCODING_PRESETS = {
+    # no encoding, netcdf4 library defaults
+    "default": {},
+    "compressed": {"complevel": 4, "shuffle": True, "chunksize": 10000},
+    "compact": {
+        "complevel": 4,
+        "shuffle": True,
+        "chunksize": 10000,
+        "float_dtype": "float32",
+        "flag_dtype": "uint8",
+    },
+}
+
+
+def is_flag_variable(name):
+    return name == "QC_FLAG" or name.endswith("_QC") or name.startswith("flag_")
+
+
+def _fits_dtype(values, dtype):
+    """True if all non-nan values are integers within the range of dtype"""
+    values = np.asarray(values)
+    values = values[~np.isnan(values)] if values.dtype.kind == "f" else values
+    if not values.size:
+        return True
+    info = np.iinfo(dtype)
+    return (
+        np.all(np.mod(values, 1) == 0)
+        and values.min() >= info.min
+        and values.max() < info.max
+    )
+
+
+def netcdf_encoding(ds, preset="default", logger=logging):
+    """
+    Returns the encoding dictionary to pass to ds.to_netcdf() for preset,
+    either the name of one of ENCODING_PRESETS or a preset dictionary.
+    Only numeric variables are encoded.  Flags with missing values are
+    stored with the largest value of flag_dtype as _FillValue, and flags
+    that don't fit in flag_dtype are left as they are.
+    """
+    if not isinstance(preset, dict):
+        preset = ENCODING_PRESETS[preset]
+    encoding = {}
+    for name, var in ds.variables.items():
+        if var.dtype.kind not in "biuf":
+            continue
+        var_encoding = {}
+        if preset.get("complevel"):
+            var_encoding.update(
+                {"zlib": True, "complevel": preset["complevel"],
+                 "shuffle": preset.get("shuffle", True)})
+            if preset.get("chunksize") and var.ndim and all(var.shape):
+                var_encoding["chunksizes"] = tuple(
+                    min(preset["chunksize"], size) for size in var.shape)
+        if is_flag_variable(name) and preset.get("flag_dtype"):
+            dtype = np.dtype(preset["flag_dtype"])
+            if _fits_dtype(var.values, dtype):
+                var_encoding["dtype"] = dtype
+                has_missing = var.dtype.kind == "f" and np.isnan(var.values).any()
+                var_encoding["_FillValue"] = np.iinfo(dtype).max if has_missing else None
+            else:
+                logger.info(f"Not encoding {name} as {dtype}, values out of range")
+        elif name in ds.data_vars and var.dtype.kind == "f" and preset.get("float_dtype"):
+            var_encoding["dtype"] = np.dtype(preset["float_dtype"])
+        if var_encoding:
+            encoding[name] = var_encoding
+    return encoding
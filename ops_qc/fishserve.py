@@ -1,8 +1,10 @@
-import pandas as pd
 import numpy as np
-import xarray as xr
-import requests
 import logging
+from ops_qc.utils import LazyModule
+
+pd = LazyModule("pandas")
+xr = LazyModule("xarray")
+requests = LazyModule("requests")
 
 
 class CheckFishserve(object):
@@ -1,9 +1,11 @@
-import pandas as pd
 import numpy as np
-import xarray as xr
 import logging
 import datetime
-from ops_qc.utils import load_yaml
+from ops_qc.utils import load_yaml, LazyModule
+from ops_qc.readers import FisherMetadataIndex
+
+pd = LazyModule("pandas")
+xr = LazyModule("xarray")
 
 
 class PreProcessMangopare(object):
@@ -12,7 +14,8 @@ class PreProcessMangopare(object):
     Inputs:
         ds -- xarray dataset including data to be QC'd
             Generated using qc_readers.py, see for defaults.
-        fisher_metadata -- pandas dataframe with Mangopare fisher metadata
+        fisher_metadata -- pandas dataframe with Mangopare fisher metadata,
+            or a readers.FisherMetadataIndex of it for faster lookups.
             Generated using qc_readers.py, see for defaults.
         attr_file -- attribute yaml file, see attribute_list.yml in
             python package directory ops_qc/
@@ -81,12 +84,15 @@ class PreProcessMangopare(object):
         self.ds.attrs["gear_class"] = "unknown"
         try:
             ms = int(self.ds.attrs["moana_serial_number"])
-            sn_data = self.fisher_metadata.loc[
-                self.fisher_metadata["Mangopare serial number"] == ms
-            ]
             self.status_dict.update(self.ds.attrs)
             t_min = pd.to_datetime(np.min(self.ds["DATETIME"]).values)
             t_max = pd.to_datetime(np.max(self.ds["DATETIME"]).values)
+            if isinstance(self.fisher_metadata, FisherMetadataIndex):
+                sn_data = self.fisher_metadata.lookup(ms, t_min, t_max)
+            else:
+                sn_data = self.fisher_metadata.loc[
+                    self.fisher_metadata["Mangopare serial number"] == ms
+                ]
         except Exception as exc:
             self.logger.error(
                 "Could not calculate time range or sn data: {}".format(exc)
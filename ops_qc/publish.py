@@ -1,14 +1,15 @@
 import os
 import logging
 import numpy as np
-import pandas as pd
-import xarray as xr
-import seawater as sw
 import datetime as dt
 from glob import glob
-from ops_qc.utils import load_yaml
+from ops_qc.utils import load_yaml, write_netcdf_atomic, remove_stale_tempfiles, LazyModule
+from ops_qc.encoding import netcdf_encoding
+from ops_qc.ragged import to_ragged, from_ragged, is_ragged
 
-xr.set_options(keep_attrs=True)
+pd = LazyModule("pandas")
+xr = LazyModule("xarray")
+sw = LazyModule("seawater")
 
 # cycle_dt = dt.datetime.utcnow()
 
@@ -29,6 +30,17 @@ class Wrapper(object):
             that includes qc flags and updated status_file
         attr_file -- location of attribute_list.yml, default uses the one in the python
             package, should be a yaml file (see sample one in ops_qc directory)
+        encoding -- netcdf encoding preset name or dictionary (see ops_qc.encoding), the
+            TIME, QC_FLAG and POSITION_QC dtypes of the published format are always kept
+        output_format -- "netcdf" saves one file per deployment, "ragged" saves batches of
+            ragged_batch_size deployments in one CF-1.6 contiguous ragged array file
+            (featureType trajectory, see ops_qc.ragged).  Ragged array files in filelist
+            (i.e. from QcWrapper with output_format="ragged") are always read deployment
+            by deployment.
+        ragged_batch_size -- maximum number of deployments per ragged array file
+        tempfile_max_age -- files are written to a temporary file and renamed when complete,
+            temporary files older than this (seconds) left in out_dir by interrupted runs
+            are removed
 
     Returns:
         self._success_files -- list of files successfully reformatted and saved as new netcdf files
@@ -49,6 +61,10 @@ class Wrapper(object):
         global_attr_dict_name="global_attr_info",
         coords_attr_dict_name="coords_attr_info",
         global_attrs_dict="global_attrs",
+        encoding="default",
+        output_format="netcdf",
+        ragged_batch_size=1000,
+        tempfile_max_age=3600,
         logger=logging,
         **kwargs,
     ):
@@ -60,6 +76,12 @@ class Wrapper(object):
         self.global_attr_dict_name = global_attr_dict_name
         self.coords_attr_dict_name = coords_attr_dict_name
         self.global_attrs_dict = global_attrs_dict
+        self.encoding = encoding
+        self.output_format = output_format
+        self.ragged_batch_size = ragged_batch_size
+        self._ragged_buffer = []
+        self.tempfile_max_age = tempfile_max_age
+        self._cleaned_dirs = set()
         self.logger = logging
         self.coords_info = load_yaml(self.attr_file, self.coords_attr_dict_name)
         self.vars_info = load_yaml(self.attr_file, self.var_attr_dict_name)
@@ -78,23 +100,46 @@ class Wrapper(object):
     # def set_cycle(self, cycle_dt):
     #     self.cycle_dt = cycle_dt
 
-    def _available_for_publication(self, filename):
+    def _deployments(self, filename):
+        """
+        Yields (filename, ds, raw ds) for each deployment in filename, ds
+        decoded and raw ds undecoded.  For ragged array files filename is the
+        deployment's trajectory id in the same directory.  The file is opened
+        once and closed when the deployments have been used, files that can't
+        be opened are skipped (they couldn't be published).
+        """
+        try:
+            ds = xr.open_dataset(filename, cache=False, engine="netcdf4")
+        except Exception as exc:
+            self.logger.error(f"Could not open {filename}: {exc}")
+            return
+        with ds, xr.open_dataset(filename, cache=False, decode_cf=False) as raw:
+            if not is_ragged(ds):
+                yield filename, ds, raw
+                return
+            head = os.path.split(filename)[0]
+            for i, trajectory in enumerate(ds["trajectory"].values):
+                yield (
+                    os.path.join(head, f"{trajectory}.nc"),
+                    from_ragged(ds, i).load(),
+                    from_ragged(raw, i).load(),
+                )
+
+    def _available_for_publication(self, filename, ds=None):
+        if ds is None:
+            try:
+                with xr.open_dataset(filename, cache=False, engine="netcdf4") as ds:
+                    return self._available_for_publication(filename, ds)
+            except Exception:
+                return False
         try:
             # Check if data is public
-            public = xr.open_dataset(filename, cache=False, engine="netcdf4").attrs[
-                "public"
-            ]
+            public = ds.attrs["public"]
             # Check if the current data is after the agreement signature date
-            self.first_measurement = xr.open_dataset(
-                filename, cache=False, engine="netcdf4"
-            )[self.time_varname_source][0].values
-            self.last_measurement = xr.open_dataset(
-                filename, cache=False, engine="netcdf4"
-            )[self.time_varname_source][-1].values
+            self.first_measurement = ds[self.time_varname_source][0].values
+            self.last_measurement = ds[self.time_varname_source][-1].values
             publication_date = dt.datetime.strptime(
-                xr.open_dataset(filename, cache=False, engine="netcdf4").attrs[
-                    "publication_date"
-                ],
+                ds.attrs["publication_date"],
                 "%d/%m/%Y",
             )
             publication_date = np.datetime64(publication_date)
@@ -190,8 +235,11 @@ class Wrapper(object):
                         self.time_varname_source
                     ].attrs[attr]
 
-    def _reformat_file(self):
-        self.ds_o = xr.open_dataset(self.filename, cache=False, decode_cf=False)
+    def _reformat_file(self, ds_o=None):
+        if ds_o is None:
+            with xr.open_dataset(self.filename, cache=False, decode_cf=False) as ds_o:
+                return self._reformat_file(ds_o)
+        self.ds_o = ds_o
         ### Generate new file using the data from the previous file
         df = pd.DataFrame()
         for coords, items in self.coords_info.items():
@@ -220,11 +268,16 @@ class Wrapper(object):
 
     def _initialize_outdir(self, dir_path):
         """
-        Check if outdir exists, create if not
+        Check if outdir exists, create if not.  The first time each
+        directory is used, removes temporary files left by interrupted writes.
         """
         try:
             if not os.path.isdir(dir_path):
                 os.mkdir(dir_path)
+            if dir_path not in self._cleaned_dirs:
+                self._cleaned_dirs.add(dir_path)
+                for tmpfile in remove_stale_tempfiles(dir_path, self.tempfile_max_age):
+                    self.logger.info(f"Removed incomplete file {tmpfile}")
         except Exception as exc:
             self.logger.error(
                 "Could not create specified directory to save publishable files in: {}".format(
@@ -240,34 +293,67 @@ class Wrapper(object):
                 "No file list found, please specify.  No transformation for publication performed."
             )
 
+    def _encoding(self, ds):
+        encoding = netcdf_encoding(ds, self.encoding, logger=self.logger)
+        for var in ["TIME", "QC_FLAG", "POSITION_QC"]:
+            encoding.setdefault(var, {}).update({"dtype": "int32"})
+            encoding[var].pop("_FillValue", None)
+        return encoding
+
+    def _write_ragged_batch(self):
+        """
+        Saves the deployments waiting in self._ragged_buffer as one ragged
+        array file, named after the first deployment in the batch
+        """
+        if not self._ragged_buffer:
+            return
+        batch, self._ragged_buffer = self._ragged_buffer, []
+        savefile = "{}{}_batch{}{}{}".format(
+            self.out_dir, batch[0][0], len(batch), self.outfile_ext, ".nc"
+        )
+        ds = to_ragged(
+            [ds for _, ds in batch],
+            [trajectory for trajectory, _ in batch],
+            time_dim=self.time_varname_destination,
+        )
+        write_netcdf_atomic(
+            ds, savefile, mode="w", format="NETCDF4", encoding=self._encoding(ds)
+        )
+        self._saved_files["filelist"].append(savefile)
+
     def run(self):
+        # xarray is only imported when first used, see utils.LazyModule
+        xr.set_options(keep_attrs=True)
         self._set_filelist()
         for file in self.filelist:
-            if self._available_for_publication(file):
-                self.filename = file
-                self._reformat_file()
-                head, tail = os.path.split(self.filename)
-                if not self.out_dir:
-                    self.out_dir = head
-                # create (mkdir) out_dir if it doesn't exist
-                self._initialize_outdir(self.out_dir)
-                name = os.path.splitext(tail)[0].split("_")
-                end_date_name = pd.to_datetime(self.last_measurement).strftime(
-                    "%Y%m%d_%H%M%S"
-                )
-                savefile = "{}{}{}{}".format(
-                    self.out_dir,
-                    "_".join([name[0], end_date_name]),
-                    self.outfile_ext,
-                    ".nc",
-                )
-                encoding = {
-                    "TIME": {"dtype": "int32"},
-                    "QC_FLAG": {"dtype": "int32"},
-                    "POSITION_QC": {"dtype": "int32"},
-                }
-                self.ds.to_netcdf(
-                    savefile, mode="w", format="NETCDF4", encoding=encoding
-                )
-                self._saved_files["filelist"].append(savefile)
+            for self.filename, ds, ds_o in self._deployments(file):
+                if self._available_for_publication(self.filename, ds):
+                    self._reformat_file(ds_o)
+                    head, tail = os.path.split(self.filename)
+                    if not self.out_dir:
+                        self.out_dir = head
+                    # create (mkdir) out_dir if it doesn't exist
+                    self._initialize_outdir(self.out_dir)
+                    name = os.path.splitext(tail)[0].split("_")
+                    end_date_name = pd.to_datetime(self.last_measurement).strftime(
+                        "%Y%m%d_%H%M%S"
+                    )
+                    savefile = "{}{}{}{}".format(
+                        self.out_dir,
+                        "_".join([name[0], end_date_name]),
+                        self.outfile_ext,
+                        ".nc",
+                    )
+                    if self.output_format == "ragged":
+                        self._ragged_buffer.append(
+                            ("_".join([name[0], end_date_name]), self.ds))
+                        if len(self._ragged_buffer) >= self.ragged_batch_size:
+                            self._write_ragged_batch()
+                        continue
+                    write_netcdf_atomic(
+                        self.ds, savefile, mode="w", format="NETCDF4",
+                        encoding=self._encoding(self.ds)
+                    )
+                    self._saved_files["filelist"].append(savefile)
+        self._write_ragged_batch()
         return self._saved_files
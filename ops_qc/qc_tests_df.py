@@ -1,12 +1,13 @@
-import pandas as pd
 import numpy as np
 from datetime import datetime
-import seawater as sw
-import shapefile
-from ops_qc.utils import calc_speed, point_on_land
-from ops_qc.utils import start_end_dist
+from ops_qc.utils import calc_speed, point_on_land, LazyModule
+from ops_qc.utils import start_end_dist, speed_from_positions
+from ops_qc.context import qc_test
 import re
 
+pd = LazyModule("pandas")
+sw = LazyModule("seawater")
+
 """
 QC Tests for ocean observations.  The test options are:
 gear_type, timing_gap, impossible_date, impossible_location,
@@ -27,31 +28,68 @@ start_end_dist_check, reset_code_check, check_timestamp_overflow
 Possibly useful:
 gear_type, stuck_value, rate_of_change_test
 
-Note these are constantly changing/being updated/improved.
+Note these are constantly changing/being updated/improved.  Tests from
+other packages can be added with an entry point, see ops_qc.registry.
 
 Inputs:
-    ds - xarray dataset with sensor data and global attributes from
-        preprocess.py
-    df - pandas dataframe version of ds containing data with columns 
-        DATETIME, LATITUDE, LONGITUDE, PRESSURE, TEMPERATURE
-    qcdf - pandas dataframe either empty or containing previous qc
-        flag values for qc tests already performed
+    self - an ops_qc.context.QcContext (i.e. QcApply) with
+        ds - xarray dataset with sensor data and global attributes from
+            preprocess.py
+        column(name) - numpy array of DATETIME, LATITUDE, LONGITUDE,
+            PRESSURE or TEMPERATURE
+        flag(name) - flag values of qc tests already performed
+    or (@qc_test) any object with df, a pandas dataframe with those columns,
+    and qcdf, a pandas dataframe of flags.
 
 Outputs:
-    Updated self.qcdf with qc flags, one flag name for each test and one
-        qc flag value for each measurement. 
+    A uint8 flag array from self.new_flag for each flag name, one qc flag
+        value for each measurement (added to self.qcdf for dataframe objects).
 
 To-do:
-    This does not need to have both ds and df versions of the same data.
-    It got this way from inheriting code that used the pandas approach,
-    but we needed the attributes from the xarray dataset.  It works this
-    way but could be cleaner.
     Finish sensor-specific qc tests (mostly timing stuff).
     Add greylist check.
     Improve test "tuning."
 """
 
+# Tests that only look at one observation at a time, so the flags are the
+# same whether they are applied to a whole deployment or block by block
+# (see readers.MangopareChunkedReader).  All other tests use statistics,
+# windows or "everything after" rules over the whole deployment.
+BLOCKWISE_TESTS = [
+    "impossible_date",
+    "impossible_location",
+    "position_on_land",
+    "remove_ref_location",
+    "climatology_test",
+]
+
+
+# rows per block in stuck_value, bounds the memory used by its sliding windows
+STUCK_VALUE_BLOCK = 100000
+
+
+def _minutes(delta_time):
+    """timedelta64 array as float minutes"""
+    return delta_time.astype("timedelta64[ns]") / np.timedelta64(1, "s") / 60
+
+
+def _speed(self):
+    """Speed in kts between consecutive positions, unless there's a speed column"""
+    if self.has_column("speed"):
+        return self.column("speed")
+    return speed_from_positions(
+        self.column("DATETIME"),
+        self.column("LATITUDE"),
+        self.column("LONGITUDE"),
+        units="kts",
+    )
+
 
+@qc_test(
+    columns=["DATETIME", "LATITUDE", "LONGITUDE"],
+    attrs=["gear_class"],
+    produces=["flag_gear_type"],
+)
 def gear_type(self, fail_flag=3, gear=None, flag_name="flag_gear_type"):
     """
     With current Mangōpare workflow, this will always fail for stationary,
@@ -72,43 +110,47 @@ def gear_type(self, fail_flag=3, gear=None, flag_name="flag_gear_type"):
             )
         )
 
-    self.qcdf[flag_name] = np.ones_like(self.df["DATETIME"], dtype="uint8")
-    if "speed" not in self.df:
-        self.df = calc_speed(self.df, units="kts")
-    mean_speed = np.nanmean(self.df["speed"])
+    flag = self.new_flag(flag_name)
+    mean_speed = np.nanmean(_speed(self))
     if (mean_speed > 0 and gear == "stationary") or (
         mean_speed == 0 and gear == "mobile"
     ):
-        self.qcdf[flag_name] = fail_flag
+        flag[:] = fail_flag
 
 
 # 4. Timing/gap test
 
 
+@qc_test(columns=["DATETIME"], produces=["flag_timing_gap"])
 def timing_gap(self, max_min=60, num_obs=5, fail_flag=4, flag_name="flag_timing_gap"):
     """
     If observations are more than max_min minutes apart and there are less than
     num_obs observations on either side of the gap, flag the smaller
     "cluster" of obs (usually due to sensor being splashed with water)
     """
-    self.qcdf[flag_name] = np.ones_like(self.df["DATETIME"], dtype="uint8")
-    delta_time = self.df.DATETIME.diff().dt.total_seconds() / 60
+    flag = self.new_flag(flag_name)
+    delta_time = _minutes(np.diff(self.column("DATETIME")))
     gap_ind = (
         [0]
-        + [i for i in range(len(delta_time)) if delta_time[i] > max_min]
-        + [len(self.df.DATETIME) - 1]
+        + list(np.flatnonzero(delta_time > max_min) + 1)
+        + [len(flag) - 1]
     )
     if len(gap_ind) > 1:
         for i1, i2 in zip(gap_ind[:-1], gap_ind[1:]):
             if i2 - i1 == 0:  # single end point
-                self.qcdf.loc[self.qcdf.index[i1], flag_name] = fail_flag
+                flag[i1] = fail_flag
             elif i2 - i1 < num_obs:  # small group "clusters"
-                self.qcdf.loc[self.qcdf.index[i1:i2], flag_name] = fail_flag
+                flag[i1:i2] = fail_flag
 
 
 # 5. Impossible date test
 
 
+@qc_test(
+    columns=["DATETIME"],
+    attrs=["download_time"],
+    produces=["flag_impossible_date"],
+)
 def impossible_date(
     self,
     min_date=datetime(2010, 1, 1),
@@ -124,25 +166,26 @@ def impossible_date(
     """
     if max_date == "offload":
         max_date = datetime.strptime(self.ds.download_time, "%d/%m/%Y %H:%M:%S")
-    self.qcdf[flag_name] = np.ones_like(self.df["DATETIME"], dtype="uint8")
-    self.qcdf.loc[(self.df["DATETIME"] >= max_date), flag_name] = fail_flag
+    flag = self.new_flag(flag_name)
+    times = self.column("DATETIME")
+    flag[times >= np.datetime64(max_date)] = fail_flag
     # min date could be a spreadsheet error
-    self.qcdf.loc[(self.df["DATETIME"] <= min_date), flag_name] = 3
+    flag[times <= np.datetime64(min_date)] = 3
 
 
+@qc_test(columns=["DATETIME"], produces=["flag_datetime_inc"])
 def datetime_increasing(self, fail_flag=4, flag_name="flag_datetime_inc"):
     """
     Check that datetime is monotonically increasing
     """
-    if not self.df["DATETIME"].is_monotonic_increasing:
-        self.qcdf[flag_name] = (
-            np.ones_like(self.df["LATITUDE"], dtype="uint8") * fail_flag
-        )
+    if not np.all(np.diff(self.column("DATETIME")) >= np.timedelta64(0)):
+        self.new_flag(flag_name, fail_flag)
 
 
 # 6. Impossible location test
 
 
+@qc_test(columns=["LATITUDE", "LONGITUDE"], produces=["flag_impossible_loc"])
 def impossible_location(
     self, lonrange=None, latrange=None, fail_flag=4, flag_name="flag_impossible_loc"
 ):
@@ -156,59 +199,64 @@ def impossible_location(
         latrange = [-90, 90]
     if lonrange is None:
         lonrange = [-180, 360]
-    self.qcdf[flag_name] = np.ones_like(self.df["LATITUDE"], dtype="uint8")
-    self.qcdf.loc[
-        (
-            (self.df["LATITUDE"] < latrange[0])
-            | (self.df["LATITUDE"] > latrange[1])
-            | (self.df["LONGITUDE"] < lonrange[0])
-            | (self.df["LONGITUDE"] > lonrange[1])
-        ),
-        flag_name,
+    flag = self.new_flag(flag_name)
+    lat = self.column("LATITUDE")
+    lon = self.column("LONGITUDE")
+    flag[
+        (lat < latrange[0])
+        | (lat > latrange[1])
+        | (lon < lonrange[0])
+        | (lon > lonrange[1])
     ] = fail_flag
 
 
 # Position on land
 
 
+@qc_test(columns=["LATITUDE", "LONGITUDE"], produces=["flag_land"], cost=300)
 def position_on_land(self, fail_flag=3, flag_name="flag_land"):
     """
     Spatial resolution of globe.is_land is 1km.  Not sufficient,
     but need to think about how to efficientlly import higher res mask.
     Leaving this test out for now.
     """
-    self.qcdf[flag_name] = np.ones_like(self.df["LATITUDE"], dtype="uint8")
+    # only needed here, so not imported with the other tests
+    import shapefile
+
+    flag = self.new_flag(flag_name)
     all_shapes = shapefile.Reader(
         "/source/moana-qc/ops_qc/land_mask/ne_10m_land.shp"
     ).shapes()
     failed = []
-    for lon, lat in zip(self.df["LONGITUDE"], self.df["LATITUDE"]):
+    for lon, lat in zip(self.column("LONGITUDE"), self.column("LATITUDE")):
         lon = (lon + 180) % 360 - 180
         failed.append(point_on_land(point=(lon, lat), all_shapes=all_shapes, tol=200))
-    self.qcdf.loc[failed, flag_name] = fail_flag
+    flag[np.array(failed, dtype=bool)] = fail_flag
 
 
 # 8. Impossible speed test
 
 
+@qc_test(columns=["DATETIME", "LATITUDE", "LONGITUDE"], produces=["flag_speed"])
 def impossible_speed(self, max_speed=100, fail_flag=3, flag_name="flag_speed"):
     """
     Don't really like calculating speed twice.  (Fixed)
     max_speed in knots.  Not a useful test with our current
     GPS accuracy.
     """
-    self.qcdf[flag_name] = np.ones_like(self.df["DATETIME"], dtype="uint8")
-    #    self.df.reset_index(drop=True)  #not sure why this is here?
-    if "speed" not in self.df:
-        self.df = calc_speed(self.df, units="kts")
-    if np.nanmean(np.absolute(self.df["speed"])) != 0:
-        self.qcdf[flag_name] = 1
-        self.qcdf.loc[(self.df["speed"] > max_speed), flag_name] = fail_flag
+    flag = self.new_flag(flag_name)
+    speed = _speed(self)
+    if np.nanmean(np.absolute(speed)) != 0:
+        flag[speed > max_speed] = fail_flag
 
 
 # 9. Global range test
 
 
+@qc_test(
+    columns=["DATETIME", "PRESSURE", "TEMPERATURE"],
+    produces=["flag_global_range_pres", "flag_global_range_temp"],
+)
 def global_range(self, ranges=None, fail_flag=[3, 4]):
     """
     Simplified version based on our experience so far.
@@ -225,26 +273,26 @@ def global_range(self, ranges=None, fail_flag=[3, 4]):
             "PRESSURE": [0, 1600, 2000, "flag_global_range_pres"],
             "TEMPERATURE": [-2, 30, 34, "flag_global_range_temp"],
         }
+    times = self.column("DATETIME")
     for var, limit in ranges.items():
         flag_name = limit[3]
         limit = limit[0:3]
-        self.qcdf[flag_name] = np.ones_like(self.df[var], dtype="uint8")
+        values = self.column(var)
+        flag = self.new_flag(flag_name)
         # Flag anything less than accepted value
-        self.qcdf.loc[self.df[var] < limit[0], flag_name] = fail_flag[1]
+        flag[values < limit[0]] = fail_flag[1]
         # Flag anything greater than limits, and everything afterwards
-        # first for expected range maximum:
-        too_high_times = self.df.loc[self.df[var] >= limit[1], "DATETIME"]
-        first_exceed = too_high_times.min()
-        self.qcdf.loc[self.df["DATETIME"] >= first_exceed, flag_name] = fail_flag[0]
-        # then for absolute range maximum:
-        too_high_times = self.df.loc[self.df[var] >= limit[2], "DATETIME"]
-        first_exceed = too_high_times.min()
-        self.qcdf.loc[self.df["DATETIME"] >= first_exceed, flag_name] = fail_flag[1]
+        # first for expected range maximum, then for absolute range maximum:
+        for max_value, max_flag in zip(limit[1:], fail_flag):
+            too_high_times = times[(values >= max_value) & ~np.isnat(times)]
+            if too_high_times.size:
+                flag[times >= too_high_times.min()] = max_flag
 
 
 # 10. Climatology test
 
 
+@qc_test(cost=300)
 def climatology_test(self):
     """
     Not sure what this is doing that is different from global_range test.
@@ -279,6 +327,10 @@ def climatology_test(self):
 # 11. Spike test
 
 
+@qc_test(
+    columns=["TEMPERATURE", "PRESSURE"],
+    produces=["flag_spike_temp", "flag_spike_pres"],
+)
 def spike(self, qc_vars=None, fail_flag=3):
     """
     So far this has only removed good data...need really high
@@ -295,16 +347,22 @@ def spike(self, qc_vars=None, fail_flag=3):
     for var, params in qc_vars.items():
         sdfactor = params[0]
         flag_name = params[1]
-        self.qcdf[flag_name] = np.ones_like(self.df[var], dtype="uint8")
-        thresh = np.std(self.df[var]) * sdfactor
-        val = np.abs(np.convolve(self.df[var], [-0.5, 1, -0.5], mode="same"))
+        values = self.column(var)
+        flag = self.new_flag(flag_name)
+        thresh = np.nanstd(values) * sdfactor
+        val = np.abs(np.convolve(values, [-0.5, 1, -0.5], mode="same"))
         # val = np.hstack((0,val))[:-1]
-        self.qcdf.loc[val > thresh, flag_name] = fail_flag
+        flag[val > thresh] = fail_flag
 
 
 # 12. Stuck value test
 
 
+@qc_test(
+    columns=["TEMPERATURE", "PRESSURE"],
+    produces=["flag_stuck_value_temp", "flag_stuck_value_pres"],
+    cost=30,
+)
 def stuck_value(self, qc_vars=None, rep_num=20, fail_flag=3):
     """
     Adapted from QARTOD - sort of.  This whole thing is suspect as implemented
@@ -322,21 +380,31 @@ def stuck_value(self, qc_vars=None, rep_num=20, fail_flag=3):
     for var, params in qc_vars.items():
         thresh = params[0]
         flag_name = params[1]
-        self.qcdf[flag_name] = np.ones_like(self.df[var], dtype="uint8")
-        arr = self.df[var]
-        it = np.nditer(arr)
-        # Maybe not very efficient, based on QARTOD code
-        for elem in it:
-            idx = it.iterindex
-            if idx >= rep_num:
-                is_suspect = np.all(np.abs(arr[idx - rep_num : idx] - elem) < thresh)
-                if is_suspect:
-                    self.qcdf[flag_name].iloc[idx - rep_num : idx] = fail_flag
+        arr = self.column(var)
+        flag = self.new_flag(flag_name)
+        # based on QARTOD code: value idx is suspect if the rep_num values
+        # before it are all within thresh of it, and those values are flagged
+        suspect = np.zeros(len(arr), dtype=bool)
+        for start in range(rep_num, len(arr), STUCK_VALUE_BLOCK):
+            stop = min(start + STUCK_VALUE_BLOCK, len(arr))
+            windows = np.lib.stride_tricks.sliding_window_view(
+                arr[start - rep_num : stop - 1], rep_num
+            )
+            suspect[start:stop] = np.all(
+                np.abs(windows - arr[start:stop, None]) < thresh, axis=1
+            )
+        # flag idx - rep_num ... idx - 1 for each suspect idx
+        idx = np.flatnonzero(suspect)
+        covered = np.zeros(len(arr) + 1, dtype=int)
+        np.add.at(covered, idx - rep_num, 1)
+        np.add.at(covered, idx, -1)
+        flag[np.cumsum(covered[:-1]) > 0] = fail_flag
 
 
 # 13. Rate of change test
 
 
+@qc_test(columns=["PRESSURE", "TEMPERATURE"], produces=["flag_roc"])
 def rate_of_change_test(
     self,
     thresh=2,
@@ -353,18 +421,18 @@ def rate_of_change_test(
     Old version doesn't really work for Mangopare, because the pressure
     delta isn't taken into consideration.  Another QARTOD-ish version:
     """
-    y = self.df[vary]
-    x = self.df[varx]
+    y = self.column(vary)
+    x = self.column(varx)
     try:
-        sd = np.std(y)
+        sd = np.nanstd(y)
         thresh = thresh + 2 * sd
-        self.qcdf[flag_name] = np.ones_like(x, dtype="uint8")
+        flag = self.new_flag(flag_name)
         # express rate of change as seconds, unit conversions will handle proper
         # comparison to threshold later
         with np.errstate(divide="ignore", invalid="ignore"):
             roc = np.abs(np.divide(np.diff(y), np.diff(x)))
         exceed = np.insert(roc > thresh, 0, False)
-        self.qcdf[flag_name].loc[exceed] = fail_flag
+        flag[exceed] = fail_flag
     except Exception as exc:
         self.logger.error("Could not apply rate of change test: {}".format(exc))
 
@@ -372,6 +440,7 @@ def rate_of_change_test(
 # 14.  Within radius of "bad" location (i.e. to remove calibration tests)
 
 
+@qc_test(columns=["LATITUDE", "LONGITUDE"], produces=["flag_ref_loc"])
 def remove_ref_location(
     self,
     bad_radius=5,
@@ -385,19 +454,25 @@ def remove_ref_location(
     in order to remove any testing values that weren't offloaded
     from the sensors at the time of test.
     """
-    self.qcdf[flag_name] = np.ones_like(self.df["LATITUDE"], dtype="uint8")
-    lats = self.df["LATITUDE"]
-    lons = self.df["LONGITUDE"]
-    d = [
-        float(sw.dist([ref_lat, lat], [ref_lon, lon])[0])
-        for lat, lon in zip(lats, lons)
-    ]
-    self.qcdf.loc[np.array(d) < bad_radius, flag_name] = fail_flag
+    flag = self.new_flag(flag_name)
+    lats = self.column("LATITUDE")
+    lons = self.column("LONGITUDE")
+    if not len(lats):
+        return
+    # one sw.dist call for all positions: every other pair of
+    # ref, lat0, ref, lat1, ... is the distance from ref to a position
+    pair_lats = np.empty(2 * len(lats))
+    pair_lons = np.empty(2 * len(lons))
+    pair_lats[0::2], pair_lats[1::2] = ref_lat, lats
+    pair_lons[0::2], pair_lons[1::2] = ref_lon, lons
+    d = sw.dist(pair_lats, pair_lons)[0][0::2]
+    flag[d < bad_radius] = fail_flag
 
 
 # 15.  Compare temps at depth bins during deployment
 
 
+@qc_test(columns=["PRESSURE", "TEMPERATURE"], produces=["flag_temp_drift"])
 def temp_drift(self, fail_flag=3, flag_name="flag_temp_drift"):
     """
     Compared all values from each cast in each depth bin, if the std
@@ -411,24 +486,27 @@ def temp_drift(self, fail_flag=3, flag_name="flag_temp_drift"):
     pres_bins = [0, 10, 20, 50, 100, 200, 400, 600, 1000, 2000]
     thresh_mm = [7, 7, 8, 8, 7, 8, 7, 7, 5]
     thresh_std = [2, 3.5, 3, 3, 3, 3, 2.5, 2.5, 1.5]
-    self.qcdf[flag_name] = np.ones_like(self.df["LATITUDE"], dtype="uint8")
+    flag = self.new_flag(flag_name)
+    pressure = self.column("PRESSURE")
+    temperature = self.column("TEMPERATURE")
     for p1, p2, tmm, tstd in zip(pres_bins[:-1], pres_bins[1:], thresh_mm, thresh_std):
-        t_in_bin = self.df.loc[
-            ((self.df["PRESSURE"] > p1) & (self.df["PRESSURE"] < p2))
-        ]["TEMPERATURE"]
+        in_bin = (pressure > p1) & (pressure < p2)
+        t_in_bin = temperature[in_bin]
         if len(t_in_bin) < 1:
             continue
         t_std = np.nanstd(t_in_bin)
         t_diff = np.nanmax(t_in_bin) - np.nanmin(t_in_bin)
         if (t_std > tstd) & (t_diff > tmm):
-            self.qcdf.loc[
-                ((self.df["PRESSURE"] > p1) & (self.df["PRESSURE"] < p2)), flag_name
-            ] = fail_flag
+            flag[in_bin] = fail_flag
 
 
 # 16.  Flag data for moana_firmware <2 after a reset
 
 
+@qc_test(
+    attrs=["moana_firmware", "reset_codes_data", "reset_codes_index"],
+    produces=["flag_reset_old_firmware"],
+)
 def reset_code_check(
     self, moana_firmware=2.00, fail_flag=4, flag_name="flag_reset_old_firmware"
 ):
@@ -436,7 +514,7 @@ def reset_code_check(
     For older firmware versions, mark any timestamps after
     reset as "bad."  Newer firmware is ok after reset.
     """
-    self.qcdf[flag_name] = np.ones_like(self.df["DATETIME"], dtype="uint8")
+    flag = self.new_flag(flag_name)
     sensor_moana_firmware = self.ds.attrs["moana_firmware"]
     if "WAVE" not in sensor_moana_firmware:
         sensor_moana_firmware = [
@@ -449,12 +527,18 @@ def reset_code_check(
         and self.ds.attrs["reset_codes_data"] != "None"
     ):
         first_reset_location = int(self.ds.attrs["reset_codes_index"].split(", ")[0])
-        self.qcdf.iloc[first_reset_location::, -1] = fail_flag
+        flag[first_reset_location::] = fail_flag
 
 
 # 17. Checks for timestamp overflow of data
 
 
+@qc_test(
+    columns=["DATETIME", "PRESSURE"],
+    attrs=["moana_firmware", "download_time"],
+    produces=["flag_timestamp_overflow"],
+    cost=10,
+)
 def check_timestamp_overflow(
     self,
     moana_firmware=2.00,
@@ -471,7 +555,7 @@ def check_timestamp_overflow(
     and gap must occur if the time gap between this measurement and the download time is
     greater than 18.2 hours. Newer firmware doesn't have this timestamp overflow error.
     """
-    self.qcdf[flag_name] = np.ones_like(self.df["DATETIME"], dtype="uint8")
+    flag = self.new_flag(flag_name)
     sensor_moana_firmware = self.ds.attrs["moana_firmware"]
     if "WAVE" not in sensor_moana_firmware:
         sensor_moana_firmware = [
@@ -515,12 +599,23 @@ def check_timestamp_overflow(
             if interval > 65535
         ]
         if first_surface in download_possible_overflow_index:
-            self.qcdf.iloc[first_surface::, -1] = fail_flag[0]
+            flag[first_surface::] = fail_flag[0]
 
 
 # anything from here depends on previous qc tests
 
 
+@qc_test(
+    columns=["PRESSURE"],
+    flags=[
+        "flag_gear_type",
+        "flag_timing_gap",
+        "flag_land",
+        "flag_ref_loc",
+    ],
+    attrs=["gear_class"],
+    produces=["flag_surf_loc"],
+)
 def stationary_position_check(
     self,
     surface_pres=10,
@@ -535,12 +630,13 @@ def stationary_position_check(
     be using vessel positions when the vessel is far away from the gear.  This
     test should be done after all other pressure or location qc tests.
     """
-    self.qcdf[flag_name] = np.ones_like(self.df["LATITUDE"], dtype="uint8")
+    flag = self.new_flag(flag_name)
     if self.ds.attrs["gear_class"] == "stationary":
         fail_flag = fail_flag[1]
     if self.ds.attrs["gear_class"] == "mobile":
         fail_flag = fail_flag[0]
     # method 1 (if included in test_list_1)
+    # no test makes flag_date or flag_location, so they aren't declared
     include_flags = [
         flagname
         for flagname in [
@@ -551,21 +647,32 @@ def stationary_position_check(
             "flag_land",
             "flag_ref_loc",
         ]
-        if flagname in self.qcdf.keys()
+        if flagname in self.flag_names()
     ]
-    combined_flag = self.qcdf[include_flags].max(axis=1).astype("int")
-    df2 = self.df.loc[combined_flag <= np.nanmax(good_pos_qc)]
+    if not include_flags:
+        flag[:] = 0
+        raise ValueError("No location or timing flags to check positions with")
+    combined_flag = np.fmax.reduce([self.flag(name) for name in include_flags])
+    pressure = self.column("PRESSURE")[combined_flag <= np.nanmax(good_pos_qc)]
     # method 1 (if included in test_list_2)
     # df2 = self.df.loc[self.df['LOCATION_QC']<=np.nanmax(good_pos_qc)]
     # the following check isn't really necessary, since apply_qc will catch failed tests
-    if len(df2) < 1:
+    if len(pressure) < 1:
         # can't apply test, not enough good location data
-        self.qcdf.loc[:, flag_name] = 0
+        flag[:] = 0
         raise Exception
-    if (df2.PRESSURE.iloc[0] > surface_pres) or (df2.PRESSURE.iloc[-1] > surface_pres):
-        self.qcdf.loc[:, flag_name] = fail_flag
-
-
+    if (pressure[0] > surface_pres) or (pressure[-1] > surface_pres):
+        flag[:] = fail_flag
+
+
+@qc_test(
+    # positions and flags are read when start_end_dist_m isn't set
+    columns=["LATITUDE", "LONGITUDE"],
+    flags=["LOCATION_QC", "DATETIME_QC"],
+    attrs=["start_end_dist_m"],
+    produces=["flag_dist"],
+    gear_class=["stationary"],
+)
 def start_end_dist_check(
     self, fail_flag=[2, 3], cutoffs=[5, 50], flag_name="flag_dist"
 ):
@@ -593,7 +700,7 @@ def start_end_dist_check(
         ff = 4
     else:
         ff = 1
-    self.qcdf[flag_name] = np.ones_like(self.df["LATITUDE"], dtype="uint8") * ff
+    self.new_flag(flag_name, ff)
 
 
 # Sensor known "
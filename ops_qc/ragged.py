@@ -0,0 +1,156 @@
+import numpy as np
+from ops_qc.utils import LazyModule
+
+xr = LazyModule("xarray")
+
+"""
+CF-1.6 discrete sampling geometry output: many deployments in one netcdf file
+as a contiguous ragged array with featureType trajectory.  Observations of all
+deployments are stored one after another along the obs dimension, row_size
+gives the number of observations of each trajectory, and each deployment's
+global attributes are stored as string variables along the trajectory dimension.
+See http://cfconventions.org/Data/cf-conventions/cf-conventions-1.6/build/cf-conventions.html#discrete-sampling-geometries
+"""
+
+OBS_DIM = "obs"
+TRAJECTORY_DIM = "trajectory"
+TIME_DIM = "DATETIME"
+GLOBAL_ATTRIBUTE = "global_attribute"
+# global attributes with a meaning for netcdf readers, stored as attr_<name>
+RESERVED_NAMES = ["Conventions", "conventions", "featureType", "coordinates"]
+
+
+def _missing_value(dtype):
+    if dtype.kind == "M":
+        return np.datetime64("NaT")
+    if dtype.kind in "SU":
+        return dtype.type()
+    return np.nan
+
+
+def _concatenate(arrays, sizes):
+    """
+    Concatenates arrays, None entries (deployments without that variable) are
+    filled with missing values
+    """
+    present = [values for values in arrays if values is not None]
+    dtype = np.result_type(*present)
+    filled = []
+    for values, size in zip(arrays, sizes):
+        if values is None:
+            missing = _missing_value(dtype)
+            if isinstance(missing, float) and dtype.kind in "biu":
+                dtype = np.dtype(float)
+            values = np.full(size, missing, dtype=dtype if dtype.kind != "O" else object)
+        filled.append(values)
+    return np.concatenate(filled)
+
+
+def to_ragged(datasets, trajectory_ids, time_dim=TIME_DIM, attrs={}):
+    """
+    Combines deployment datasets (all along time_dim) into one contiguous
+    ragged array dataset.
+    Inputs:
+        datasets -- list of xarray datasets, one per deployment
+        trajectory_ids -- list of unique names, one per deployment
+        time_dim -- name of the observation dimension in datasets
+        attrs -- extra global attributes for the combined dataset
+    Variables missing from some deployments are filled with missing values.
+    Variable attributes are taken from the first deployment with each variable.
+    """
+    sizes = [ds.sizes[time_dim] for ds in datasets]
+    names = list(dict.fromkeys(name for ds in datasets for name in ds.variables))
+    combined = xr.Dataset(
+        attrs=dict(attrs, featureType="trajectory", Conventions="CF-1.6",
+                   deployment_time_dim=time_dim))
+    for name in names:
+        if any(name in ds.variables and ds[name].dims != (time_dim,) for ds in datasets):
+            # only per-observation variables can be stored along obs
+            continue
+        arrays = [ds[name].values if name in ds.variables else None for ds in datasets]
+        first = next(ds[name] for ds in datasets if name in ds.variables)
+        # coordinates are written by xarray from the combined coordinates
+        attrs = {k: v for k, v in first.attrs.items() if k != "coordinates"}
+        combined[name] = xr.Variable(OBS_DIM, _concatenate(arrays, sizes), attrs=attrs)
+        if "units" in first.encoding and first.dtype.kind == "M":
+            combined[name].encoding["units"] = first.encoding["units"]
+    coords = [
+        name for name in dict.fromkeys(name for ds in datasets for name in ds.coords)
+        if name in combined.variables
+    ]
+    combined = combined.set_coords(coords)
+    combined["trajectory"] = xr.Variable(
+        TRAJECTORY_DIM, np.array(trajectory_ids, dtype=object),
+        attrs={"cf_role": "trajectory_id", "long_name": "deployment"})
+    combined["row_size"] = xr.Variable(
+        TRAJECTORY_DIM, np.array(sizes, dtype=np.int64),
+        attrs={"sample_dimension": OBS_DIM,
+               "long_name": "number of observations for this trajectory"})
+    attr_names = list(dict.fromkeys(name for ds in datasets for name in ds.attrs))
+    for name in attr_names:
+        values = [str(ds.attrs[name]) if name in ds.attrs else "" for ds in datasets]
+        var_name = name
+        if name in combined.variables or name in RESERVED_NAMES:
+            var_name = f"attr_{name}"
+        combined[var_name] = xr.Variable(
+            TRAJECTORY_DIM, np.array(values, dtype=object),
+            attrs={"source": GLOBAL_ATTRIBUTE, "attribute_name": name})
+    return combined
+
+
+def is_ragged(ds):
+    return ds.attrs.get("featureType") == "trajectory" and "row_size" in ds.variables
+
+
+def ragged_offsets(ds):
+    """
+    Row offsets of each trajectory, trajectory i is obs offsets[i]:offsets[i+1]
+    """
+    return np.concatenate([[0], np.cumsum(ds["row_size"].values)]).astype(np.int64)
+
+
+def trajectory_index(ds, trajectory):
+    """Index of trajectory, given either its index or its trajectory id"""
+    if isinstance(trajectory, (int, np.integer)):
+        return int(trajectory)
+    ids = [str(value) for value in ds["trajectory"].values]
+    return ids.index(trajectory)
+
+
+def from_ragged(ds, trajectory, time_dim=None):
+    """
+    Returns one deployment (index or trajectory id) from a ragged dataset in
+    the layout it had before to_ragged, reading only its rows if ds was opened
+    lazily.  Global attributes are restored as strings, and empty attributes
+    (not set for this deployment) are left out.  Variables the deployment did
+    not have come back filled with missing values.  time_dim defaults to the
+    time dimension name the deployments had in to_ragged.
+    """
+    time_dim = time_dim or ds.attrs.get("deployment_time_dim", TIME_DIM)
+    i = trajectory_index(ds, trajectory)
+    offsets = ragged_offsets(ds)
+    obs_vars = [name for name, var in ds.variables.items() if var.dims == (OBS_DIM,)]
+    deployment = ds[obs_vars].isel({OBS_DIM: slice(offsets[i], offsets[i + 1])})
+    deployment = deployment.reset_coords()
+    if time_dim in deployment.variables:
+        deployment = deployment.swap_dims({OBS_DIM: time_dim})
+    else:
+        deployment = deployment.rename_dims({OBS_DIM: time_dim})
+    deployment.attrs = {}
+    for name, var in ds.variables.items():
+        if var.attrs.get("source") == GLOBAL_ATTRIBUTE:
+            value = var.values[i]
+            value = value.decode() if isinstance(value, bytes) else str(value)
+            if value:
+                deployment.attrs[var.attrs["attribute_name"]] = value
+    coords = [name for name in obs_vars if name in ds.coords and name != time_dim]
+    return deployment.set_coords(coords)
+
+
+def open_deployment(filename, trajectory, **kwargs):
+    """
+    Opens a ragged array netcdf file and loads one deployment from it,
+    kwargs are passed to xarray.open_dataset
+    """
+    with xr.open_dataset(filename, **kwargs) as ds:
+        return from_ragged(ds, trajectory).load()
@@ -1,14 +1,22 @@
+import os
 import numpy as np
-import pandas as pd
 from datetime import datetime
 import logging
 import subprocess
 import io
+import json
 import re
-import requests
 
 import ops_qc
-from ops_qc.utils import catch
+from ops_qc.cache import ContentCache, content_key
+from ops_qc.utils import catch, LazyModule
+
+pd = LazyModule("pandas")
+requests = LazyModule("requests")
+
+# Increment when a change to MangopareStandardReader parsing or formatting
+# would change the cached columns, so old cache entries are not reused.
+READER_VERSION = "1"
 
 
 class MangopareStandardReader(object):
@@ -27,6 +35,17 @@ class MangopareStandardReader(object):
                 example: startstring = 'DateTime (UTC)'
             self.dateformat: date format to convert to pd.datetime object
                 example: dateformat = '%Y%m%dT%H%M%S'
+            self.single_pass: read the file into memory once, split the header
+                from the data with a byte search and parse both from that buffer
+                (true) or scan the file for the header, then reread it for the
+                attributes and the data (false)
+            self.cache_dir: if set, parsed and formatted columns are cached in
+                this directory, keyed by file contents and READER_VERSION, so
+                unchanged files are not parsed again.  Implies single pass.
+                Whether the file was a cache "hit" or "miss" is kept in
+                self.cache_result.
+            self.cache_max_bytes: maximum size of cache_dir before the least
+                recently used entries are removed
         Output:
             self.ds = xarray dataset including data attributes
 
@@ -42,6 +61,9 @@ class MangopareStandardReader(object):
         startstring="DateTime (UTC)",
         skip_rows=11,
         default_reset_value=44.444,
+        single_pass=False,
+        cache_dir=None,
+        cache_max_bytes=1024**3,
         logger=logging,
     ):
         self.filename = filename
@@ -50,7 +72,12 @@ class MangopareStandardReader(object):
         self.startstring = startstring
         self.skip_rows = skip_rows
         self.default_reset_value = default_reset_value
+        self.single_pass = single_pass
+        self.cache_dir = cache_dir
+        self.cache_max_bytes = cache_max_bytes
         self.logger = logger
+        self._header_lines = None
+        self.cache_result = None
 
         self.global_attrs = {
             "date_quality_controlled": datetime.utcnow()
@@ -62,15 +89,29 @@ class MangopareStandardReader(object):
             "raw_data_filename": self.filename,
         }
 
-    def _read_mangopare_csv(self):
+    def _read_mangopare_csv(self, buffer=None):
         """
         Opens a mangopare csv file in pandas, formats the data, converts to xarray
+        If buffer (the file contents) is given, parses that instead of
+        opening the file again.
         """
         try:
-            self.start_line = self._calc_header_rows(default_skiprows=self.skip_rows)
+            if buffer is not None:
+                source = self._split_header(buffer)
+                skiprows = 0
+            elif self.single_pass:
+                with open(self.filename, "rb") as f:
+                    source = self._split_header(f.read())
+                skiprows = 0
+            else:
+                self.start_line = self._calc_header_rows(
+                    default_skiprows=self.skip_rows
+                )
+                source = self.filename
+                skiprows = self.start_line
             self.df = pd.read_csv(
-                self.filename,
-                skiprows=self.start_line,
+                source,
+                skiprows=skiprows,
                 on_bad_lines="error",
                 float_precision="round_trip",
             )
@@ -202,30 +243,64 @@ class MangopareStandardReader(object):
             )
         return start_line
 
+    def _split_header(self, buffer):
+        """
+        Single pass version of _calc_header_rows.  Finds the last line that
+        starts with startstring using a byte search, keeps the header lines
+        for _load_global_attributes and returns the data section (including
+        the column names) as a buffer for pd.read_csv.
+        """
+        marker = (self.startstring + ",").encode()
+        # rfind returns -1 if not found, so the data then starts at the top of
+        # the file, as it does for _calc_header_rows
+        data_start = buffer.rfind(b"\n" + marker) + 1
+        header = buffer[:data_start].decode()
+        self._header_lines = header.splitlines(keepends=True)
+        self.start_line = len(self._header_lines)
+        return io.BytesIO(buffer[data_start:])
+
+    def _read_header_lines(self):
+        """
+        Returns the self.start_line header rows, reusing the ones kept by
+        _split_header if the file has already been read in single pass mode.
+        """
+        if self._header_lines is not None:
+            return self._header_lines
+        with open(self.filename) as f:
+            return [f.readline() for _ in range(self.start_line)]
+
+    def _file_attributes(self):
+        """
+        Returns the attributes from the csv file header followed by
+        self.global_attrs, as a dictionary.
+        """
+        attrs = {}
+        for line in self._read_header_lines():
+            row = line.split(",")
+            attr_name = row[0]
+            # extract units from attr_name and
+            # append to attr_val
+            res = re.findall(r"\(.*?\)", attr_name)
+            if not res:
+                res = ""
+            else:
+                res = " " + res[0]
+            if attr_name == "Cellular upload position":
+                attr_val = str(row[1].strip()) + ", " + str(row[2].strip())
+            else:
+                attr_val = str(row[1].strip()) + res
+            # remove 'illegal' characters
+            attr_name = re.sub("[\(\[].*?[\)\]]", "", attr_name).strip()
+            attr_name = re.sub(" ", "_", attr_name).lower()
+            attrs[attr_name] = attr_val
+        for name, value in self.global_attrs.items():
+            attrs[name] = value
+        return attrs
+
     def _load_global_attributes(self):
         # Add attributes from csv file header
         try:
-            f = open(self.filename)
-            for _ in range(self.start_line):
-                row = f.readline().split(",")
-                attr_name = row[0]
-                # extract units from attr_name and
-                # append to attr_val
-                res = re.findall(r"\(.*?\)", attr_name)
-                if not res:
-                    res = ""
-                else:
-                    res = " " + res[0]
-                if attr_name == "Cellular upload position":
-                    attr_val = str(row[1].strip()) + ", " + str(row[2].strip())
-                else:
-                    attr_val = str(row[1].strip()) + res
-                # remove 'illegal' characters
-                attr_name = re.sub("[\(\[].*?[\)\]]", "", attr_name).strip()
-                attr_name = re.sub(" ", "_", attr_name).lower()
-                self.ds.attrs[attr_name] = attr_val
-            for name, value in self.global_attrs.items():
-                self.ds.attrs[name] = value
+            self.ds.attrs.update(self._file_attributes())
         except Exception as exc:
             self.logger.error(
                 "Could not load global attributes for {} due to {}".format(
@@ -236,20 +311,340 @@ class MangopareStandardReader(object):
                 f"Could not load global attributes during data file read due to: {exc}"
             )
 
-    def run(self):
-        # read file based on self.filetype
-        self._read_mangopare_csv()
+    def _cache_key(self, buffer):
+        return content_key(
+            buffer,
+            READER_VERSION,
+            self.dateformat,
+            self.startstring,
+            self.default_reset_value,
+        )
+
+    def _read_cached_csv(self):
+        """
+        Loads the formatted columns, header and reset codes from the parse
+        cache if this file's contents have been read before, otherwise
+        parses the file and adds it to the cache.
+        """
+        reset_attrs = ["reset_codes_data", "reset_codes_timestamps", "reset_codes_index"]
+        try:
+            with open(self.filename, "rb") as f:
+                buffer = f.read()
+        except Exception as exc:
+            self.logger.error(
+                "Could not read csv file {} due to {}".format(self.filename, exc)
+            )
+            raise type(exc)(f"Could not read csv file due to: {exc}")
+        cache = ContentCache.shared(self.cache_dir, self.cache_max_bytes, logger=self.logger)
+        key = self._cache_key(buffer)
+        cached = cache.get(key)
+        if cached is not None:
+            columns, metadata = cached
+            self.df = pd.DataFrame({name: columns[name] for name in metadata["columns"]})
+            self._header_lines = metadata["header_lines"]
+            self.start_line = len(self._header_lines)
+            for name in reset_attrs:
+                self.global_attrs[name] = metadata[name]
+            self.cache_result = "hit"
+            return
+        self.cache_result = "miss"
+        self._read_mangopare_csv(buffer)
         self._format_df_data()
         self._identify_sensor_resets()
+        metadata = {name: self.global_attrs[name] for name in reset_attrs}
+        metadata.update(
+            {"columns": list(self.df.columns), "header_lines": self._header_lines}
+        )
+        cache.put(
+            key, {name: self.df[name].to_numpy() for name in self.df.columns}, metadata
+        )
+
+    def run(self):
+        # read file based on self.filetype
+        if self.cache_dir:
+            self._read_cached_csv()
+        else:
+            self._read_mangopare_csv()
+            self._format_df_data()
+            self._identify_sensor_resets()
         self._convert_df_to_ds()
         self._load_global_attributes()
         return self.ds
 
 
+class MangopareBatch(object):
+    """
+    Data from several Mangopare csv files held as one set of contiguous
+    columns, so that downstream stages can work on a whole batch instead
+    of one pandas/xarray object per file.
+    Inputs:
+        data -- dictionary of column name: numpy array, one value per
+            observation for all deployments, concatenated in file order
+        offsets -- numpy int64 array of length n_deployments + 1, rows
+            offsets[i]:offsets[i+1] belong to deployment i
+        attrs -- pandas dataframe with one row per deployment containing the
+            global attributes that MangopareStandardReader would assign
+        failed -- dictionary of filename: error for files that could not be read
+    """
+
+    def __init__(self, data, offsets, attrs, failed=None):
+        self.data = data
+        self.offsets = offsets
+        self.attrs = attrs
+        self.failed = failed or {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def filenames(self):
+        if "raw_data_filename" not in self.attrs:
+            # empty batch
+            return []
+        return list(self.attrs["raw_data_filename"])
+
+    def deployment(self, index):
+        """
+        Returns the columns of deployment number index as numpy views
+        """
+        rows = slice(self.offsets[index], self.offsets[index + 1])
+        return {name: values[rows] for name, values in self.data.items()}
+
+    def to_dataset(self, index):
+        """
+        Builds the xarray dataset for deployment number index.  Only has
+        the batch's columns, so with the default MangopareBatchReader
+        columns it is the same as MangopareStandardReader.run() returns
+        for that file.
+        """
+        df = pd.DataFrame(self.deployment(index)).set_index(["DATETIME"])
+        ds = df.to_xarray()
+        ds = ds.set_coords([name for name in ["LATITUDE", "LONGITUDE"] if name in ds])
+        ds.attrs.update(self.attrs.iloc[index].dropna().to_dict())
+        return ds
+
+
+class MangopareBatchReader(object):
+    """
+    Read many Mangopare csv files into a single MangopareBatch.  Uses
+    MangopareStandardReader (in single pass mode) to parse and format each
+    file, but skips the per-file conversion to xarray.
+    Inputs:
+        filelist -- list of mangopare csv files to read
+        reader_kwargs -- keyword arguments passed to MangopareStandardReader,
+            i.e. dateformat, startstring, default_reset_value
+    Output:
+        MangopareBatch with DATETIME, LATITUDE, LONGITUDE, PRESSURE and
+        TEMPERATURE columns.  Files that could not be read are logged and
+        listed in MangopareBatch.failed instead of stopping the batch.
+    """
+
+    def __init__(
+        self,
+        filelist,
+        columns=["DATETIME", "LATITUDE", "LONGITUDE", "PRESSURE", "TEMPERATURE"],
+        reader_kwargs={},
+        logger=logging,
+    ):
+        self.filelist = filelist
+        self.columns = columns
+        self.reader_kwargs = reader_kwargs
+        self.logger = logger
+
+    def _read_file(self, filename):
+        """
+        Reads and formats one file, returns its columns and attributes
+        """
+        reader = MangopareStandardReader(
+            filename, single_pass=True, logger=self.logger, **self.reader_kwargs
+        )
+        reader._read_mangopare_csv()
+        reader._format_df_data()
+        reader._identify_sensor_resets()
+        # same row selection as MangopareStandardReader._convert_df_to_ds
+        df = reader.df.dropna(axis=0, how="any")
+        return [df[name].to_numpy() for name in self.columns], reader._file_attributes()
+
+    def run(self):
+        columns = [[] for _ in self.columns]
+        lengths = []
+        attrs = []
+        failed = {}
+        for filename in self.filelist:
+            try:
+                file_columns, file_attrs = self._read_file(filename)
+            except Exception as exc:
+                self.logger.error(
+                    "Could not add {} to batch due to {}".format(filename, exc)
+                )
+                failed[filename] = str(exc)
+                continue
+            for values, file_values in zip(columns, file_columns):
+                values.append(file_values)
+            lengths.append(len(file_columns[0]))
+            attrs.append(file_attrs)
+        offsets = np.zeros(len(lengths) + 1, dtype="int64")
+        np.cumsum(lengths, out=offsets[1:])
+        data = {
+            name: np.concatenate(values) if values else np.array([])
+            for name, values in zip(self.columns, columns)
+        }
+        return MangopareBatch(data, offsets, pd.DataFrame(attrs), failed)
+
+
+class MangopareBlock(object):
+    """
+    One fixed-size block of a Mangopare csv file read by MangopareChunkedReader.
+    Inputs:
+        data -- dictionary of column name: numpy array for the rows in this block
+        attrs -- global attributes for the file, with the reset codes found in
+            this block (reset_codes_index counts rows from the start of the file)
+        start -- row number of the first row in this block, counted after
+            duplicate times are dropped, as for reset_codes_index
+    """
+
+    def __init__(self, data, attrs, start):
+        self.data = data
+        self.attrs = attrs
+        self.start = start
+
+    def __len__(self):
+        return len(self.data["DATETIME"])
+
+    def to_dataset(self):
+        df = pd.DataFrame(self.data).set_index(["DATETIME"])
+        ds = df.to_xarray().set_coords(["LATITUDE", "LONGITUDE"])
+        ds.attrs.update(self.attrs)
+        return ds
+
+
+class MangopareChunkedReader(MangopareStandardReader):
+    """
+    Read a Mangopare csv file in fixed-size blocks, so that memory use does
+    not depend on the file length (i.e. for long-line and potting gear left
+    out for months).  run() is a generator of MangopareBlock objects, each
+    formatted the same way as MangopareStandardReader.
+    Inputs:
+        chunksize -- number of csv rows per block
+        Other inputs as for MangopareStandardReader.
+
+    Only the QC tests in qc_tests_df.BLOCKWISE_TESTS give the same flags
+    when applied block by block, all other tests need the whole deployment.
+    Duplicate times are dropped within a block and against the last time
+    of the previous block, which covers the repeated timestamps seen in
+    Mangopare files, but not duplicates that are far apart.
+    """
+
+    def __init__(self, filename, chunksize=100000, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.chunksize = chunksize
+
+    def _offset_reset_index(self, offset):
+        """
+        Converts reset_codes_index found by _identify_sensor_resets in this
+        block to a row number counted from the start of the file
+        """
+        if self.global_attrs["reset_codes_index"] != "None":
+            self.global_attrs["reset_codes_index"] = ", ".join(
+                str(int(x) + offset)
+                for x in self.global_attrs["reset_codes_index"].split(", ")
+            )
+
+    def run(self):
+        self.start_line = self._calc_header_rows(default_skiprows=self.skip_rows)
+        try:
+            header_attrs = self._file_attributes()
+            chunks = pd.read_csv(
+                self.filename,
+                skiprows=self.start_line,
+                on_bad_lines="error",
+                float_precision="round_trip",
+                chunksize=self.chunksize,
+            )
+        except Exception as exc:
+            self.logger.error(
+                "Could not read csv file {} due to {}".format(self.filename, exc)
+            )
+            raise type(exc)(f"Could not read csv file due to: {exc}")
+        last_time = None
+        nrows = 0
+        for chunk in chunks:
+            self.df = chunk.reset_index(drop=True)
+            self._format_df_data()
+            if last_time is not None:
+                self.df = self.df.loc[self.df["DATETIME"] != last_time]
+            if len(self.df) < 1:
+                continue
+            last_time = self.df["DATETIME"].iloc[-1]
+            self._identify_sensor_resets()
+            self._offset_reset_index(nrows)
+            start = nrows
+            nrows += len(self.df)
+            df = self.df.dropna(axis=0, how="any")
+            attrs = dict(header_attrs)
+            attrs.update(self.global_attrs)
+            yield MangopareBlock(
+                {name: df[name].to_numpy() for name in df.columns}, attrs, start
+            )
+
+
+class FisherMetadataIndex(object):
+    """
+    Fisher metadata indexed by Mangopare serial number, so that the rows
+    for a deployment can be found without scanning the whole spreadsheet.
+    For each serial number, the "Date supplied" times are kept sorted, so a
+    binary search finds the rows supplied before the deployment started,
+    and only those are checked against "Date returned".
+    Inputs:
+        fisher_metadata -- pandas dataframe from MangopareMetadataReader
+        serial_column -- name of the Mangopare serial number column
+    """
+
+    def __init__(self, fisher_metadata, serial_column="Mangopare serial number"):
+        self.fisher_metadata = fisher_metadata
+        self.serial_column = serial_column
+        self._build_index()
+
+    def _build_index(self):
+        supplied = pd.to_datetime(
+            self.fisher_metadata["Date supplied"], errors="coerce"
+        ).to_numpy(dtype="datetime64[ns]")
+        # returned date is rounded to the first minute of the next day, as in
+        # PreProcessMangopare._classify_gear
+        returned = (
+            pd.to_datetime(self.fisher_metadata["Date returned"], errors="coerce")
+            .dt.normalize()
+            + pd.Timedelta(days=1)
+        ).to_numpy(dtype="datetime64[ns]")
+        self._index = {}
+        serials = self.fisher_metadata[self.serial_column]
+        for serial, positions in serials.groupby(serials, sort=False).indices.items():
+            positions = positions[~np.isnat(supplied[positions])]
+            order = np.argsort(supplied[positions], kind="stable")
+            positions = positions[order]
+            self._index[serial] = (supplied[positions], returned[positions], positions)
+
+    def lookup(self, serial_number, t_min, t_max):
+        """
+        Returns the fisher metadata rows for serial_number that were supplied
+        on or before t_min and returned after t_max, in spreadsheet order.
+        """
+        if serial_number not in self._index:
+            return self.fisher_metadata.iloc[[]]
+        supplied, returned, positions = self._index[serial_number]
+        candidates = np.searchsorted(supplied, np.datetime64(t_min, "ns"), side="right")
+        covering = returned[:candidates] >= np.datetime64(t_max, "ns")
+        return self.fisher_metadata.iloc[np.sort(positions[:candidates][covering])]
+
+
 class MangopareMetadataReader(object):
     """
     Read Mangopare fisher metadata in order to classify gear and
     to assign email addresses to Mangopare serial number.
+    If build_index, run() returns a FisherMetadataIndex of the metadata
+    instead of the dataframe itself.
+    If cache_dir is set, the parsed spreadsheet is kept there and only
+    downloaded and parsed again when it has changed.
     """
 
     def __init__(
@@ -271,6 +666,8 @@ class MangopareMetadataReader(object):
             "Bottom long line": "mobile",
             "Waka": "mobile",
         },
+        build_index=False,
+        cache_dir=None,
         logger=logging,
     ):
         self.metafile = metafile
@@ -278,30 +675,110 @@ class MangopareMetadataReader(object):
         self.token = token
         self.dateformat = dateformat
         self.gear_class = gear_class
+        self.build_index = build_index
+        self.cache_dir = cache_dir
         self.logger = logger
 
+    def _parse_fisher_metadata(self, source):
+        return pd.read_csv(
+            source,
+            on_bad_lines="skip",
+            parse_dates=["Date supplied", "Date returned"],
+            dayfirst=True,
+        )
+
+    def _is_remote(self):
+        return "raw.githubusercontent.com" in self.metafile or self.metafile.startswith(
+            ("http://", "https://")
+        )
+
+    def _download_fisher_metadata(self, headers={}):
+        github_session = requests.Session()
+        github_session.auth = (self.username, self.token)
+        return github_session.get(self.metafile, headers=headers)
+
+    def _cache_paths(self):
+        key = content_key(self.metafile)
+        return (
+            os.path.join(self.cache_dir, key + ".json"),
+            os.path.join(self.cache_dir, key + ".pkl"),
+        )
+
+    def _load_cached_fisher_metadata(self):
+        """
+        Returns the parsed metadata from cache_dir if the source has not
+        changed since it was cached, otherwise reads (or downloads) and
+        parses it and updates the cache.  Remote files are checked with a
+        conditional request using the cached ETag/Last-Modified headers,
+        local files by comparing their mtime and size.
+        """
+        validator_file, data_file = self._cache_paths()
+        cached = {}
+        if os.path.isfile(validator_file) and os.path.isfile(data_file):
+            with open(validator_file) as f:
+                cached = json.load(f)
+        if self._is_remote():
+            headers = {}
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+            try:
+                response = self._download_fisher_metadata(headers)
+                response.raise_for_status()
+            except Exception as exc:
+                if not cached:
+                    raise
+                self.logger.error(
+                    "Could not download fisher metadata from {}, using cached copy: {}".format(
+                        self.metafile, exc
+                    )
+                )
+                return pd.read_pickle(data_file)
+            if response.status_code == 304:
+                self.logger.info("Fisher metadata not modified, using cached copy.")
+                return pd.read_pickle(data_file)
+            validators = {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+            fisher_metadata = self._parse_fisher_metadata(
+                io.StringIO(response.content.decode("utf-8"))
+            )
+        else:
+            stat = os.stat(self.metafile)
+            validators = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+            if cached and all(cached.get(k) == v for k, v in validators.items()):
+                self.logger.info("Fisher metadata not modified, using cached copy.")
+                return pd.read_pickle(data_file)
+            fisher_metadata = self._parse_fisher_metadata(
+                io.open(self.metafile, errors="replace")
+            )
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # data first, so the validators never point at an older copy
+        fisher_metadata.to_pickle(data_file + ".tmp", compression=None)
+        os.replace(data_file + ".tmp", data_file)
+        with open(validator_file + ".tmp", "w") as f:
+            json.dump(validators, f)
+        os.replace(validator_file + ".tmp", validator_file)
+        return fisher_metadata
+
     def _load_fisher_metadata(self):
         """
         Read fisher metadata csv file provided by Zebra-Tech either from
         github or csv file path
         """
         try:
-            if "raw.githubusercontent.com" in self.metafile:
-                github_session = requests.Session()
-                github_session.auth = (self.username, self.token)
-                download = github_session.get(self.metafile).content
-                self.fisher_metadata = pd.read_csv(
-                    io.StringIO(download.decode("utf-8")),
-                    on_bad_lines="skip",
-                    parse_dates=["Date supplied", "Date returned"],
-                    date_parser=lambda x: pd.to_datetime(x, dayfirst=True),
+            if self.cache_dir:
+                self.fisher_metadata = self._load_cached_fisher_metadata()
+            elif self._is_remote():
+                download = self._download_fisher_metadata().content
+                self.fisher_metadata = self._parse_fisher_metadata(
+                    io.StringIO(download.decode("utf-8"))
                 )
             else:
-                self.fisher_metadata = pd.read_csv(
-                    io.open(self.metafile, errors="replace"),
-                    on_bad_lines='skip',
-                    parse_dates=["Date supplied", "Date returned"],
-                    date_parser=lambda x: pd.to_datetime(x, dayfirst=True),
+                self.fisher_metadata = self._parse_fisher_metadata(
+                    io.open(self.metafile, errors="replace")
                 )
         except Exception as exc:
             self.logger.error(
@@ -335,6 +812,8 @@ class MangopareMetadataReader(object):
         try:
             self._load_fisher_metadata()
             self._format_fisher_metadata()
+            if self.build_index:
+                return FisherMetadataIndex(self.fisher_metadata)
             return self.fisher_metadata
         except Exception as exc:
             self.logger.error(
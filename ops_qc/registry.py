@@ -0,0 +1,192 @@
+import inspect
+import logging
+import functools
+from importlib import metadata
+import ops_qc.qc_tests_df as qc_tests
+
+"""
+Registry of the qc tests QcApply can run.  The tests in qc_tests_df are
+always registered; other installed packages add tests with an entry point in
+the "ops_qc.qc_tests" group, naming either a module (all of its qc_test
+decorated functions are registered) or one qc_test decorated function
+(registered under the entry point name), i.e. in the package's setup.py:
+
+    entry_points={"ops_qc.qc_tests": [
+        "my_qc_tests = my_package.qc_tests",
+        "bottom_check = my_package.checks:bottom_check",
+    ]}
+
+A module can also define qc_attr_info, a dictionary of flag name:
+[long name, category] in the format of attribute_list.yml, for the flags of
+its tests, so they don't have to be added to the attribute file.
+"""
+
+ENTRY_POINT_GROUP = "ops_qc.qc_tests"
+
+
+class QcTestInfo(object):
+    """
+    A registered qc test and what it declares (see ops_qc.context.qc_test).
+    Inputs:
+        name -- name the test is run by in test lists
+        func -- the test, called with a QcContext
+        source -- module (or entry point) the test was registered from
+    """
+
+    def __init__(self, name, func, source=None):
+        self.name = name
+        self.func = func
+        self.source = source or func.__module__
+        self.requires = getattr(func, "requires", None)
+        self.cost = getattr(func, "cost", 1)
+
+    @property
+    def parameters(self):
+        """Dictionary of the test's keyword arguments: default values"""
+        signature = inspect.signature(inspect.unwrap(self.func))
+        return {
+            name: param.default
+            for name, param in list(signature.parameters.items())[1:]
+            if param.default is not inspect.Parameter.empty
+        }
+
+    @property
+    def flags(self):
+        """Flags the test makes with its default arguments, empty if undeclared"""
+        return list((self.requires or {}).get("produces", []))
+
+    def categories(self, qc_attr_info):
+        """Dictionary of the test's flags: category flag (or "None")"""
+        return {
+            flag: qc_attr_info[flag][1] for flag in self.flags if flag in qc_attr_info
+        }
+
+    def __repr__(self):
+        return f"QcTestInfo({self.name}, source={self.source}, cost={self.cost})"
+
+
+class QcRegistry(object):
+    """
+    Qc tests by name, with their declarations and cost hints.
+    Inputs:
+        modules -- modules (or classes) whose qc_test decorated functions are
+            registered
+        entry_points -- also register the tests of installed packages'
+            ENTRY_POINT_GROUP entry points
+
+    Usage:
+        registry = default_registry()
+        registry.validate(test_list, qc_attr_info)  # ValueError if not runnable
+        registry.get("spike").func(qc)
+    """
+
+    def __init__(self, modules=[qc_tests], entry_points=False, logger=logging):
+        self.logger = logger
+        self.tests = {}
+        self.qc_attr_info = {}
+        for module in modules:
+            self.register_module(module)
+        if entry_points:
+            self.load_entry_points()
+
+    def register(self, func, name=None, source=None):
+        """
+        Registers func as qc test name (default the function name).  A name
+        already registered to another function raises ValueError.
+        """
+        name = name or func.__name__
+        registered = self.tests.get(name)
+        if registered is not None:
+            if registered.func is func:
+                return registered
+            raise ValueError(
+                f"qc test {name} from {source or func.__module__} is already registered from {registered.source}")
+        self.tests[name] = QcTestInfo(name, func, source)
+        return self.tests[name]
+
+    def register_module(self, module, source=None):
+        """Registers the qc_test decorated functions of module and its qc_attr_info"""
+        source = source or getattr(module, "__name__", None)
+        for name, func in vars(module).items():
+            if not name.startswith("_") and callable(func) and hasattr(func, "requires"):
+                self.register(func, name, source)
+        for flag, attrs in getattr(module, "qc_attr_info", {}).items():
+            self.qc_attr_info.setdefault(flag, attrs)
+
+    def load_entry_points(self):
+        """
+        Registers the tests of ENTRY_POINT_GROUP entry points.  Entry points
+        that can't be loaded are logged and skipped, so the tests in them are
+        unknown to validate.
+        """
+        entry_points = metadata.entry_points()
+        if hasattr(entry_points, "select"):
+            entry_points = entry_points.select(group=ENTRY_POINT_GROUP)
+        else:
+            entry_points = entry_points.get(ENTRY_POINT_GROUP, [])
+        for entry_point in entry_points:
+            try:
+                loaded = entry_point.load()
+                if inspect.ismodule(loaded):
+                    self.register_module(loaded, source=entry_point.value)
+                else:
+                    self.register(loaded, entry_point.name, source=entry_point.value)
+            except Exception as exc:
+                self.logger.error(
+                    f"Could not register qc tests from entry point {entry_point.name}: {exc}")
+
+    def __contains__(self, name):
+        return name in self.tests
+
+    def names(self):
+        return sorted(self.tests)
+
+    def get(self, name):
+        """QcTestInfo of test name, KeyError if it isn't registered"""
+        try:
+            return self.tests[name]
+        except KeyError:
+            raise KeyError(f"{name} is not a registered qc test")
+
+    def requires(self, name):
+        """Declarations of test name, None if it has none or isn't registered"""
+        info = self.tests.get(name)
+        return info.requires if info else None
+
+    def cost(self, name):
+        """Cost hint of test name, relative run time per observation"""
+        info = self.tests.get(name)
+        return info.cost if info else 1
+
+    def attr_info(self, qc_attr_info=None):
+        """
+        qc_attr_info of the registered modules updated with qc_attr_info (i.e.
+        from the attribute file, which takes precedence)
+        """
+        return dict(self.qc_attr_info, **(qc_attr_info or {}))
+
+    def validate(self, test_list, qc_attr_info=None):
+        """
+        Checks that every test in test_list is registered and every flag they
+        declare has attributes, in qc_attr_info or the registered modules.
+        Raises ValueError otherwise, returns the QcTestInfo of each test.
+        """
+        test_list = list(dict.fromkeys(test_list or []))
+        unknown = [name for name in test_list if name not in self.tests]
+        if unknown:
+            raise ValueError(
+                f"Unknown qc tests {unknown}, registered tests are {self.names()}")
+        qc_attr_info = self.attr_info(qc_attr_info)
+        missing = [
+            f"{name}: {flag}" for name in test_list
+            for flag in self.tests[name].flags if flag not in qc_attr_info
+        ]
+        if missing:
+            raise ValueError(f"qc flags without attributes in qc_attr_info: {missing}")
+        return [self.tests[name] for name in test_list]
+
+
+@functools.lru_cache(maxsize=None)
+def default_registry():
+    """The tests of qc_tests_df and of installed packages' entry points, made once"""
+    return QcRegistry([qc_tests], entry_points=True)
@@ -0,0 +1,241 @@
+import heapq
+import logging
+from ops_qc.registry import default_registry
+
+"""
+Dependency aware ordering of qc tests.  Each qc test declares the dataset
+columns, flags and dataset attributes it reads and the flags it makes (see
+ops_qc.context.qc_test), and processing steps that have to happen between
+tests (i.e. the wrapper's position calculations) are declared the same way
+with QcStep.  QcScheduler orders the tests and steps so each one runs after
+whatever makes its inputs, so QcApply can run all of them in one pass, and
+groups tests that don't depend on each other so they can run at the same time.
+"""
+
+
+class StepError(Exception):
+    """A processing step failed, which fails the whole file (unlike a qc test)"""
+
+
+class QcStep(object):
+    """
+    Processing step run between qc tests by QcApply.  Before the step runs,
+    the flags made so far are merged into the dataset (including QC_FLAG and
+    the category flags, i.e. LOCATION_QC).
+    Inputs:
+        func -- function taking the dataset and returning the updated dataset
+        columns -- dataset variables the step reads
+        flags -- flags or flag categories the step reads
+        attrs -- dataset attributes the step reads
+        produces -- dataset attributes the step adds
+        modifies -- dataset variables the step changes, tests that read them
+            run before the step unless they depend on it
+    """
+
+    def __init__(self, func, columns=None, flags=None, attrs=None, produces=None, modifies=None):
+        self.func = func
+        self.requires = {
+            "columns": list(columns or []),
+            "flags": list(flags or []),
+            "attrs": list(attrs or []),
+            "produces": list(produces or []),
+            "modifies": list(modifies or []),
+        }
+
+    def __call__(self, ds):
+        return self.func(ds)
+
+
+class _Node(object):
+    """A test or step, with its reads and writes as "kind:name" strings"""
+
+    def __init__(self, name, index, requires, step=False):
+        self.name = name
+        self.index = index
+        self.step = step
+        self.declared = requires is not None
+        requires = requires or {}
+        self.reads = set(
+            [f"column:{name}" for name in requires.get("columns", [])]
+            + [f"flag:{name}" for name in requires.get("flags", [])]
+            + [f"attr:{name}" for name in requires.get("attrs", [])]
+        )
+        kind = "attr" if step else "flag"
+        self.produces = set(f"{kind}:{name}" for name in requires.get("produces", []))
+        self.modifies = set(f"column:{name}" for name in requires.get("modifies", []))
+        self.after = set(requires.get("after", []))
+
+
+class QcScheduler(object):
+    """
+    Orders qc tests and processing steps by what they read and produce.
+    Inputs:
+        test_list -- names of registered qc tests, repeated names are run once
+        steps -- dictionary of name: QcStep
+        categories -- dictionary of flag name: category flag name (the
+            qc_attr_info of the attribute file), so that steps reading a
+            category flag run after the tests making flags in that category
+        requires -- dictionary of test name: declarations added to those of the
+            test (see ops_qc.context.qc_test), i.e. {"after": ["positions"]}
+        registry -- ops_qc.registry.QcRegistry the qc tests are in, default
+            ops_qc.registry.default_registry()
+
+    Tests run after the tests and steps making what they read and before steps
+    modifying what they read, otherwise in test_list order with the steps as
+    late as possible.  Tests without declarations run in their test_list
+    position, after every test before them and before every test after them.
+
+    Usage:
+        scheduler = QcScheduler(test_list, steps={"positions": QcStep(...)})
+        scheduler.order()  # names in the order to run them
+        scheduler.plan()   # the same, grouped into stages of independent tests
+    """
+
+    def __init__(
+        self,
+        test_list,
+        steps=None,
+        categories=None,
+        requires=None,
+        registry=None,
+        logger=logging,
+    ):
+        self.test_list = list(dict.fromkeys(test_list or []))
+        self.steps = steps or {}
+        self.categories = categories or {}
+        self.requires = requires or {}
+        self.registry = registry or default_registry()
+        self.logger = logger
+        self.nodes = self._nodes()
+        self.after = self._edges()
+
+    def test_requires(self, name):
+        """Declarations of test name (with those from requires), None if it has none"""
+        declared = self.registry.requires(name)
+        extra = self.requires.get(name)
+        if declared is None and extra is None:
+            return None
+        requires = dict(declared or {})
+        for key, value in (extra or {}).items():
+            requires[key] = list(requires.get(key, [])) + list(value)
+        return requires
+
+    def cost(self, name):
+        """Cost hint of test name (see ops_qc.context.qc_test), 0 for steps"""
+        return 0 if name in self.steps else self.registry.cost(name)
+
+    def _nodes(self):
+        nodes = {}
+        for index, name in enumerate(self.test_list):
+            nodes[name] = _Node(name, index, self.test_requires(name))
+        for index, (name, step) in enumerate(self.steps.items(), start=len(nodes)):
+            if name in nodes:
+                raise ValueError(f"Step {name} has the same name as a qc test")
+            nodes[name] = _Node(name, index, step.requires, step=True)
+        return nodes
+
+    def _category_of(self, resource):
+        kind, name = resource.split(":", 1)
+        if kind != "flag":
+            return None
+        category = self.categories.get(name)
+        if isinstance(category, (list, tuple)):
+            category = category[1]
+        return f"flag:{category}" if category and category != "None" else None
+
+    def _feeds(self, node, other):
+        """
+        Whether other should run before node, unless that would make a cycle:
+        other makes flags in a category node reads, or node modifies columns
+        other reads
+        """
+        if not other.declared and not other.step:
+            return node.step
+        made = set(self._category_of(resource) for resource in other.produces)
+        if node.reads & made:
+            return True
+        return bool(node.modifies & other.reads)
+
+    def _edges(self):
+        """name: set of names that have to run before it"""
+        nodes = list(self.nodes.values())
+        after = {node.name: set() for node in nodes}
+        for node in nodes:
+            for name in node.after:
+                if name not in self.nodes:
+                    raise ValueError(f"{node.name} runs after {name}, which is not scheduled")
+                after[node.name].add(name)
+            if not node.declared and not node.step:
+                for other in nodes:
+                    if other.step:
+                        continue
+                    if other.index < node.index:
+                        after[node.name].add(other.name)
+                    elif other.index > node.index:
+                        after[other.name].add(node.name)
+                continue
+            for other in nodes:
+                if other is not node and node.reads & other.produces:
+                    after[node.name].add(other.name)
+        self._check_cycles(after)
+        for node in nodes:
+            for other in nodes:
+                if other is node or other.name in after[node.name]:
+                    continue
+                if self._feeds(node, other) and not self._depends(after, other.name, node.name):
+                    after[node.name].add(other.name)
+        return after
+
+    def _depends(self, after, name, other):
+        """Whether name has to run after other"""
+        seen, todo = set(), [name]
+        while todo:
+            for before in after[todo.pop()]:
+                if before == other:
+                    return True
+                if before not in seen:
+                    seen.add(before)
+                    todo.append(before)
+        return False
+
+    def _check_cycles(self, after):
+        cycle = [name for name in after if self._depends(after, name, name)]
+        if cycle:
+            raise ValueError(f"qc tests and steps depend on each other: {cycle}")
+
+    def order(self):
+        """Test and step names in the order to run them"""
+        waiting = {name: set(before) for name, before in self.after.items()}
+        ready = [(self.nodes[name].index, name) for name, before in waiting.items() if not before]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            _, name = heapq.heappop(ready)
+            order.append(name)
+            for other, before in waiting.items():
+                if name in before:
+                    before.discard(name)
+                    if not before:
+                        heapq.heappush(ready, (self.nodes[other].index, other))
+        return order
+
+    def plan(self):
+        """
+        order() grouped into stages: consecutive declared tests that don't
+        depend on each other share a stage, steps and tests without
+        declarations are stages of their own
+        """
+        stages = []
+        for name in self.order():
+            node = self.nodes[name]
+            parallel = node.declared and not node.step
+            if (
+                parallel
+                and stages
+                and stages[-1][0][1]
+                and not any(self._depends(self.after, name, other) for other, _ in stages[-1])
+            ):
+                stages[-1].append((name, parallel))
+            else:
+                stages.append([(name, parallel)])
+        return [[name for name, _ in stage] for stage in stages]
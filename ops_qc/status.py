@@ -0,0 +1,240 @@
+import os
+import json
+import time
+from contextlib import contextmanager, nullcontext
+import numpy as np
+from ops_qc.utils import LazyModule
+
+pd = LazyModule("pandas")
+
+
+class StatusRecorder(object):
+    """
+    Append-only buffer for the per-file status rows written to status_file_XXXX.csv.
+    Rows are kept as dictionaries and only turned into a dataframe when needed,
+    so recording a file's status costs the same however many files came before.
+    Inputs:
+        columns -- list of status column names, in the order they are written
+
+    Rows can be written to the status file in batches with flush(), only the
+    rows not yet written are appended each time.
+    """
+
+    def __init__(self, columns):
+        self.columns = list(columns)
+        self.rows = []
+        self._flushed = 0
+        self._df = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def pending(self):
+        """Number of rows not yet written by flush()"""
+        return len(self.rows) - self._flushed
+
+    def append(self, row):
+        self.rows.append(row)
+        self._df = None
+
+    def extend(self, rows):
+        self.rows.extend(rows)
+        self._df = None
+
+    def update(self, filenames, values):
+        """
+        Updates the rows of filenames with the values dictionary, i.e. when a
+        file turns out not to be saved after its status was recorded.  Returns
+        False if some of those rows were already written by flush().
+        """
+        for row in self.rows:
+            if row.get("filename") in filenames:
+                row.update(values)
+        self._df = None
+        return all(
+            row.get("filename") not in filenames for row in self.rows[: self._flushed]
+        )
+
+    def _rows_to_dataframe(self, rows):
+        # object dtype keeps integer counts as integers in the csv even when
+        # some rows are missing them
+        return pd.DataFrame(rows, columns=self.columns, dtype=object)
+
+    def to_dataframe(self):
+        """Returns all recorded rows (flushed or not) as a dataframe"""
+        if self._df is None:
+            self._df = self._rows_to_dataframe(self.rows)
+        return self._df
+
+    def flush(self, filename):
+        """
+        Appends the rows not yet written to filename, writing the header
+        only if the file does not exist yet.
+        """
+        if not self.pending:
+            return
+        rows = self.rows[self._flushed :]
+        self._rows_to_dataframe(rows).to_csv(
+            filename, mode="a", header=not os.path.isfile(filename), index=False
+        )
+        self._flushed = len(self.rows)
+
+
+class StageTimer(object):
+    """
+    Accumulates wall clock time per processing stage for the current file.
+    Inputs:
+        enabled -- if False, stage() does nothing so timing costs nothing when off
+
+    Usage:
+        with timer.stage("read"):
+            ...
+    Times (in seconds) are kept in timings as time_<stage>, matching the extra
+    status file columns, until reset() is called for the next file.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.timings = {}
+
+    def reset(self):
+        self.timings = {}
+
+    def stage(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._timed(name)
+
+    @contextmanager
+    def _timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            key = f"time_{name}"
+            self.timings[key] = self.timings.get(key, 0) + time.perf_counter() - start
+
+    def add(self, name, seconds):
+        """Adds an externally measured time, i.e. of a single qc test"""
+        key = f"time_{name}"
+        self.timings[key] = self.timings.get(key, 0) + seconds
+
+
+def timing_summary(status_data, columns):
+    """
+    Summarises the time_* status columns of a run.  Returns a dataframe with
+    one row per stage and the number of files timed, total, p50 and p95 time
+    in seconds.  Stages never timed (i.e. a test that was not run) are left out.
+    """
+    summary = {}
+    for column in columns:
+        if column not in status_data:
+            continue
+        times = pd.to_numeric(status_data[column], errors="coerce").dropna()
+        if times.empty:
+            continue
+        summary[column[len("time_"):]] = {
+            "files": len(times),
+            "total": times.sum(),
+            "p50": np.percentile(times, 50),
+            "p95": np.percentile(times, 95),
+        }
+    return pd.DataFrame.from_dict(
+        summary, orient="index", columns=["files", "total", "p50", "p95"])
+
+
+def cache_report(status_data, columns):
+    """
+    Summarises the cache_* status columns of a run (qc test result cache
+    "hit" or "miss").  Returns a dataframe with one row per test and the
+    number of hits and misses and the hit rate.  Tests never cached are left out.
+    """
+    report = {}
+    for column in columns:
+        if column not in status_data:
+            continue
+        results = status_data[column].dropna()
+        if results.empty:
+            continue
+        hits = int((results == "hit").sum())
+        misses = int((results == "miss").sum())
+        report[column[len("cache_"):]] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses else np.nan,
+        }
+    return pd.DataFrame.from_dict(
+        report, orient="index", columns=["hits", "misses", "hit_rate"])
+
+
+class QcJournal(object):
+    """
+    Per-file completion journal for resumable QcWrapper runs.  Each file's
+    outcome is appended to a json-lines file as soon as it finishes, so a run
+    that stops part way (i.e. a scheduler time limit) can be restarted and
+    skip the files already done.
+    Inputs:
+        filename -- journal file, created if it does not exist
+        config_key -- hash of the qc configuration.  Entries recorded with a
+            different configuration are not reused.
+
+    Each entry holds the input file, a hash of its contents, the files saved
+    from it and its status row (which includes any failure mode).
+    """
+
+    def __init__(self, filename, config_key):
+        self.filename = filename
+        self.config_key = config_key
+        self.entries = self._load()
+
+    def _load(self):
+        entries = {}
+        if not os.path.isfile(self.filename):
+            return entries
+        with open(self.filename, "r+b") as f:
+            content = f.read()
+            if content and not content.endswith(b"\n"):
+                # last line of a run that was killed while writing, removed so
+                # the next entry isn't appended to it
+                content = content[: content.rfind(b"\n") + 1]
+                f.truncate(len(content))
+        for line in content.decode().splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if entry.get("config_key") == self.config_key:
+                entries[entry["filename"]] = entry
+        return entries
+
+    def completed(self, filename, input_hash):
+        """
+        Returns the journal entry for filename if it was completed with the
+        same contents and configuration, otherwise None
+        """
+        entry = self.entries.get(filename)
+        if entry and input_hash and entry["input_hash"] == input_hash:
+            return entry
+        return None
+
+    def record(self, filename, input_hash, saved_files, status_rows):
+        entry = {
+            "filename": filename,
+            "input_hash": input_hash,
+            "config_key": self.config_key,
+            "saved_files": list(saved_files),
+            "status_rows": status_rows,
+        }
+        with open(self.filename, "a") as f:
+            f.write(json.dumps(entry, default=_json_default) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.entries[filename] = entry
+
+
+def _json_default(value):
+    # numpy scalars in status rows, i.e. qc flag counts
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
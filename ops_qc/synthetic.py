@@ -0,0 +1,266 @@
+import os
+import logging
+import numpy as np
+import pandas as pd
+import datetime as dt
+
+"""
+Synthetic Mangōpare/Moana data for load testing.  Writes csv files in the
+sensor's download format together with a matching fisher metadata csv, so
+QcWrapper can run end to end on any number of files without network access.
+"""
+
+# offshore positions around New Zealand that stationary and mobile gear start from
+BASE_POSITIONS = [
+    (-35.1452, 174.3387),
+    (-39.6000, 177.6000),
+    (-44.5000, 172.5000),
+    (-41.6000, 174.6000),
+    (-38.0000, 174.3000),
+]
+# Zebra-Tech in Nelson, where sensors are tested before being supplied
+REF_POSITION = (-41.25707, 173.28393)
+# (moana firmware, deck unit firmware), firmware < 2 has the reset and
+# timestamp overflow issues checked by the qc tests
+FIRMWARE = [("MOANA-1.21", "4.03"), ("MOANA-2.04", "4.10"), ("MOANA-2.10", "4.12")]
+GEAR = {"Potting": "stationary", "Bottom trawl": "mobile", "Long lining": "stationary", "Trawling": "mobile"}
+RESET_VALUE = 44.444
+METADATA_COLUMNS = [
+    "Fishing method", "Fisherman name", "Vessel name", "Vessel id",
+    "Fisherman contact phone", "Contact email", "Mangopare serial number",
+    "Deck unit serial number", "Date supplied", "Date returned",
+    "Active/Terminated", "Comments", "Email Status", "Email Frequency",
+    "Programme", "Public", "WIGOS ID", "Publication Date",
+]
+
+
+class SyntheticMangopare(object):
+    """
+    Writes synthetic Mangōpare csv files and their fisher metadata.
+    Inputs:
+        out_dir -- directory to write the csv files and metadata file in, created if needed
+        nfiles -- number of csv files (deployments)
+        nsensors -- number of sensors the files are spread over, each one a row in the
+            fisher metadata
+        hauls -- (min, max) number of hauls (profiles) per file
+        haul_minutes -- (min, max) minutes each haul is at the bottom
+        max_depth -- (min, max) bottom depth in dBar
+        sample_seconds -- seconds between observations
+        start_date -- datetime of the first deployment
+        anomaly_rate -- probability of each anomaly (spike, stuck value, timing gap,
+            reset rows, test at the Nelson reference location) in a file
+        seed -- random seed, the same seed gives the same files
+        metafile -- name of the fisher metadata csv written in out_dir
+
+    Returns (from run):
+        list of csv files written, fisher metadata filename
+    """
+
+    def __init__(
+        self,
+        out_dir,
+        nfiles=10,
+        nsensors=None,
+        hauls=(1, 4),
+        haul_minutes=(10, 60),
+        max_depth=(20, 300),
+        sample_seconds=4,
+        start_date=dt.datetime(2021, 6, 1),
+        anomaly_rate=0.2,
+        seed=0,
+        metafile="synthetic_fisherman_database.csv",
+        logger=logging,
+    ):
+        self.out_dir = out_dir
+        self.nfiles = nfiles
+        self.nsensors = nsensors or max(1, nfiles // 10)
+        self.hauls = hauls
+        self.haul_minutes = haul_minutes
+        self.max_depth = max_depth
+        self.sample_seconds = sample_seconds
+        self.start_date = start_date
+        self.anomaly_rate = anomaly_rate
+        self.metafile = metafile
+        self.logger = logger
+        self.rng = np.random.default_rng(seed)
+
+    def _sensors(self):
+        """One row per sensor: serial number, deck unit, gear, firmware, base position"""
+        sensors = []
+        methods = list(GEAR)
+        for i in range(self.nsensors):
+            sensors.append({
+                "serial": 100 + i,
+                "deck_unit": 5000 + i,
+                "method": methods[i % len(methods)],
+                "firmware": FIRMWARE[i % len(FIRMWARE)],
+                "position": BASE_POSITIONS[i % len(BASE_POSITIONS)],
+            })
+        return sensors
+
+    def _haul(self, depth, minutes):
+        """Pressure for one haul: descent, time at the bottom, ascent"""
+        rate = self.rng.uniform(0.5, 1.5)  # dBar per second
+        nprofile = max(2, int(depth / rate / self.sample_seconds))
+        nbottom = max(1, int(minutes * 60 / self.sample_seconds))
+        descent = np.linspace(1, depth, nprofile)
+        bottom = depth + self.rng.normal(0, 0.5, nbottom)
+        return np.concatenate([descent, bottom, descent[::-1]])
+
+    def _temperature(self, pressure, surface_temp):
+        """Temperature with a thermocline around 50 dBar and sensor noise"""
+        temp = surface_temp - 4 / (1 + np.exp(-(pressure - 50) / 15))
+        return temp + self.rng.normal(0, 0.01, len(pressure))
+
+    def _deployment(self, sensor, start):
+        """Data for one file as a dataframe and the time of the download"""
+        gear = GEAR[sensor["method"]]
+        depth = self.rng.uniform(*self.max_depth)
+        nhauls = self.rng.integers(self.hauls[0], self.hauls[1] + 1)
+        pressure, times = [], []
+        t = start
+        for _ in range(nhauls):
+            haul = self._haul(depth * self.rng.uniform(0.9, 1.1), self.rng.uniform(*self.haul_minutes))
+            pressure.append(haul)
+            times.append(t + np.arange(len(haul)) * np.timedelta64(self.sample_seconds, "s"))
+            # out of the water between hauls
+            t = times[-1][-1] + np.timedelta64(int(self.rng.uniform(10, 120)), "m")
+        pressure = np.concatenate(pressure)
+        times = np.concatenate(times)
+        nobs = len(pressure)
+
+        lat0, lon0 = sensor["position"]
+        if self._anomaly():
+            lat0, lon0 = REF_POSITION
+        lat0 += self.rng.uniform(-0.05, 0.05)
+        lon0 += self.rng.uniform(-0.05, 0.05)
+        if gear == "mobile":
+            # towed at about 3 knots on a random heading
+            heading = self.rng.uniform(0, 2 * np.pi)
+            km = np.arange(nobs) * self.sample_seconds * 5.56 / 3600
+            lat = lat0 + km * np.cos(heading) / 111.2
+            lon = lon0 + km * np.sin(heading) / (111.2 * np.cos(np.radians(lat0)))
+        else:
+            lat = lat0 + self.rng.normal(0, 0.00003, nobs)
+            lon = lon0 + self.rng.normal(0, 0.00003, nobs)
+
+        temp = self._temperature(pressure, self.rng.uniform(10, 20))
+        df = pd.DataFrame({"time": times, "lat": lat, "lon": lon, "pressure": pressure, "temp": temp})
+        df = self._add_anomalies(df)
+        download = df["time"].iloc[-1] + np.timedelta64(int(self.rng.uniform(5, 60)), "m")
+        return df, pd.Timestamp(download).to_pydatetime()
+
+    def _anomaly(self):
+        return self.rng.random() < self.anomaly_rate
+
+    def _add_anomalies(self, df):
+        nobs = len(df)
+        if self._anomaly():
+            # temperature spike
+            i = self.rng.integers(1, nobs - 1)
+            df.loc[i, "temp"] += self.rng.choice([-1, 1]) * self.rng.uniform(3, 8)
+        if self._anomaly() and nobs > 40:
+            # stuck temperature sensor
+            i = self.rng.integers(0, nobs - 30)
+            df.loc[i:i + 29, "temp"] = df.loc[i, "temp"]
+        if self._anomaly():
+            # sensor reset, the pressure column holds the reset code
+            rows = df.iloc[[self.rng.integers(0, nobs - 1)]].copy()
+            rows["time"] += np.timedelta64(1, "s")
+            rows["temp"] = RESET_VALUE
+            rows["pressure"] = self.rng.choice([2, 4, 8])
+            df = pd.concat([df, rows]).drop_duplicates("time", keep="last")
+            df = df.sort_values("time", kind="stable")
+        if self._anomaly():
+            # a few splashes long before the deployment
+            first = df.iloc[0]
+            splash = pd.DataFrame({
+                "time": first["time"] - np.timedelta64(3, "h") + np.arange(3) * np.timedelta64(self.sample_seconds, "s"),
+                "lat": first["lat"], "lon": first["lon"], "pressure": 0.5, "temp": first["temp"] + 2,
+            })
+            df = pd.concat([splash, df])
+        return df.reset_index(drop=True)
+
+    def _header(self, sensor, df, download):
+        moana_firmware, deck_firmware = sensor["firmware"]
+        reset_codes = "0x200204" if (df["temp"] == RESET_VALUE).any() else "0x000000"
+        lines = [
+            ("Deck unit serial number", sensor["deck_unit"]),
+            ("Deck unit firmware version", deck_firmware),
+            ("Deck unit battery voltage", f"{self.rng.uniform(3.6, 4.2):.1f}"),
+            ("Deck unit battery percent", self.rng.integers(2, 100)),
+            ("Cellular upload position", f"{df['lat'].iloc[-1]:.6f},{df['lon'].iloc[-1]:.6f}"),
+            ("Cellular signal strength", self.rng.integers(5, 31)),
+            ("Download Time", download.strftime("%d/%m/%Y %H:%M:%S")),
+            ("Moana Serial Number", sensor["serial"]),
+            ("Moana Firmware", moana_firmware),
+            ("Protocol Version", 2),
+            ("Moana calibration date", (self.start_date - dt.timedelta(days=60)).strftime("%d/%m/%Y")),
+            ("Reset Codes", f" {reset_codes}"),
+            ("Moana Battery (V)", f"{self.rng.uniform(3.4, 3.7):.2f}"),
+            ("Max Lifetime Depth (dBar)", f"{df['pressure'].max() + self.rng.uniform(0, 50):.1f}"),
+            ("Baseline(mBar)", self.rng.integers(990, 1030)),
+        ]
+        # the first line of a download starts with a space
+        return " " + "".join(f"{name},{value}\n" for name, value in lines)
+
+    def _write_csv(self, filename, header, df):
+        data = pd.DataFrame({
+            "DateTime (UTC)": df["time"].dt.strftime("%Y%m%dT%H%M%S"),
+            "Lat": df["lat"].map("{:.6f}".format),
+            "Lon": df["lon"].map("{:+.6f}".format),
+            "Depth (dBar)": df["pressure"].map("{:.1f}".format),
+            "Temperature C": df["temp"].map("{:.3f}".format),
+        })
+        with open(filename, "w") as f:
+            f.write(header)
+            data.to_csv(f, index=False)
+
+    def _write_metadata(self, sensors):
+        rows = []
+        for sensor in sensors:
+            rows.append({
+                "Fishing method": sensor["method"],
+                "Fisherman name": f"Fisher {sensor['serial']}",
+                "Vessel name": f"Vessel {sensor['serial']}",
+                "Vessel id": sensor["serial"],
+                "Fisherman contact phone": "0000000",
+                "Contact email": f"fisher{sensor['serial']}@example.com",
+                "Mangopare serial number": sensor["serial"],
+                "Deck unit serial number": sensor["deck_unit"],
+                "Date supplied": (self.start_date - dt.timedelta(days=7)).strftime("%d/%m/%Y"),
+                "Date returned": "",
+                "Active/Terminated": "Active",
+                "Comments": "Synthetic",
+                "Email Status": "no",
+                "Email Frequency": "daily",
+                "Programme": "Moana",
+                "Public": "True",
+                "WIGOS ID": "NA",
+                "Publication Date": "1/01/2021",
+            })
+        metafile = os.path.join(self.out_dir, self.metafile)
+        pd.DataFrame(rows, columns=METADATA_COLUMNS).to_csv(metafile)
+        return metafile
+
+    def run(self):
+        os.makedirs(self.out_dir, exist_ok=True)
+        sensors = self._sensors()
+        downloads = {sensor["serial"]: 0 for sensor in sensors}
+        filelist = []
+        start = np.datetime64(self.start_date, "s")
+        for i in range(self.nfiles):
+            sensor = sensors[i % len(sensors)]
+            df, download = self._deployment(sensor, start)
+            downloads[sensor["serial"]] += 1
+            filename = os.path.join(
+                self.out_dir,
+                f"MOANA_{sensor['serial']:04d}_{downloads[sensor['serial']]}_{download:%y%m%d%H%M%S}.csv",
+            )
+            self._write_csv(filename, self._header(sensor, df, download), df)
+            filelist.append(filename)
+            # deployments start a few hours apart
+            start = start + np.timedelta64(int(self.rng.uniform(1, 6) * 3600), "s")
+        metafile = self._write_metadata(sensors)
+        self.logger.info(f"Wrote {len(filelist)} synthetic files and {metafile}")
+        return filelist, metafile
@@ -0,0 +1,53 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+from ops_qc.benchmark import Benchmark, compare, ENTRY_POINTS
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.out_file = os.path.join(self.tmpdir, 'benchmark.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_run(self):
+        results = Benchmark(
+            out_file=self.out_file,
+            rows=[500],
+            files=[2],
+            file_rows=500,
+            repeat=1,
+            test_list=['spike', 'timing_gap'],
+            components=['reader', 'qc_tests', 'wrapper', 'publish']).run()
+        with open(self.out_file) as f:
+            self.assertEqual(json.load(f), results)
+        names = [(r['component'], r['name']) for r in results['results']]
+        self.assertEqual(names, [
+            ('reader', 'MangopareStandardReader.run'),
+            ('qc_tests', 'spike'),
+            ('qc_tests', 'timing_gap'),
+            ('wrapper', 'QcWrapper.run'),
+            ('publish', 'publish.Wrapper.run')])
+        for result in results['results']:
+            assert result['error'] is None
+            assert result['best_s'] > 0
+        wrapper = results['results'][3]
+        self.assertEqual((wrapper['files'], wrapper['rows']), (2, 1000))
+        df = compare(self.out_file, self.out_file)
+        assert len(df) == 5
+        assert (df['ratio'] == 1).all() and not df['regression'].any()
+
+    def test_startup(self):
+        results = Benchmark(
+            out_file=self.out_file, rows=[], files=[], repeat=1, components=['startup']).run()
+        self.assertEqual([r['name'] for r in results['results']], ENTRY_POINTS)
+        for result in results['results']:
+            assert result['error'] is None
+            # heavy dependencies are only imported when used
+            self.assertEqual(result['modules'], [])
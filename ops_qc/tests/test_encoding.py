@@ -0,0 +1,58 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from ops_qc.encoding import netcdf_encoding
+
+
+class TestNetcdfEncoding(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        times = pd.date_range('2021-06-24', periods=50, freq='min')
+        self.ds = xr.Dataset(
+            {'TEMPERATURE': ('DATETIME', np.linspace(10.5, 12.25, 50)),
+             'PRESSURE': ('DATETIME', np.r_[np.nan, np.linspace(0, 200.5, 49)]),
+             'QC_FLAG': ('DATETIME', np.tile([1, 2, 3, 4, 9], 10)),
+             'TEMPERATURE_QC': ('DATETIME', np.r_[np.nan, np.ones(49)]),
+             'flag_spike_temp': ('DATETIME', np.ones(50, dtype=np.int64)),
+             'PHASE': ('DATETIME', np.array([b'P']*50))},
+            coords={'DATETIME': times,
+                    'LATITUDE': ('DATETIME', np.full(50, -35.1459655)),
+                    'LONGITUDE': ('DATETIME', np.full(50, 174.3383915))})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _round_trip(self, preset):
+        savefile = os.path.join(self.tmpdir, 'test.nc')
+        self.ds.to_netcdf(savefile, format='NETCDF4', encoding=netcdf_encoding(self.ds, preset))
+        with xr.open_dataset(savefile) as ds:
+            return ds.load()
+
+    def test_default(self):
+        assert netcdf_encoding(self.ds) == {}
+        xr.testing.assert_identical(self._round_trip('default'), self.ds)
+
+    def test_compact_round_trip(self):
+        ds = self._round_trip('compact')
+        assert ds['QC_FLAG'].dtype == np.uint8
+        assert ds['flag_spike_temp'].dtype == np.uint8
+        assert ds['QC_FLAG'].encoding['zlib']
+        np.testing.assert_array_equal(ds['QC_FLAG'], self.ds['QC_FLAG'])
+        np.testing.assert_array_equal(ds['TEMPERATURE_QC'], self.ds['TEMPERATURE_QC'])
+        np.testing.assert_allclose(ds['TEMPERATURE'], self.ds['TEMPERATURE'], rtol=1e-6)
+        np.testing.assert_allclose(ds['PRESSURE'], self.ds['PRESSURE'], rtol=1e-6)
+        # positions and times are not made smaller
+        np.testing.assert_array_equal(ds['LATITUDE'], self.ds['LATITUDE'])
+        np.testing.assert_array_equal(ds['DATETIME'], self.ds['DATETIME'])
+
+    def test_out_of_range_flags(self):
+        self.ds['QC_FLAG'][0] = 300
+        encoding = netcdf_encoding(self.ds, {'flag_dtype': 'uint8'})
+        assert 'QC_FLAG' not in encoding
+        assert encoding['flag_spike_temp']['dtype'] == np.uint8
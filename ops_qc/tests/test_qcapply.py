@@ -1,11 +1,16 @@
 import unittest
 import os
+import tempfile
+import shutil
+import numpy as np
 import pandas as pd
 import xarray as xr
 
 from ops_qc.readers import MangopareStandardReader
 from ops_qc.readers import MangopareMetadataReader
 from ops_qc.apply_qc import QcApply
+from ops_qc.context import FlagMatrix
+from ops_qc.registry import QcRegistry
 from ops_qc.preprocess import PreProcessMangopare
 
 #ds = MagicMock()
@@ -23,3 +28,99 @@ class TestApplyQC(unittest.TestCase):
     def test_applyqc(self):
         ds = QcApply(self.ds,self.test_list,save_flags=False,attr_file=self.attr_file).run()
         assert isinstance(ds,xr.core.dataset.Dataset)
+
+    def test_no_dataframe(self):
+        self.ds.load()
+        qc = QcApply(self.ds, self.test_list, save_flags=True, attr_file=self.attr_file)
+        assert np.shares_memory(qc.column('TEMPERATURE'), self.ds['TEMPERATURE'].values)
+        ds = qc.run()
+        # none of the tests needed the dataframe versions
+        assert qc._df is None and qc._qcdf is None
+        assert ds['flag_spike_temp'].dtype == np.uint8
+        self.assertEqual(int(ds['QC_FLAG'].max()), max(int(f.max()) for f in qc.flags.values()))
+
+    def test_dataframe_test(self):
+        def legacy_test(self, flag_name='flag_legacy'):
+            self.qcdf[flag_name] = np.ones_like(self.df['DATETIME'], dtype='uint8')
+            self.qcdf.loc[self.df['TEMPERATURE'] > 20, flag_name] = 3
+
+        registry = QcRegistry()
+        registry.register(legacy_test)
+        qc = QcApply(self.ds, ['spike', 'legacy_test', 'global_range'], attr_file=self.attr_file, registry=registry)
+        qc._run_qc_tests()
+        self.assertEqual(qc._success_tests, ['spike', 'legacy_test', 'global_range'])
+        self.assertEqual(
+            qc.flag_names(),
+            ['flag_spike_temp', 'flag_spike_pres', 'flag_legacy',
+             'flag_global_range_pres', 'flag_global_range_temp'])
+        np.testing.assert_array_equal(
+            qc.flag('flag_legacy') == 3, self.ds['TEMPERATURE'].values > 20)
+
+    def test_flag_matrix(self):
+        flags = FlagMatrix(5, capacity=2)
+        first = flags.new('flag_a')
+        flags['flag_b'] = np.array([1, 3, 1, 1, 1], dtype='uint8')
+        flags['flag_c'] = np.array([1, 1, np.nan, 4, 1])
+        # a third uint8 flag starts a second matrix, the first row is still in use
+        third = flags.new('flag_d')
+        first[4] = 2
+        third[0] = 2
+        self.assertEqual(list(flags), ['flag_a', 'flag_b', 'flag_c', 'flag_d'])
+        self.assertEqual(len(flags.blocks), 2)
+        np.testing.assert_array_equal(flags['flag_a'], [1, 1, 1, 1, 2])
+        qc_flag, groups = flags.group_max(
+            {'flag_a': 'LOCATION_QC', 'flag_b': 'None', 'flag_c': 'DATETIME_QC', 'flag_d': 'LOCATION_QC'})
+        np.testing.assert_array_equal(qc_flag, [2, 3, 1, 4, 2])
+        self.assertEqual(list(groups), ['LOCATION_QC', 'DATETIME_QC'])
+        np.testing.assert_array_equal(groups['LOCATION_QC'], [2, 1, 1, 1, 2])
+        self.assertEqual(groups['LOCATION_QC'].dtype, np.uint8)
+
+    def test_flag_matrix_rows_not_reused(self):
+        flags = FlagMatrix(3, capacity=2)
+        flags['flag_a'] = np.array([1, 2, 1], dtype='uint8')
+        flags['flag_b'] = np.array([3, 1, 1], dtype='uint8')
+        flags['flag_c'] = np.array([1, 1, 4], dtype='uint8')
+        # deleting a flag and replacing one with a non-uint8 array releases rows
+        del flags['flag_a']
+        flags['flag_b'] = np.array([3., 1., np.nan])
+        flags.new('flag_d', 2)
+        flags.new('flag_e', 3)
+        np.testing.assert_array_equal(flags['flag_b'], [3, 1, np.nan])
+        np.testing.assert_array_equal(flags['flag_c'], [1, 1, 4])
+        np.testing.assert_array_equal(flags['flag_d'], [2, 2, 2])
+        np.testing.assert_array_equal(flags['flag_e'], [3, 3, 3])
+        self.assertEqual(list(flags), ['flag_b', 'flag_c', 'flag_d', 'flag_e'])
+
+    def test_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.ds.load()
+        self.ds.attrs.update(moana_firmware='MOANA-1.21', reset_codes_data='None')
+        attr_file = os.path.join(os.path.dirname(test_dir), '..', 'attribute_list.yml')
+        test_list = ['global_range', 'spike', 'reset_code_check']
+        results = []
+        for ds in [self.ds.copy(), self.ds.copy(), self.ds.isel(DATETIME=slice(0, 100))]:
+            qc = QcApply(ds, test_list, save_flags=True, attr_file=attr_file, cache_dir=cache_dir)
+            results.append((qc.run(), qc.cache_results))
+        self.assertEqual(set(results[0][1].values()), {'miss'})
+        self.assertEqual(set(results[1][1].values()), {'hit'})
+        xr.testing.assert_identical(results[0][0], results[1][0])
+        # reset_code_check only reads attributes, which are the same
+        self.assertEqual(set(results[2][1].values()), {'miss'})
+        self.assertEqual(len(results[2][0]['flag_reset_old_firmware']), 100)
+
+    def test_cache_start_end_dist(self):
+        # without start_end_dist_m the distance comes from the positions
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.ds.load()
+        self.ds.attrs.pop('start_end_dist_m', None)
+        attr_file = os.path.join(os.path.dirname(test_dir), '..', 'attribute_list.yml')
+        moved = self.ds.copy(deep=True)
+        moved['LATITUDE'].values[-1] += 1
+        results = []
+        for ds in [self.ds, moved]:
+            qc = QcApply(ds, ['start_end_dist_check'], attr_file=attr_file, cache_dir=cache_dir)
+            qc.run()
+            results.append(qc.cache_results['start_end_dist_check'])
+        self.assertEqual(results, ['miss', 'miss'])
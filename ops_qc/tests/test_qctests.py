@@ -1,4 +1,5 @@
 import unittest
+from types import SimpleNamespace
 import numpy as np
 from ops_qc.qc_tests_df import *
 
@@ -38,6 +39,27 @@ class TestQcTests(unittest.TestCase):
         self.assertEqual(expected_peaks_temp,self.qcdf['flag_spike_temp'].tolist())
         self.assertEqual(expected_peaks_pres,self.qcdf['flag_spike_pres'].tolist())
 
+    def test_stuck_value_long(self):
+        rng = np.random.default_rng(0)
+        temp = np.round(rng.normal(12, 0.5, 3000), 1)
+        temp[500:540] = 12.3
+        self.df = pd.DataFrame({'TEMPERATURE': temp, 'PRESSURE': rng.uniform(0, 100, 3000)})
+        stuck_value(self, qc_vars={'TEMPERATURE': [0.05, 'flag_stuck_value_temp']}, rep_num=20, fail_flag=3)
+        # QARTOD style loop
+        expected = np.ones(len(temp), dtype='uint8')
+        for idx in range(20, len(temp)):
+            if np.all(np.abs(temp[idx - 20:idx] - temp[idx]) < 0.05):
+                expected[idx - 20:idx] = 3
+        np.testing.assert_array_equal(self.qcdf['flag_stuck_value_temp'], expected)
+        assert (expected[500:539] == 3).all()
+
+    def test_stationary_position_check_no_flags(self):
+        # without position or timing flags the test fails and the data isn't marked as good
+        self.ds = SimpleNamespace(attrs={'gear_class': 'stationary'})
+        with self.assertRaises(ValueError):
+            stationary_position_check(self)
+        self.assertEqual(self.qcdf['flag_surf_loc'].tolist(), [0] * len(self.df))
+
     def test_stuck_value(self):
         stuck_value(self, qc_vars=None, rep_num=5, fail_flag=2)
         expected_vals_temp = [1,1,1,1,1,1,1,1,1,1,2,2,2,2,2,1,1,1,1,1,1,1,1]
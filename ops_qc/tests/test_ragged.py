@@ -0,0 +1,48 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+from ops_qc.ragged import to_ragged, from_ragged, open_deployment, ragged_offsets
+
+
+class TestRaggedArray(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.datasets = []
+        for num, size in enumerate([5, 3, 4]):
+            ds = xr.Dataset(
+                {'TEMPERATURE': ('DATETIME', np.arange(size) + 10.5 * num),
+                 'QC_FLAG': ('DATETIME', np.ones(size, dtype=np.int64))},
+                coords={'DATETIME': pd.date_range(f'2021-06-2{num}', periods=size, freq='min'),
+                        'LATITUDE': ('DATETIME', np.full(size, -40.0 - num)),
+                        'LONGITUDE': ('DATETIME', np.full(size, 170.0 + num))},
+                attrs={'moana_serial_number': str(38 + num), 'gear_class': 'stationary'})
+            self.datasets.append(ds)
+        # a flag only saved for one deployment and an attribute only one has
+        self.datasets[1]['flag_spike_temp'] = ('DATETIME', np.array([1, 4, 1]))
+        self.datasets[2].attrs['public'] = 'True'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        ds = to_ragged(self.datasets, ['a', 'b', 'c'])
+        assert ds.attrs['featureType'] == 'trajectory'
+        assert ds['row_size'].attrs['sample_dimension'] == 'obs'
+        self.assertEqual(list(ragged_offsets(ds)), [0, 5, 8, 12])
+        self.assertEqual(list(ds['moana_serial_number'].values), ['38', '39', '40'])
+        savefile = os.path.join(self.tmpdir, 'ragged.nc')
+        ds.to_netcdf(savefile, format='NETCDF4')
+        for i, trajectory in enumerate(['a', 'b', 'c']):
+            deployment = open_deployment(savefile, trajectory)
+            expected = self.datasets[i]
+            xr.testing.assert_equal(
+                deployment.drop_vars('flag_spike_temp'), expected.drop_vars('flag_spike_temp', errors='ignore'))
+            self.assertEqual(deployment.attrs, expected.attrs)
+        np.testing.assert_array_equal(open_deployment(savefile, 1)['flag_spike_temp'], [1, 4, 1])
+        assert np.isnan(from_ragged(ds, 0)['flag_spike_temp']).all()
@@ -1,10 +1,18 @@
 import unittest
 import os
+import tempfile
+import threading
+import functools
+from http.server import HTTPServer, SimpleHTTPRequestHandler
 import pandas as pd
 import xarray as xr
 
 from ops_qc.readers import MangopareStandardReader
 from ops_qc.readers import MangopareMetadataReader
+from ops_qc.readers import MangopareBatchReader
+from ops_qc.readers import MangopareChunkedReader
+from ops_qc.readers import FisherMetadataIndex
+from ops_qc.cache import ContentCache
 
 test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),'testdata')
 
@@ -22,3 +30,132 @@ class TestMangopareStandardReader(unittest.TestCase):
         expected_coords = ['LATITUDE','LONGITUDE','DATETIME']
         assert all(var_name in var_list for var_name in expected_vars)
         assert all(var_name in coord_list for var_name in expected_coords)
+
+    def test_MangopareStandardReader_single_pass(self):
+        ds = MangopareStandardReader(self.filename).run()
+        ds_single = MangopareStandardReader(self.filename, single_pass=True).run()
+        ds_single.attrs["date_quality_controlled"] = ds.attrs["date_quality_controlled"]
+        xr.testing.assert_identical(ds, ds_single)
+
+    def test_MangopareStandardReader_cache(self):
+        ds = MangopareStandardReader(self.filename).run()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            results = []
+            for _ in range(2):
+                reader = MangopareStandardReader(self.filename, cache_dir=cache_dir)
+                ds_cached = reader.run()
+                ds_cached.attrs["date_quality_controlled"] = ds.attrs["date_quality_controlled"]
+                xr.testing.assert_identical(ds, ds_cached)
+                results.append(reader.cache_result)
+            assert results == ["miss", "hit"]
+            assert len(os.listdir(cache_dir)) == 1
+            # readers share one cache (and its size estimate) per cache_dir
+            assert ContentCache.shared(cache_dir) is ContentCache.shared(cache_dir)
+
+
+class TestMangopareBatchReader(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = os.path.join(test_dir, 'MOANA_0038_13_210624041106.csv')
+
+    def test_MangopareBatchReader(self):
+        missing = os.path.join(test_dir, 'missing.csv')
+        batch = MangopareBatchReader([self.filename, missing, self.filename]).run()
+        assert len(batch) == 2
+        assert list(batch.failed) == [missing]
+        nobs = batch.offsets[1]
+        assert batch.offsets.tolist() == [0, nobs, 2 * nobs]
+        assert len(batch.data['TEMPERATURE']) == 2 * nobs
+        ds = MangopareStandardReader(self.filename).run()
+        ds_batch = batch.to_dataset(1)
+        ds_batch.attrs["date_quality_controlled"] = ds.attrs["date_quality_controlled"]
+        xr.testing.assert_identical(ds, ds_batch)
+
+    def test_empty_batch(self):
+        missing = os.path.join(test_dir, 'missing.csv')
+        batch = MangopareBatchReader([missing]).run()
+        assert len(batch) == 0
+        assert batch.filenames == []
+
+
+class TestMangopareChunkedReader(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = os.path.join(test_dir, 'MOANA_0038_13_210624041106.csv')
+
+    def test_MangopareChunkedReader(self):
+        ds = MangopareStandardReader(self.filename).run()
+        blocks = list(MangopareChunkedReader(self.filename, chunksize=50).run())
+        assert all(len(block) <= 50 for block in blocks)
+        assert [block.start for block in blocks] == list(range(0, 50 * len(blocks), 50))
+        ds_blocks = xr.concat([block.to_dataset() for block in blocks], dim='DATETIME')
+        xr.testing.assert_equal(ds, ds_blocks)
+        assert blocks[0].attrs['moana_serial_number'] == ds.attrs['moana_serial_number']
+
+
+class TestFisherMetadataIndex(unittest.TestCase):
+
+    def setUp(self):
+        metafile = os.path.join(test_dir, 'Trial_fisherman_database_tests.csv')
+        self.fisher_metadata = MangopareMetadataReader(metafile).run()
+
+    def test_lookup(self):
+        index = FisherMetadataIndex(self.fisher_metadata)
+        times = pd.to_datetime(['2021-01-01', '2021-06-10', '2021-06-20', '2050-01-01'])
+        for serial in [38, 58, 60, 1]:
+            for t_min in times:
+                for t_max in times[times >= t_min]:
+                    expected = [
+                        i for i, row in self.fisher_metadata.iterrows()
+                        if row['Mangopare serial number'] == serial
+                        and t_min >= row['Date supplied']
+                        and t_max <= pd.to_datetime(row['Date returned'].date() + pd.Timedelta(days=1))
+                    ]
+                    found = index.lookup(serial, t_min, t_max)
+                    self.assertEqual(expected, list(found.index))
+        assert len(index.lookup(38, times[1], times[2])) == 1
+
+
+class CountingHandler(SimpleHTTPRequestHandler):
+    status_codes = []
+
+    def send_response(self, code, message=None):
+        self.status_codes.append(code)
+        super().send_response(code, message)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMangopareMetadataReaderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.metafile = os.path.join(test_dir, 'Trial_fisherman_database_tests.csv')
+        self.expected = MangopareMetadataReader(self.metafile).run()
+        self.expected = self.expected.drop(columns=['Date returned'])
+
+    def test_remote_cache(self):
+        CountingHandler.status_codes = []
+        handler = functools.partial(CountingHandler, directory=test_dir)
+        server = HTTPServer(('127.0.0.1', 0), handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = 'http://127.0.0.1:{}/Trial_fisherman_database_tests.csv'.format(server.server_port)
+        try:
+            with tempfile.TemporaryDirectory() as cache_dir:
+                for _ in range(2):
+                    fisher_metadata = MangopareMetadataReader(url, cache_dir=cache_dir).run()
+                    pd.testing.assert_frame_equal(
+                        self.expected, fisher_metadata.drop(columns=['Date returned']))
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([200, 304], CountingHandler.status_codes)
+
+    def test_local_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(2):
+                fisher_metadata = MangopareMetadataReader(self.metafile, cache_dir=cache_dir).run()
+                pd.testing.assert_frame_equal(
+                    self.expected, fisher_metadata.drop(columns=['Date returned']))
+            assert len(os.listdir(cache_dir)) == 2
@@ -0,0 +1,97 @@
+import unittest
+from unittest import mock
+import os
+from importlib import metadata
+import numpy as np
+import xarray as xr
+
+from ops_qc.apply_qc import QcApply, load_attr_file
+from ops_qc.context import qc_test
+from ops_qc.registry import QcRegistry, ENTRY_POINT_GROUP
+from ops_qc.utils import load_yaml
+
+attr_file = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'attribute_list.yml')
+
+# flags of the tests in this module, as a plugin module would declare them
+qc_attr_info = {'flag_warm': ['Warm Water Quality Flag', 'TEMPERATURE_QC']}
+
+
+@qc_test(columns=['TEMPERATURE'], produces=['flag_warm'], cost=5)
+def warm_water(self, max_temp=20, fail_flag=3, flag_name='flag_warm'):
+    flag = self.new_flag(flag_name)
+    flag[self.column('TEMPERATURE') > max_temp] = fail_flag
+
+
+class TestQcRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.qc_attr_info = load_yaml(attr_file, 'qc_attr_info')
+        n = 50
+        self.ds = xr.Dataset(
+            {
+                'TEMPERATURE': ('DATETIME', np.linspace(10, 30, n)),
+                'PRESSURE': ('DATETIME', np.linspace(0, 50, n)),
+            },
+            coords={'DATETIME': np.datetime64('2021-01-01', 'ns') + np.arange(n) * np.timedelta64(60, 's')},
+        )
+
+    def test_qc_tests_df(self):
+        registry = QcRegistry()
+        info = registry.get('stuck_value')
+        self.assertEqual(info.flags, ['flag_stuck_value_temp', 'flag_stuck_value_pres'])
+        self.assertEqual(info.parameters['rep_num'], 20)
+        self.assertEqual(info.cost, 30)
+        self.assertEqual(
+            info.categories(self.qc_attr_info),
+            {'flag_stuck_value_temp': 'TEMPERATURE_QC', 'flag_stuck_value_pres': 'PRESSURE_QC'})
+        self.assertIsNone(registry.requires('climatology_test'))
+        self.assertNotIn('_speed', registry)
+
+    def test_validate(self):
+        registry = QcRegistry()
+        self.assertEqual(len(registry.validate(['spike', 'global_range'], self.qc_attr_info)), 2)
+        with self.assertRaisesRegex(ValueError, 'Unknown qc tests'):
+            registry.validate(['spike', 'not_a_test'], self.qc_attr_info)
+        with self.assertRaisesRegex(ValueError, 'flag_spike_temp'):
+            registry.validate(['spike'], {})
+
+    def test_entry_points(self):
+        entry_points = metadata.EntryPoints([
+            metadata.EntryPoint('plugin', __name__, ENTRY_POINT_GROUP),
+            metadata.EntryPoint('broken', 'not_a_module:test', ENTRY_POINT_GROUP),
+        ])
+        with mock.patch('ops_qc.registry.metadata.entry_points', return_value=entry_points):
+            registry = QcRegistry(entry_points=True)
+        self.assertIn('warm_water', registry)
+        self.assertEqual(registry.cost('warm_water'), 5)
+        # flag attributes come from the plugin module
+        registry.validate(['warm_water', 'spike'], self.qc_attr_info)
+        ds = QcApply(
+            self.ds, ['warm_water', 'spike'], save_flags=True, attr_file=attr_file,
+            registry=registry).run()
+        self.assertEqual(ds['flag_warm'].attrs['long_name'], 'Warm Water Quality Flag')
+        self.assertEqual(int(ds['TEMPERATURE_QC'].max()), 3)
+
+    def test_fail_fast(self):
+        qc = QcApply(self.ds, ['spike', 'not_a_test'], attr_file=attr_file)
+        with self.assertRaisesRegex(ValueError, 'not_a_test'):
+            qc.run()
+        # raised before any test ran
+        self.assertEqual(qc.flag_names(), [])
+
+    def test_validated(self):
+        # the attribute file is parsed once, and not validated again per file
+        self.assertIs(load_attr_file(attr_file), load_attr_file(attr_file))
+        with mock.patch.object(QcApply, 'validate_tests') as validate_tests:
+            QcApply(self.ds, ['spike'], attr_file=attr_file, validated=True).run()
+            QcApply(self.ds, ['spike'], attr_file=attr_file).run()
+        self.assertEqual(validate_tests.call_count, 1)
+
+    def test_duplicate(self):
+        registry = QcRegistry()
+        with self.assertRaises(ValueError):
+            registry.register(warm_water, name='spike')
+
+
+if __name__ == '__main__':
+    unittest.main()
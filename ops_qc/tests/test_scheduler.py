@@ -0,0 +1,119 @@
+import unittest
+import os
+import numpy as np
+import xarray as xr
+
+from ops_qc.apply_qc import QcApply
+from ops_qc.context import qc_test
+from ops_qc.scheduler import QcScheduler, QcStep, StepError
+from ops_qc.registry import QcRegistry
+from ops_qc.utils import load_yaml
+
+attr_file = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'attribute_list.yml')
+
+
+class FakeTests(object):
+    """Stand in for qc_tests_df"""
+
+    @qc_test(flags=['flag_a'], produces=['flag_b'])
+    def test_b(self):
+        flag = self.new_flag('flag_b')
+        flag[self.flag('flag_a') > 1] = 3
+
+    @qc_test(columns=['TEMPERATURE'], produces=['flag_a'])
+    def test_a(self):
+        flag = self.new_flag('flag_a')
+        flag[self.column('TEMPERATURE') > 20] = 4
+
+    @qc_test(columns=['TEMPERATURE'], produces=['flag_c'])
+    def test_c(self):
+        self.new_flag('flag_c')
+
+    @qc_test
+    def test_undeclared(self):
+        self.new_flag('flag_d')
+
+
+fake_registry = QcRegistry([FakeTests])
+
+
+class TestQcScheduler(unittest.TestCase):
+
+    def test_order(self):
+        scheduler = QcScheduler(['test_b', 'test_a', 'test_c'], registry=fake_registry)
+        self.assertEqual(scheduler.order(), ['test_a', 'test_b', 'test_c'])
+        # test_c doesn't depend on test_b, so can run at the same time
+        self.assertEqual(scheduler.plan(), [['test_a'], ['test_b', 'test_c']])
+
+    def test_undeclared(self):
+        scheduler = QcScheduler(['test_c', 'test_undeclared', 'test_a'], registry=fake_registry)
+        self.assertEqual(scheduler.plan(), [['test_c'], ['test_undeclared'], ['test_a']])
+
+    def test_cycle(self):
+        requires = {'test_a': {'flags': ['flag_b']}}
+        with self.assertRaises(ValueError):
+            QcScheduler(['test_a', 'test_b'], requires=requires, registry=fake_registry)
+
+    def test_steps(self):
+        steps = {
+            'location_attrs': QcStep(None, columns=['LATITUDE'], flags=['LOCATION_QC'], produces=['start_end_dist_m']),
+            'positions': QcStep(None, columns=['LATITUDE'], flags=['LOCATION_QC'], modifies=['LATITUDE']),
+        }
+        scheduler = QcScheduler(
+            ['start_end_dist_check', 'impossible_location', 'spike'],
+            steps,
+            load_yaml(attr_file, 'qc_attr_info'),
+        )
+        self.assertEqual(
+            scheduler.order(),
+            ['impossible_location', 'spike', 'location_attrs', 'start_end_dist_check', 'positions'])
+
+
+class TestQcApplySteps(unittest.TestCase):
+
+    def setUp(self):
+        n = 50
+        self.ds = xr.Dataset(
+            {
+                'TEMPERATURE': ('DATETIME', np.linspace(10, 25, n)),
+                'PRESSURE': ('DATETIME', np.linspace(1, 50, n)),
+                'LATITUDE': ('DATETIME', np.full(n, -41.0)),
+                'LONGITUDE': ('DATETIME', np.full(n, 174.0)),
+            },
+            coords={'DATETIME': np.datetime64('2021-06-01', 'ns') + np.arange(n) * np.timedelta64(4, 's')},
+            attrs={'gear_class': 'mobile'},
+        )
+
+    def test_step(self):
+        def location_step(ds):
+            # flags made before the step are in the dataset
+            ds.attrs['location_qc'] = int(ds['LOCATION_QC'].max())
+            ds.attrs['start_end_dist_m'] = '100.00'
+            return ds
+
+        steps = {'location_attrs': QcStep(location_step, flags=['LOCATION_QC'], produces=['start_end_dist_m'])}
+        test_requires = {'start_end_dist_check': {'gear_class': ['mobile']}}
+        ds = QcApply(
+            self.ds, ['start_end_dist_check', 'impossible_location', 'global_range'],
+            attr_file=attr_file, steps=steps, test_requires=test_requires, threads=2).run()
+        self.assertEqual(ds.attrs['location_qc'], 1)
+        # tests are listed in test_list order, not the order they ran in
+        self.assertEqual(ds.attrs['qc_tests_applied'], str(['start_end_dist_check', 'impossible_location', 'global_range']))
+        self.assertEqual(int(ds['LOCATION_QC'].max()), 2)
+
+    def test_gear_class(self):
+        # start_end_dist_check is for stationary gear, mobile data gets no flag_dist
+        ds = QcApply(
+            self.ds, ['impossible_location', 'start_end_dist_check'],
+            save_flags=True, attr_file=attr_file).run()
+        self.assertEqual(ds.attrs['qc_tests_applied'], str(['impossible_location']))
+        self.assertNotIn('flag_dist', ds)
+        self.assertEqual(int(ds['LOCATION_QC'].max()), 1)
+
+    def test_step_error(self):
+        def failing_step(ds):
+            raise ValueError('Position attrs not assigned due to: no positions')
+
+        qc = QcApply(self.ds, ['impossible_location'], attr_file=attr_file, steps={'positions': QcStep(failing_step)})
+        with self.assertRaises(StepError):
+            qc.run()
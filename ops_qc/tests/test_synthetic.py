@@ -0,0 +1,46 @@
+import unittest
+import os
+import shutil
+import tempfile
+import filecmp
+
+from ops_qc.synthetic import SyntheticMangopare, RESET_VALUE
+from ops_qc.readers import MangopareStandardReader
+from ops_qc.wrapper import QcWrapper
+
+
+class TestSyntheticMangopare(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _generate(self, name, **kwargs):
+        return SyntheticMangopare(os.path.join(self.tmpdir, name), nfiles=6, nsensors=3, **kwargs).run()
+
+    def test_seed(self):
+        filelist, metafile = self._generate('a', seed=1)
+        filelist_b, metafile_b = self._generate('b', seed=1)
+        self.assertEqual([os.path.basename(f) for f in filelist], [os.path.basename(f) for f in filelist_b])
+        for a, b in zip(filelist + [metafile], filelist_b + [metafile_b]):
+            assert filecmp.cmp(a, b, shallow=False)
+
+    def test_reset_rows(self):
+        filelist, _ = self._generate('resets', anomaly_rate=1, hauls=(1, 1), haul_minutes=(5, 10))
+        ds = MangopareStandardReader(filelist[0]).run()
+        assert (ds['TEMPERATURE'] == RESET_VALUE).any()
+        self.assertNotEqual(ds.attrs['reset_codes_data'], 'None')
+
+    def test_wrapper(self):
+        filelist, metafile = self._generate('in', anomaly_rate=0, haul_minutes=(5, 10))
+        wrapper = QcWrapper(
+            filelist=filelist,
+            out_dir=os.path.join(self.tmpdir, 'out') + '/',
+            test_list_1=['impossible_date', 'impossible_location', 'timing_gap', 'global_range', 'remove_ref_location', 'spike', 'temp_drift', 'reset_code_check'],
+            test_list_2=['start_end_dist_check'],
+            fishing_metafile=metafile)
+        success_files = wrapper.run()
+        self.assertEqual(len(success_files), len(filelist))
+        self.assertEqual(set(wrapper._status_data['gear_class']), {'mobile', 'stationary'})
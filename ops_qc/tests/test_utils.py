@@ -1,8 +1,14 @@
 import unittest
+import os
+import time
+import shutil
+import tempfile
 import numpy as np
 import pandas as pd
 from datetime import datetime
-from ops_qc.utils import haversine, calc_speed
+import xarray as xr
+from ops_qc.utils import haversine, calc_speed, good_position_mask, derive_positions, haul_positions, start_end_dist
+from ops_qc.utils import write_netcdf_atomic, remove_stale_tempfiles, LazyModule, phase_segments
 
 
 class TestVariousUtils(unittest.TestCase):
@@ -30,4 +36,70 @@ class TestVariousUtils(unittest.TestCase):
         expected_mph = [speed*1.15077867312 for speed in speed_knots]
         assert np.allclose(speed_mph,expected_mph)
 
+    def test_derive_positions(self):
+        ds = xr.Dataset({
+            'LATITUDE': ('DATETIME', self.df['LATITUDE'].to_numpy()),
+            'LONGITUDE': ('DATETIME', self.df['LONGITUDE'].to_numpy()),
+            'LOCATION_QC': ('DATETIME', [4, 1, 1, 1, 3, 4]),
+            'DATETIME_QC': ('DATETIME', [1, 1, 1, 4, 1, 1])})
+        mask = good_position_mask(ds, qcrange=[1, 2, 3])
+        self.assertEqual(list(mask), [False, True, True, False, True, False])
+        positions = derive_positions(ds.LATITUDE.values, ds.LONGITUDE.values, mask)
+        assert positions['start'] == 1 and positions['end'] == 4
+        assert positions['latitude'] == -39.5 and positions['longitude'] == 176
+        expected_dist = haversine(lat1=-37, lon1=169, lat2=-42, lon2=183)*1000
+        assert np.isclose(positions['start_end_dist'], expected_dist)
+        assert np.isclose(start_end_dist(ds), expected_dist)
+        with self.assertRaises(ValueError):
+            derive_positions(ds.LATITUDE.values, ds.LONGITUDE.values, np.zeros(6, dtype=bool))
+        # a missing qc flag isn't taken as all positions being good
+        with self.assertRaises(KeyError):
+            start_end_dist(ds.drop_vars('LOCATION_QC'))
+        mask = good_position_mask(ds.drop_vars('LOCATION_QC'), qcrange=[1, 2, 3], optional=True)
+        self.assertEqual(list(mask), [True, True, True, False, True, True])
 
+    def test_phase_segments(self):
+        phase = np.array([b'D', b'D', b'P', b'P', b'D', b'D', b'D', b'P'])
+        self.assertEqual(list(phase_segments(phase)), [1, 1, 2, 2, 3, 3, 3, 4])
+        self.assertEqual(len(phase_segments(np.array([], dtype='S1'))), 0)
+
+    def test_haul_positions(self):
+        mask = np.array([True, True, True, False, False, True])
+        haul = np.array([1, 1, 1, 2, 2, 3])
+        lat, lon = haul_positions(
+            self.df['LATITUDE'].to_numpy(), self.df['LONGITUDE'].to_numpy(), mask, haul)
+        assert np.array_equal(lat, [-37, -37, -37, np.nan, np.nan, -45], equal_nan=True)
+        assert np.array_equal(lon, [171.5, 171.5, 171.5, np.nan, np.nan, 185], equal_nan=True)
+
+    def test_write_netcdf_atomic(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ds = xr.Dataset({'TEMPERATURE': ('DATETIME', [10.0, 11.0])})
+            savefile = os.path.join(tmpdir, 'test.nc')
+            write_netcdf_atomic(ds, savefile, mode='w', format='NETCDF4')
+            self.assertEqual(os.listdir(tmpdir), ['test.nc'])
+            with xr.open_dataset(savefile) as saved:
+                xr.testing.assert_identical(saved.load(), ds)
+            # a failed write leaves neither the file nor a temporary file
+            with self.assertRaises(Exception):
+                write_netcdf_atomic(ds, os.path.join(tmpdir, 'bad.nc'), format='NOT_A_FORMAT')
+            self.assertEqual(os.listdir(tmpdir), ['test.nc'])
+            # only old temporary files are removed
+            old = os.path.join(tmpdir, '.tmp_old.nc.abc.tmp')
+            new = os.path.join(tmpdir, '.tmp_new.nc.abc.tmp')
+            for name in [old, new]:
+                open(name, 'w').close()
+            os.utime(old, (time.time() - 7200, time.time() - 7200))
+            self.assertEqual(remove_stale_tempfiles(tmpdir, max_age=3600), [old])
+            self.assertEqual(sorted(os.listdir(tmpdir)), ['.tmp_new.nc.abc.tmp', 'test.nc'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_lazy_module(self):
+        lazy = LazyModule('json')
+        assert 'not loaded' in repr(lazy)
+        self.assertEqual(lazy.loads('[1, 2]'), [1, 2])
+        assert 'dumps' in dir(lazy)
+        assert 'not loaded' not in repr(lazy)
+        with self.assertRaises(AttributeError):
+            lazy.not_a_function
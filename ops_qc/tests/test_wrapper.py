@@ -0,0 +1,237 @@
+import unittest
+import importlib
+import os
+import shutil
+import tempfile
+import pandas as pd
+
+from ops_qc.wrapper import QcWrapper, cycle_dt
+from ops_qc.status import QcJournal
+
+test_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)),'testdata')
+
+
+class TestQcWrapper(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.metafile = os.path.join(test_dir, 'Trial_fisherman_database_wrapper_tests.csv')
+        self.test_list_1 = ['impossible_date', 'impossible_location', 'timing_gap', 'global_range', 'remove_ref_location', 'spike', 'temp_drift', 'reset_code_check']
+        self.test_list_2 = ['start_end_dist_check']
+        self.filelist = []
+        for num in [13, 14, 15]:
+            filename = os.path.join(self.tmpdir, f'MOANA_0038_{num}_210624041106.csv')
+            shutil.copy(os.path.join(test_dir, 'MOANA_0038_13_210624041106.csv'), filename)
+            self.filelist.append(filename)
+        # one file that can't be read
+        self.filelist.insert(1, os.path.join(self.tmpdir, 'MOANA_0038_16_210624041106.csv'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run_wrapper(self, out_name, **kwargs):
+        out_dir = os.path.join(self.tmpdir, out_name) + '/'
+        wrapper = QcWrapper(
+            filelist=self.filelist,
+            out_dir=out_dir,
+            test_list_1=self.test_list_1,
+            test_list_2=self.test_list_2,
+            fishing_metafile=self.metafile,
+            **kwargs)
+        success_files = wrapper.run()
+        status = wrapper._status_data.drop(columns=['date_quality_controlled'])
+        return [os.path.basename(f) for f in success_files], status
+
+    def test_run(self):
+        success_files, status = self._run_wrapper('serial')
+        assert len(success_files) == 3
+        self.assertEqual(list(status['filename']), self.filelist)
+        self.assertEqual(list(status['saved'].fillna('no')), ['yes', 'no', 'yes', 'yes'])
+        self.assertEqual(status['failed'].iloc[1], 'yes')
+
+    def test_run_workers(self):
+        success_files, status = self._run_wrapper('serial')
+        success_files_parallel, status_parallel = self._run_wrapper('parallel', workers=2)
+        self.assertEqual(success_files, success_files_parallel)
+        pd.testing.assert_frame_equal(status, status_parallel)
+
+    def test_run_pipeline(self):
+        success_files, status = self._run_wrapper('serial')
+        success_files_pipeline, status_pipeline = self._run_wrapper(
+            'pipeline', pipeline=True, pipeline_queue_size=1)
+        self.assertEqual(success_files, success_files_pipeline)
+        pd.testing.assert_frame_equal(status, status_pipeline)
+
+    def test_ragged_output(self):
+        import xarray as xr
+        from ops_qc.ragged import open_deployment
+        success_files, status = self._run_wrapper('serial')
+        ragged_files, ragged_status = self._run_wrapper(
+            'ragged', output_format='ragged', ragged_batch_size=2)
+        date = cycle_dt.strftime('%y%m%d')
+        self.assertEqual(ragged_files, [
+            f'MOANA_0038_13_210624041106_batch2_qc_{date}.nc',
+            f'MOANA_0038_15_210624041106_batch1_qc_{date}.nc'])
+        pd.testing.assert_frame_equal(status, ragged_status)
+        with xr.open_dataset(os.path.join(self.tmpdir, 'serial', success_files[1])) as expected:
+            deployment = open_deployment(
+                os.path.join(self.tmpdir, 'ragged', ragged_files[0]), os.path.splitext(success_files[1])[0])
+            xr.testing.assert_equal(deployment, expected.load())
+
+    def test_status_flush(self):
+        status_file_dir = os.path.join(self.tmpdir, 'status')
+        success_files, status = self._run_wrapper(
+            'flushed', status_file_dir=status_file_dir, status_flush_every=3)
+        status_files = os.listdir(status_file_dir)
+        assert len(status_files) == 1
+        saved_status = pd.read_csv(os.path.join(status_file_dir, status_files[0]))
+        self.assertEqual(list(saved_status['filename']), self.filelist)
+
+    def test_journal_resume(self):
+        journal_file = os.path.join(self.tmpdir, 'journal.jsonl')
+        success_files, status = self._run_wrapper('journal', journal_file=journal_file)
+        with open(journal_file) as f:
+            assert len(f.readlines()) == 4
+        # unchanged files are skipped, a changed or missing file is tried again
+        with open(self.filelist[2], 'a') as f:
+            f.write('\n')
+        success_files_resumed, status_resumed = self._run_wrapper('journal', journal_file=journal_file)
+        with open(journal_file) as f:
+            assert len(f.readlines()) == 6
+        self.assertEqual(success_files, success_files_resumed)
+        self.assertEqual(list(status_resumed['filename']), self.filelist)
+        self.assertEqual(list(status_resumed['saved'].fillna('no')), ['yes', 'no', 'yes', 'yes'])
+
+    def test_journal_resume_status_file(self):
+        journal_file = os.path.join(self.tmpdir, 'journal.jsonl')
+        status_dirs = [os.path.join(self.tmpdir, name) for name in ['status_1', 'status_2']]
+        # the second run writes another status file, i.e. on another cycle date
+        for status_dir in status_dirs + status_dirs[:1]:
+            self._run_wrapper(
+                'journal', journal_file=journal_file, status_file_dir=status_dir,
+                status_flush_every=1)
+        # resumed files are in each status file once, the missing file is tried
+        # again by every run
+        expected = [self.filelist + [self.filelist[1]], self.filelist]
+        for status_dir, filenames in zip(status_dirs, expected):
+            status_file, = os.listdir(status_dir)
+            saved_status = pd.read_csv(os.path.join(status_dir, status_file))
+            self.assertEqual(list(saved_status['filename']), filenames)
+
+    def test_haul_positions(self):
+        import numpy as np
+        import xarray as xr
+        latitude = np.array([-41.0, -41.2, -41.4, -45.0, -45.5, -46.0])
+        longitude = np.array([174.0, 174.2, 174.4, 175.0, 175.5, 176.0])
+        ds = xr.Dataset(
+            {'LATITUDE': ('DATETIME', latitude), 'LONGITUDE': ('DATETIME', longitude),
+             'LOCATION_QC': ('DATETIME', np.ones(6)), 'DATETIME_QC': ('DATETIME', np.ones(6)),
+             # consecutive D samples (slow sampling on the bottom) are one haul
+             'PHASE': ('DATETIME', np.array([b'P', b'P', b'D', b'D', b'D', b'P']))},
+            coords={'DATETIME': pd.date_range('2021-06-24', periods=6, freq='min')},
+            attrs={'gear_class': 'stationary'})
+        wrapper = QcWrapper(filelist=[], stationary_positions='haul')
+        wrapper.ds = ds
+        wrapper._calc_positions('test.csv')
+        np.testing.assert_allclose(
+            wrapper.ds['LATITUDE'].values, [-41.1, -41.1, -43.45, -43.45, -43.45, -46.0])
+        np.testing.assert_allclose(
+            wrapper.ds['LONGITUDE'].values, [174.1, 174.1, 174.95, 174.95, 174.95, 176.0])
+
+    def test_convert_pressure_to_depth(self):
+        import gsw
+        import numpy as np
+        import xarray as xr
+        pressure = np.array([1.0, 10.5, 'bad', 200.0, np.nan, 35.2], dtype=object)
+        latitude = np.array([-41.0, -41.2, np.nan, -45.0, -45.5, -46.0])
+        # consecutive D samples (slow sampling on the bottom) are one profile
+        phase = np.array([b'D', b'P', b'P', b'D', b'D', b'P'])
+        ds = xr.Dataset(
+            {'PRESSURE': ('DATETIME', pressure), 'PRESSURE_QC': ('DATETIME', np.ones(6)),
+             'LATITUDE': ('DATETIME', latitude), 'PHASE': ('DATETIME', phase)},
+            coords={'DATETIME': pd.date_range('2021-06-24', periods=6, freq='min')})
+
+        def loop_depth(lats):
+            return [-gsw.z_from_p(float(p) if p != 'bad' else np.nan, lat)
+                    for p, lat in zip(pressure, lats)]
+
+        mean_lat = np.nanmean(latitude)
+        expected = {
+            'mean': loop_depth([mean_lat]*6),
+            'sample': loop_depth(np.where(np.isnan(latitude), mean_lat, latitude)),
+            'profile': loop_depth([-41.0, -41.2, -41.2, -45.25, -45.25, -46.0]),
+        }
+        for depth_latitude, depth in expected.items():
+            wrapper = QcWrapper(filelist=[], depth_latitude=depth_latitude)
+            wrapper.ds = ds.copy()
+            np.testing.assert_allclose(
+                wrapper.convert_pressure_to_depth()['DEPTH'].values, depth)
+
+    def test_time_stages(self):
+        status_file_dir = os.path.join(self.tmpdir, 'status')
+        success_files, status = self._run_wrapper(
+            'timed', status_file_dir=status_file_dir, time_stages=True)
+        self.assertEqual(len(success_files), 3)
+        for column in ['time_read', 'time_preprocess', 'time_write', 'time_qc_spike', 'time_qc_start_end_dist_check']:
+            assert column in status
+        # the missing file is only timed as far as reading it
+        assert status['time_read'].notna().all()
+        assert status['time_write'].isna().iloc[1]
+        summary = pd.read_csv(
+            [os.path.join(status_file_dir, f) for f in os.listdir(status_file_dir) if f.startswith('timing_summary')][0],
+            index_col='stage')
+        self.assertEqual(summary.loc['read', 'files'], 4)
+        self.assertEqual(summary.loc['write', 'files'], 3)
+        assert (summary['p95'] >= summary['p50']).all()
+
+    def test_qc_cache(self):
+        success_files, status = self._run_wrapper('serial')
+        status_file_dir = os.path.join(self.tmpdir, 'status')
+        cached_files, cached_status = self._run_wrapper(
+            'cached', status_file_dir=status_file_dir, qc_cache_dir=os.path.join(self.tmpdir, 'cache'))
+        self.assertEqual(cached_files, success_files)
+        # the files have the same data, so only the first one runs the tests
+        self.assertEqual(list(cached_status['cache_spike'].fillna('')), ['miss', '', 'hit', 'hit'])
+        pd.testing.assert_frame_equal(
+            status, cached_status.drop(columns=[c for c in cached_status if c.startswith('cache_')]))
+        report = pd.read_csv(
+            [os.path.join(status_file_dir, f) for f in os.listdir(status_file_dir) if f.startswith('qc_cache_report')][0],
+            index_col='test')
+        self.assertEqual(report.loc['spike', 'hits'], 2)
+        self.assertAlmostEqual(report.loc['spike', 'hit_rate'], 2 / 3)
+
+    @unittest.skipUnless(importlib.util.find_spec('zarr'), 'zarr not installed')
+    def test_zarr_output(self):
+        import xarray as xr
+        from ops_qc.archive import ZarrArchive
+        success_files, status = self._run_wrapper('serial')
+        zarr_store = os.path.join(self.tmpdir, 'archive.zarr')
+        saved, zarr_status = self._run_wrapper(
+            'zarr', output_format='zarr', zarr_store=zarr_store, workers=2)
+        pd.testing.assert_frame_equal(status, zarr_status)
+        archive = ZarrArchive(zarr_store)
+        deployments = [os.path.splitext(f)[0] for f in success_files]
+        self.assertEqual(saved, deployments)
+        self.assertEqual(archive.deployments(), deployments)
+        self.assertEqual(list(archive.index()['gear_class']), ['stationary'] * 3)
+        with xr.open_dataset(os.path.join(self.tmpdir, 'serial', success_files[0])) as expected:
+            deployment = archive.open(deployments[0]).load()
+            xr.testing.assert_equal(deployment, expected.load())
+            self.assertEqual(deployment.attrs['start_end_dist_m'], expected.attrs['start_end_dist_m'])
+        combined = archive.load()
+        self.assertEqual(list(combined['row_size'].values), [167, 167, 167])
+
+
+class TestQcJournal(unittest.TestCase):
+
+    def test_truncated_entry(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            journal_file = os.path.join(tmpdir, 'journal.jsonl')
+            QcJournal(journal_file, 'config').record('a.csv', 'hash_a', [], [{'filename': 'a.csv'}])
+            with open(journal_file, 'a') as f:
+                # a run killed while writing an entry
+                f.write('{"filename": "b.csv", "inp')
+            QcJournal(journal_file, 'config').record('c.csv', 'hash_c', [], [{'filename': 'c.csv'}])
+            journal = QcJournal(journal_file, 'config')
+            self.assertEqual(list(journal.entries), ['a.csv', 'c.csv'])
+            self.assertIsNotNone(journal.completed('c.csv', 'hash_c'))
@@ -1,16 +1,9 @@
 import os
 import logging
-import numpy as np
-import pandas as pd
-import xarray as xr
-import seawater as sw
 import datetime as dt
-from glob import glob
 import subprocess
 import time
 
-xr.set_options(keep_attrs=True)
-
 # cycle_dt = dt.datetime.utcnow()
 
 
@@ -4,14 +4,45 @@ import datetime as dt
 import glob
 import os
 import importlib as il
-from shapely.geometry import Point, shape
-from shapely.ops import nearest_points
+import tempfile
+import time
 
 """
 Miscellanous functions used by multiple classes in the QC library.
 """
 
 
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported when one of its attributes
+    is first used, e.g. xr = LazyModule("xarray").  Heavy dependencies are
+    imported this way so that importing an ops_qc entry point (i.e. as a
+    scheduler pycallable) only pays for the libraries the job actually uses.
+    """
+
+    def __init__(self, name):
+        self.__dict__["_name"] = name
+        self.__dict__["_module"] = None
+
+    def _load(self):
+        if self._module is None:
+            self.__dict__["_module"] = il.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<LazyModule {self._name} ({state})>"
+
+
+pd = LazyModule("pandas")
+
+
 def catch(func, handle=lambda e: e, *args, **kwargs):
     """ Values that return an error are overwritten as np.nan...we just ignore them for now """
     try:
@@ -43,22 +74,26 @@ def calc_speed(df, units='kts'):
     """
     Calculate speed in km/hr, mph, or kts
     """
-    conversions = {'kts': 0.539957, 'mph': 0.621371}
-    df['speed'] = np.nan
-    if len(df.DATETIME) > 1:
-        delta_time = df.DATETIME.diff().dt.total_seconds()/3600
-        lat1 = df.LATITUDE.shift()
-        lon1 = df.LONGITUDE.shift()
-        lat2 = df.LONGITUDE
-        lon2 = df.LATITUDE
-        dist = haversine(lat1, lon1, lon2, lat2)
-        cvf = conversions[units]
-        df['speed'] = [d / t * cvf if t != 0 else np.nan for d, t in zip(dist, delta_time)]
-    else:
-        df['speed'] = np.nan
+    df['speed'] = speed_from_positions(
+        np.asarray(df.DATETIME), np.asarray(df.LATITUDE), np.asarray(df.LONGITUDE), units)
     return (df)
 
 
+def speed_from_positions(datetime, latitude, longitude, units='kts'):
+    """
+    Speed between consecutive positions (numpy arrays) in kts or mph, the
+    first value and values with no time difference are nan
+    """
+    conversions = {'kts': 0.539957, 'mph': 0.621371}
+    speed = np.full(len(datetime), np.nan)
+    if len(datetime) > 1:
+        delta_time = np.diff(datetime).astype('timedelta64[ns]') / np.timedelta64(1, 's') / 3600
+        dist = haversine(latitude[:-1], longitude[:-1], latitude[1:], longitude[1:])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed[1:] = np.where(delta_time != 0, dist / delta_time * conversions[units], np.nan)
+    return speed
+
+
 def load_yaml(filename,dict_name):
     """
     Load yaml file and return specified dictionary
@@ -108,6 +143,8 @@ def point_on_land(point,all_shapes,tol=0):
     minimum distance of the point from the polygon boundary.  tol is the tolerance
     in meters of distance from boundary to count as "on land"
     """
+    from shapely.geometry import Point, shape
+    from shapely.ops import nearest_points
 
     # first check if point is on land
     is_on_land = sum([Point(point).within(shape(item)) for item in all_shapes])
@@ -123,6 +160,74 @@ def point_on_land(point,all_shapes,tol=0):
     else:
         return False
 
+def good_position_mask(ds, qcrange=[1,2,3], qc_vars=["LOCATION_QC", "DATETIME_QC"], optional=False):
+    """
+    Boolean numpy array, True where every one of qc_vars has a flag in
+    qcrange.  Computed on the arrays, the dataset is not copied.  Raises a
+    KeyError if one of qc_vars is not in ds, unless optional, when the
+    missing qc_vars are left out.
+    """
+    mask = np.ones(len(ds["LATITUDE"]), dtype=bool)
+    for var in qc_vars:
+        if var in ds.data_vars:
+            mask &= np.isin(ds[var].values, qcrange)
+        elif not optional:
+            raise KeyError(f"No {var} to find good positions with")
+    return mask
+
+
+def derive_positions(latitude, longitude, mask):
+    """
+    Takes latitude and longitude arrays and a good position mask (see
+    good_position_mask) and returns a dictionary with the index of the first
+    (start) and last (end) good positions, the stationary position (latitude,
+    longitude) as the mean of the start and end positions, and the distance
+    in meters between them (start_end_dist).  Raises a ValueError if there
+    are no good positions.
+    """
+    good = np.flatnonzero(mask)
+    if not len(good):
+        raise ValueError("No good positions")
+    start, end = good[0], good[-1]
+    return {
+        "start": start,
+        "end": end,
+        "latitude": np.nanmean([latitude[start], latitude[end]]),
+        "longitude": np.nanmean([longitude[start], longitude[end]]),
+        "start_end_dist": haversine(
+            latitude[start], longitude[start],
+            latitude[end], longitude[end])*1000,
+    }
+
+
+def phase_segments(phase):
+    """
+    Segment number of each sample of a PHASE array, a new segment starting
+    wherever PHASE changes, so each run of profile ("P") or deployed ("D")
+    samples is one segment.  PHASE is "D" for every sample after a time gap,
+    so runs of "D" (i.e. slow sampling on the bottom) aren't split up.
+    """
+    phase = np.asarray(phase).astype(str)
+    change = np.ones(len(phase), dtype=bool)
+    change[1:] = phase[1:] != phase[:-1]
+    return np.cumsum(change)
+
+
+def haul_positions(latitude, longitude, mask, haul):
+    """
+    Per-haul version of the stationary position in derive_positions.
+    haul is an array of haul numbers, one per sample.  Returns latitude
+    and longitude arrays with every sample set to the mean of the first and
+    last good positions of its haul, NaN for hauls with no good positions.
+    """
+    df = pd.DataFrame(
+        {"haul": haul, "latitude": latitude, "longitude": longitude})
+    good = df[mask].groupby("haul")
+    ends = pd.concat([good.head(1), good.tail(1)]).groupby("haul").mean()
+    ends = ends.reindex(haul)
+    return ends["latitude"].to_numpy(), ends["longitude"].to_numpy()
+
+
 def start_end_dist(ds, qcrange = [1,2,3]):
     """
     Takes an xarray dataset with LATITUDE, LONGITUDE, LOCATION_QC,
@@ -131,16 +236,62 @@ def start_end_dist(ds, qcrange = [1,2,3]):
     of qcflags that should be considered "good" data.  Returned 
     distance is in meters.
     """
-    ds2 = ds.where(ds['LOCATION_QC'].isin(qcrange), drop=True)
-    ds2 = ds2.where(
-        ds2['DATETIME_QC'].isin(qcrange), drop=True)
-    if len(ds2) > 1:
-        sed = haversine(
-            ds2.LATITUDE[0], ds2.LONGITUDE[0],
-            ds2.LATITUDE[-1], ds2.LONGITUDE[-1])*1000
-    else:
-        sed = np.nan
-    return sed
+    mask = good_position_mask(ds, qcrange)
+    return derive_positions(
+        ds.LATITUDE.values, ds.LONGITUDE.values, mask)["start_end_dist"]
+
+TEMPFILE_PREFIX = ".tmp_"
+
+
+def write_netcdf_atomic(ds, savefile, **kwargs):
+    """
+    Writes ds to savefile (kwargs are passed to ds.to_netcdf) without ever
+    leaving a partial savefile: the data is written to a hidden temporary
+    file in the same directory, fsynced, then renamed to savefile.
+    """
+    save_dir, name = os.path.split(os.path.abspath(savefile))
+    fd, tmpfile = tempfile.mkstemp(
+        dir=save_dir, prefix=f"{TEMPFILE_PREFIX}{name}.", suffix=".tmp")
+    os.close(fd)
+    try:
+        ds.to_netcdf(tmpfile, **kwargs)
+        with open(tmpfile, "rb") as f:
+            os.fsync(f.fileno())
+        os.replace(tmpfile, savefile)
+    except BaseException:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise
+    # make the rename itself durable
+    dir_fd = os.open(save_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def remove_stale_tempfiles(dir_path, max_age=3600):
+    """
+    Removes temporary files left in dir_path by write_netcdf_atomic calls
+    that were interrupted, if older than max_age seconds (younger ones may
+    belong to a run still in progress).  Returns the removed files.
+    """
+    removed = []
+    if not os.path.isdir(dir_path):
+        return removed
+    now = time.time()
+    for name in os.listdir(dir_path):
+        if not (name.startswith(TEMPFILE_PREFIX) and name.endswith(".tmp")):
+            continue
+        path = os.path.join(dir_path, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+                removed.append(path)
+        except FileNotFoundError:
+            pass
+    return removed
+
 
 def import_pycallable(pycallable):
     """
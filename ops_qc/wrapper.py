@@ -1,13 +1,27 @@
 import os
 import logging
+import ops_qc
 import numpy as np
-import pandas as pd
-import xarray as xr
-import gsw
 import datetime as dt
-from ops_qc.utils import catch, start_end_dist, import_pycallable
+import time
+import queue
+import threading
+import functools
+from concurrent.futures import ProcessPoolExecutor
+from ops_qc.utils import catch, start_end_dist, import_pycallable, LazyModule
+from ops_qc.utils import good_position_mask, derive_positions, haul_positions, phase_segments
+from ops_qc.utils import write_netcdf_atomic, remove_stale_tempfiles
+from ops_qc.readers import FisherMetadataIndex
+from ops_qc.status import StatusRecorder, QcJournal, StageTimer, timing_summary, cache_report
+from ops_qc.cache import content_key, file_digest
+from ops_qc.encoding import netcdf_encoding
+from ops_qc.ragged import to_ragged
+from ops_qc.archive import ZarrArchive
+from ops_qc.scheduler import QcStep, StepError
 
-xr.set_options(keep_attrs=True)
+pd = LazyModule("pandas")
+xr = LazyModule("xarray")
+gsw = LazyModule("gsw")
 
 cycle_dt = dt.datetime.utcnow()
 
@@ -21,25 +35,78 @@ class QcWrapper(object):
         filelist -- list of csv files to apply quality control to
         outfile_ext -- extension to add to filenames when saving as netcdf files
         out_dir - directory to save qc'd netcdf files in
-        test_list_1 -- list of qc tests to run in the first "batch," these tests should not
-            depend on a previous test
-        test_list_2 -- list of qc tests to run in the second "batch," which may depend on 
-            qc tests in test_list_1
+        test_list_1 -- older form of test_list, used if test_list isn't set: tests run
+            before the positions are calculated
+        test_list_2 -- older form of test_list: tests only run for stationary gear, after
+            the positions are calculated
+        test_list -- list of qc tests to run.  The qc class runs them in the order of
+            their dependencies (see ops_qc.scheduler), together with the location_attrs
+            and positions steps, in one pass.  If the qc class can validate test lists,
+            unknown tests or flags without attributes stop the run before any file is
+            processed (see ops_qc.registry).
+        qc_threads -- number of threads the qc class runs qc tests that don't depend on
+            each other with
+        qc_cache_dir -- if set, passed to the qc class as cache_dir so the flags of qc
+            tests already run on the same data (with the same test code, parameters and
+            package version) are reused, i.e. when re-running an archive after tuning
+            one test.  Whether each test was a cache hit or miss is added to the status
+            file as cache_<test> columns, and the hit rate of each test is logged and
+            saved as qc_cache_report_XXXXXX.csv next to the status file.
+        qc_cache_max_bytes -- maximum size of qc_cache_dir, least recently used entries
+            are removed past it
         fishing_metafile -- path and filename for the csv file that contains fisher metadata,
             can be a local directory or a csv file in a github repository
         metafile_username -- used if you need a username to access metafile on github
         metafile_token -- github token if you need a username to access metafile on github
+        metafile_cache_dir -- if set, passed to metareader as cache_dir so the fisher
+            metadata is only downloaded and parsed again when it has changed
         status_file_ext -- extension added to status_file_XXXXXX.csv, usually a datetime
         status_file_dir -- directory to save status file in, if empty, will use out_dir
+        status_flush_every -- if set, append status rows to the status file every
+            status_flush_every files instead of only at the end of the run
+        journal_file -- if set, each file's outcome is appended to this journal as it
+            finishes.  Files already completed with the same contents and configuration
+            (test lists, attr_file, fisher metadata, ...) by a previous run are skipped,
+            so an interrupted run can be restarted where it stopped.
+        time_stages -- boolean, time each processing stage (read, preprocess including
+            fisher metadata matching, qc, location_attrs, positions, depth, write)
+            and each qc test for every file.  Times in seconds are added to the status
+            file as time_<stage> and time_qc_<test> columns, and a summary of the run
+            (total, p50, p95 per stage) is logged and saved as timing_summary_XXXXXX.csv
+            next to the status file.
+        pipeline -- boolean, overlap reading, qc and writing: a reader thread parses the
+            next files while the current one is qc'd, and a writer thread saves the netcdf
+            files and status rows (in filelist order).  Ignored when workers > 1.
+        pipeline_queue_size -- number of files each pipeline stage can hold waiting for the
+            next stage, limits the extra memory used by pipeline
         datareader -- python class to read csv file, returns an xarray dataset
         preprocessor -- python class to preprocess data from datareader, returns updated
             xarray dataset and updated status_file
         qc_class -- python class wrapper for running qc tests, returns updated xarray dataset
             that includes qc flags and updated status_file
         save_flags -- boolean, save all qc flags (true) or only global qc flags (false)
+        encoding -- netcdf encoding of the qc'd files, name of a preset in
+            ops_qc.encoding.ENCODING_PRESETS ("default", "compressed" or "compact") or a
+            preset dictionary (see ops_qc.encoding)
+        output_format -- "netcdf" saves one netcdf file per csv file, "ragged" saves batches of
+            ragged_batch_size deployments in one CF-1.6 contiguous ragged array file
+            (featureType trajectory, see ops_qc.ragged).  Ragged output is written by this
+            process, so it runs without workers and without journal_file.  "zarr" writes each
+            deployment to a group in the zarr_store archive (see ops_qc.archive, needs the
+            zarr package), workers can write to the archive at the same time.
+        ragged_batch_size -- maximum number of deployments per ragged array file
+        zarr_store -- path of the zarr archive for output_format "zarr", default is
+            qc_archive.zarr in out_dir
+        tempfile_max_age -- netcdf files are written to a temporary file and renamed when
+            complete, temporary files older than this (seconds) left in out_dir by
+            interrupted runs are removed
         convert_p_to_z -- boolean, convert pressure to depth (true) or only keep pressure
             (false)
-        default_latitude -- latitude to use in convert_p_to_z
+        default_latitude -- latitude to use in convert_p_to_z when the file has no latitudes
+        depth_latitude -- latitude used in convert_p_to_z: "mean" (file-wide mean latitude),
+            "sample" (each sample's latitude) or "profile" (mean latitude of each profile)
+        stationary_positions -- position given to stationary gear: "file" (mean of the first
+            and last good positions in the file) or "haul" (the same, for each haul)
         attr_file -- location of attribute_list.yml, default uses the one in the python 
             package, should be a yaml file (see sample one in ops_qc directory)
         startstring -- string, used by datareader class to recognize the end of the header
@@ -49,6 +116,14 @@ class QcWrapper(object):
             after as "detailed_error"
         gear_class -- dictionary of fishing_method:gear_class pairs, matching every 
             fishing method in the fishing_metafile to either "mobile" or "stationary"
+        index_metadata -- boolean, pass the fisher metadata to the preprocessor as a
+            readers.FisherMetadataIndex (true) so each file is matched with a binary
+            search instead of a scan of the whole spreadsheet, or as the dataframe
+            from metareader (false).  The preprocessor must accept the index.
+        workers -- number of processes to qc files with.  With more than one, each
+            file is read, preprocessed, qc'd and saved in a process pool and the
+            status data is merged back in filelist order.  If out_dir is not set, files
+            are saved in the directory of the first file in filelist.
 
     Returns:
         self._success_files -- list of files successfully qc'd and saved as netcdf files
@@ -58,6 +133,8 @@ class QcWrapper(object):
         Saves status_file_XXXX as csv in status_file_dir (or if none, out_dir)
     """
 
+    stages = ["read", "preprocess", "qc", "location_attrs", "positions", "depth", "write"]
+
     def __init__(
         self,
         filelist=None,
@@ -65,18 +142,35 @@ class QcWrapper(object):
         out_dir=None,
         test_list_1=None,
         test_list_2=None,
+        test_list=None,
+        qc_threads=1,
+        qc_cache_dir=None,
+        qc_cache_max_bytes=1024**3,
         fishing_metafile="/data/obs/mangopare/incoming/Fisherman_details/Trial_fisherman_database.csv",
         metafile_username=[],
         metafile_token=[],
+        metafile_cache_dir=None,
         status_file_ext="_%y%m%d",
         status_file_dir="",
+        status_flush_every=None,
+        journal_file=None,
+        time_stages=False,
+        pipeline=False,
+        pipeline_queue_size=2,
         datareader={},
         metareader={},
         preprocessor={},
         qc_class={},
         save_flags=False,
+        encoding="default",
+        output_format="netcdf",
+        ragged_batch_size=1000,
+        zarr_store=None,
+        tempfile_max_age=3600,
         convert_p_to_z=True,
         default_latitude=-40,
+        depth_latitude="mean",
+        stationary_positions="file",
         attr_file=os.path.join(
             os.path.dirname(os.path.realpath(__file__)), "attribute_list.yml"
         ),
@@ -104,6 +198,8 @@ class QcWrapper(object):
             "Diving": "stationary",
             "Trolling": "mobile"
         },
+        index_metadata=False,
+        workers=1,
         logger=logging,
         **kwargs,
     ):
@@ -113,22 +209,56 @@ class QcWrapper(object):
         self.out_dir = out_dir
         self.test_list_1 = test_list_1
         self.test_list_2 = test_list_2
+        if test_list is None:
+            test_list = list(dict.fromkeys((test_list_1 or []) + (test_list_2 or [])))
+            # as when test_list_2 was a second qc run for stationary gear
+            self.test_requires = {
+                name: {"gear_class": ["stationary"], "after": ["positions"]}
+                for name in test_list_2 or []
+                if name not in (test_list_1 or [])
+            }
+        else:
+            self.test_requires = {}
+        self.test_list = test_list
+        self.qc_threads = qc_threads
+        self.qc_cache_dir = qc_cache_dir
+        self.qc_cache_max_bytes = qc_cache_max_bytes
         self.metafile = fishing_metafile
         self.metafile_username = metafile_username
         self.metafile_token = metafile_token
+        self.metafile_cache_dir = metafile_cache_dir
         self.status_file_ext = status_file_ext
         self.status_file_dir = status_file_dir
+        self.status_flush_every = status_flush_every
+        self.journal_file = journal_file
+        self.time_stages = time_stages
+        self.pipeline = pipeline
+        self.pipeline_queue_size = pipeline_queue_size
+        self._write_queue = None
+        self._pending_write = None
         self.datareader_class = datareader
         self.metareader_class = metareader
         self.preprocessor_class = preprocessor
         self.qc_class = qc_class
         self.save_flags = save_flags
+        self.encoding = encoding
+        self.output_format = output_format
+        self.ragged_batch_size = ragged_batch_size
+        self._ragged_buffer = []
+        self.zarr_store = zarr_store
+        self._archive = None
+        self.tempfile_max_age = tempfile_max_age
+        self._cleaned_dirs = set()
         self.convert_p_to_z = convert_p_to_z
         self.default_latitude = default_latitude
+        self.depth_latitude = depth_latitude
+        self.stationary_positions = stationary_positions
         self.attr_file = attr_file
         self.startstring = startstring
         self.splitstring = splitstring
         self.gear_class = gear_class
+        self.index_metadata = index_metadata
+        self.workers = workers
         self._default_datareader_class = "ops_qc.readers.MangopareStandardReader"
         self._default_metareader_class = "ops_qc.readers.MangopareMetadataReader"
         self._default_preprocessor_class = "ops_qc.preprocess.PreProcessMangopare"
@@ -159,6 +289,18 @@ class QcWrapper(object):
             "total_obs",
             "detailed_error"
         ]
+        self._timer = StageTimer(enabled=time_stages)
+        # set by run() once the qc class has checked test_list
+        self._tests_validated = False
+        if time_stages:
+            tests = dict.fromkeys(self.test_list)
+            self.timing_columns = [f"time_{stage}" for stage in self.stages] + [
+                f"time_qc_{test}" for test in tests
+            ]
+            self.status_dict_keys += self.timing_columns
+        if qc_cache_dir:
+            self.cache_columns = [f"cache_{test}" for test in dict.fromkeys(self.test_list)]
+            self.status_dict_keys += self.cache_columns
 
     def set_cycle(self, cycle_dt):
         self.cycle_dt = cycle_dt
@@ -222,10 +364,11 @@ class QcWrapper(object):
                 self.out_dir, os.path.splitext(
                     tail)[0], self.outfile_ext, ".nc"
             )
-            self.ds.to_netcdf(savefile, mode="w", format="NETCDF4")
-            # self._saved_files.append(savefile)
-            self.status_dict.update({"saved": "yes"})
-            self._saved_files.append(savefile)
+            if self._write_queue is not None:
+                # saved by the pipeline writer thread, see _finish_file
+                self._pending_write = (savefile, self.ds)
+                return
+            self._write_qc_data(self.ds, savefile, filename, self.status_dict)
         except Exception as exc:
             self.status_dict.update(
                 {"failed": "yes", "failure_mode": "Save QC File Failed"}
@@ -235,35 +378,155 @@ class QcWrapper(object):
             )
             # self._failed_files.append(f'{filename}: Save QC File Failed')
 
+    def _write_qc_data(self, ds, savefile, filename, status_dict):
+        if self.output_format == "ragged":
+            self._ragged_buffer.append((filename, savefile, ds))
+            status_dict.update({"saved": "yes"})
+            if len(self._ragged_buffer) >= self.ragged_batch_size:
+                self._write_ragged_batch(status_dict)
+            return
+        try:
+            if self.output_format == "zarr":
+                deployment = os.path.splitext(os.path.basename(savefile))[0]
+                self._saved_files.append(self._zarr_archive().write(deployment, ds))
+                status_dict.update({"saved": "yes"})
+                return
+            write_netcdf_atomic(
+                ds, savefile, mode="w", format="NETCDF4",
+                encoding=netcdf_encoding(ds, self.encoding, logger=self.logger),
+            )
+            # self._saved_files.append(savefile)
+            status_dict.update({"saved": "yes"})
+            self._saved_files.append(savefile)
+        except Exception as exc:
+            status_dict.update(
+                {"failed": "yes", "failure_mode": "Save QC File Failed"}
+            )
+            self.logger.error(
+                "Could not save qc data from {}: {}".format(filename, exc)
+            )
+
+    def _zarr_archive(self):
+        """
+        Opens (creating if needed) the zarr archive, once per process
+        """
+        if self._archive is None:
+            if not self.zarr_store:
+                self.zarr_store = os.path.join(self.out_dir, "qc_archive.zarr")
+            self._archive = ZarrArchive(
+                self.zarr_store, encoding=self.encoding, logger=self.logger)
+        return self._archive
+
+    def _write_ragged_batch(self, status_dict=None):
+        """
+        Saves the deployments waiting in self._ragged_buffer as one ragged array
+        file, named after the first csv file in the batch.  If the save fails,
+        the status rows (and status_dict, for the file being processed) of all
+        files in the batch are marked as failed.
+        """
+        if not self._ragged_buffer:
+            return
+        batch, self._ragged_buffer = self._ragged_buffer, []
+        filenames = [filename for filename, _, _ in batch]
+        tail = os.path.split(filenames[0])[1]
+        savefile = "{}{}_batch{}{}{}".format(
+            self.out_dir, os.path.splitext(tail)[0], len(batch), self.outfile_ext, ".nc"
+        )
+        try:
+            ds = to_ragged(
+                [ds for _, _, ds in batch],
+                [os.path.splitext(os.path.basename(f))[0] for _, f, _ in batch],
+            )
+            write_netcdf_atomic(
+                ds, savefile, mode="w", format="NETCDF4",
+                encoding=netcdf_encoding(ds, self.encoding, logger=self.logger),
+            )
+            self._saved_files.append(savefile)
+        except Exception as exc:
+            failed = {"saved": None, "failed": "yes", "failure_mode": "Save QC File Failed"}
+            if status_dict is not None:
+                status_dict.update(failed)
+            if not self._status.update(filenames, failed):
+                self.logger.error("Status rows already saved for some files in the failed batch")
+            self.logger.error(
+                "Could not save ragged array file {}: {}".format(savefile, exc)
+            )
+
     def _save_status_data(self):
         """
         Save self._success_files and self._failed_files as text files.
         If status_file_dir is not specified, saves in same directory as
-        qc'd data.
+        qc'd data.  Only status rows not already saved are appended.
         """
         try:
-            if not self.status_file_dir:
-                self.status_file_dir = self.out_dir
+            filename = self._status_filename()
             # create (mkdir) status_file_dir if it doesn't exist
             self._initialize_outdir(self.status_file_dir)
-            # create all the status files in self.save_file_dict
-            #           for name,data in save_file_dict:
-            basefile = f"status_file{self.status_file_ext}.csv"
+            self._status.flush(filename)
+        except Exception as exc:
+            self.logger.error("Could not save status files: {}".format(exc))
+
+    def _status_filename(self):
+        """Status file of this cycle, in status_file_dir (default out_dir)"""
+        if not self.status_file_dir:
+            self.status_file_dir = self.out_dir
+        basefile = f"status_file{self.status_file_ext}.csv"
+        return cycle_dt.strftime(os.path.join(self.status_file_dir, basefile))
+
+    def _saved_status_filenames(self):
+        """Input files that already have a row in this cycle's status file"""
+        try:
+            return set(pd.read_csv(self._status_filename(), usecols=["filename"])["filename"])
+        except Exception:
+            # no status file for this cycle yet
+            return set()
+
+    def _save_timing_summary(self):
+        """
+        Logs the per stage timing summary of this run and saves it as
+        timing_summary_XXXXXX.csv in status_file_dir
+        """
+        try:
+            self.timing_summary = timing_summary(self._status_data, self.timing_columns)
+            self.logger.info(f"Timing summary (seconds):\n{self.timing_summary}")
+            basefile = f"timing_summary{self.status_file_ext}.csv"
             filename = cycle_dt.strftime(
                 os.path.join(self.status_file_dir, basefile))
-            self._status_data.to_csv(
-                filename, mode="a", header=not os.path.isfile(filename), index=False
-            )
+            self.timing_summary.to_csv(filename, index_label="stage")
         except Exception as exc:
-            self.logger.error("Could not save status files: {}".format(exc))
+            self.logger.error("Could not save timing summary: {}".format(exc))
+
+    def _save_cache_report(self):
+        """
+        Logs the qc result cache hit rate of each test in this run and saves it
+        as qc_cache_report_XXXXXX.csv in status_file_dir
+        """
+        try:
+            self.cache_report = cache_report(self._status_data, self.cache_columns)
+            self.logger.info(f"QC cache hit rates:\n{self.cache_report}")
+            basefile = f"qc_cache_report{self.status_file_ext}.csv"
+            filename = cycle_dt.strftime(
+                os.path.join(self.status_file_dir, basefile))
+            self.cache_report.to_csv(filename, index_label="test")
+        except Exception as exc:
+            self.logger.error("Could not save qc cache report: {}".format(exc))
+
+    @property
+    def _status_data(self):
+        return self._status.to_dataframe()
 
     def _initialize_outdir(self, dir_path):
         """
-        Check if outdir exists, create if not
+        Check if outdir exists, create if not.  The first time each
+        directory is used, removes temporary files left by interrupted writes.
         """
         try:
             if not os.path.isdir(dir_path):
                 os.mkdir(dir_path)
+            if dir_path not in self._cleaned_dirs:
+                self._cleaned_dirs.add(dir_path)
+                for tmpfile in remove_stale_tempfiles(dir_path, self.tempfile_max_age):
+                    self.logger.info(f"Removed incomplete file {tmpfile}")
         except Exception as exc:
             self.logger.error(
                 "Could not create specified directory to save qc files in: {}".format(
@@ -273,26 +536,54 @@ class QcWrapper(object):
             raise type(exc)(f'Could not create specified directory to save qc files in due to: {exc}')
 
 
+    def _depth_latitudes(self):
+        """
+        Latitude(s) used to convert pressure to depth, depending on depth_latitude:
+            mean -- one file-wide mean latitude
+            sample -- each sample's own latitude
+            profile -- mean latitude of each profile, a new profile starting
+                wherever PHASE changes (see utils.phase_segments)
+        Missing latitudes fall back to the file-wide mean, or default_latitude if
+        the file has no latitudes at all.
+        """
+        latitude = pd.to_numeric(
+            np.asarray(self.ds["LATITUDE"]).ravel(), errors="coerce"
+        ).astype(float)
+        if np.isnan(latitude).all():
+            return self.default_latitude
+        mean_latitude = np.nanmean(latitude)
+        if self.depth_latitude == "mean":
+            return mean_latitude
+        if self.depth_latitude == "profile":
+            if "PHASE" not in self.ds:
+                self.logger.error(
+                    "No PHASE variable to split profiles, using mean latitude"
+                )
+                return mean_latitude
+            profile = phase_segments(self.ds["PHASE"].values)
+            latitude = (
+                pd.Series(latitude).groupby(profile).transform("mean").to_numpy()
+            )
+        elif self.depth_latitude != "sample":
+            raise ValueError(f"Unknown depth_latitude {self.depth_latitude}")
+        return np.where(np.isnan(latitude), mean_latitude, latitude)
+
     def convert_pressure_to_depth(self):
         """
-        Converts pressure to depth in the ocean either using the
-        mean latitude of the observations or using a default_latitude
+        Converts pressure to depth in the ocean using latitude(s) chosen by
+        depth_latitude (see _depth_latitudes).  Non-numeric pressures give
+        NaN depths.
         """
         try:
-            if not np.isnan(np.nanmean(self.ds["LATITUDE"])):
-                d_lat = np.nanmean(self.ds["LATITUDE"])
-            else:
-                d_lat = self.default_latitude
-            depth = [
-                gsw.z_from_p(catch(lambda: float(z)), d_lat)
-                for z in self.ds["PRESSURE"]
-            ]
+            pressure = pd.to_numeric(
+                np.asarray(self.ds["PRESSURE"]), errors="coerce"
+            ).astype(float)
+            depth = gsw.z_from_p(pressure, self._depth_latitudes())
             self.ds["DEPTH"] = xr.Variable(
                 dims="DATETIME",
-                data=depth,
+                data=np.asarray(depth)*-1,
                 attrs={"units": "[m]", "standard_name": "depth"},
             )
-            self.ds["DEPTH"] = self.ds["DEPTH"]*-1
             #self.ds = self.ds.drop("PRESSURE")
             self.ds = self.ds.rename({"PRESSURE_QC": "DEPTH_QC"})
             self.ds["PRESSURE_QC"] = self.ds["DEPTH_QC"]
@@ -309,26 +600,28 @@ class QcWrapper(object):
     def _calc_positions(self, filename, surface_pressure=10, qcrange=[1,2]):
         """
         Calculate locations for either stationary or mobile gear.
-        Current state of this code assumes all stationary locations
-        in one CSV file are the SAME.  NOT NECESSARILY TRUE!  Hence
-        the commented out regions...eventually will use those.
+        Stationary gear is given the mean of the first and last good
+        positions, either of the whole file or of each haul (a new haul
+        starting wherever PHASE changes, see utils.phase_segments) if
+        stationary_positions is "haul".  Hauls without good positions use the file position.
         """
         try:
             if self.ds.attrs['gear_class'] == 'stationary':
-                # this needs work
-                if 'LOCATION_QC' in self.ds.data_vars:
-                    ds2 = self.ds.where(self.ds['LOCATION_QC'].isin(qcrange), drop=True)
-                else:
-                    ds2 = self.ds
-                if 'DATETIME_QC' in ds2.data_vars:
-                    ds2 = ds2.where(
-                        ds2['DATETIME_QC'].isin(qcrange), drop=True)
-                lat = np.nanmean(
-                    [ds2.LATITUDE.values[0], ds2.LATITUDE.values[-1]])
-                lon = np.nanmean(
-                    [ds2.LONGITUDE.values[0], ds2.LONGITUDE.values[-1]]) % 360
-                self.ds['LATITUDE'] = self.ds.LATITUDE.where(self.ds.LATITUDE == lat, other=lat)
-                self.ds['LONGITUDE'] = self.ds.LONGITUDE.where(self.ds.LONGITUDE == lon, other=lon)
+                latitude = self.ds.LATITUDE.values
+                longitude = self.ds.LONGITUDE.values
+                # as before positions came from masks, missing qc flags are left out
+                mask = good_position_mask(
+                    self.ds, qcrange, qc_vars=["LOCATION_QC", "DATETIME_QC"], optional=True)
+                positions = derive_positions(latitude, longitude, mask)
+                lat = np.full(len(latitude), positions["latitude"])
+                lon = np.full(len(longitude), positions["longitude"])
+                if self.stationary_positions == "haul" and "PHASE" in self.ds:
+                    haul = phase_segments(self.ds["PHASE"].values)
+                    haul_lat, haul_lon = haul_positions(latitude, longitude, mask, haul)
+                    lat = np.where(np.isnan(haul_lat), lat, haul_lat)
+                    lon = np.where(np.isnan(haul_lon), lon, haul_lon)
+                self.ds['LATITUDE'] = (self.ds.LATITUDE.dims, lat, self.ds.LATITUDE.attrs)
+                self.ds['LONGITUDE'] = (self.ds.LONGITUDE.dims, lon % 360, self.ds.LONGITUDE.attrs)
             if self.ds.attrs['gear_class'] == 'mobile':
                 self.ds = self.ds.assign({"LONGITUDE": lambda ds: ds['LONGITUDE'] % 360})
         except Exception as exc:
@@ -367,8 +660,10 @@ class QcWrapper(object):
             # only save files with at least some good data
             if np.nanmin(self.ds["QC_FLAG"]) < 4:
                 if self.convert_p_to_z:
-                    self.ds = self.convert_pressure_to_depth()
-                self._save_qc_data(filename)
+                    with self._timer.stage("depth"):
+                        self.ds = self.convert_pressure_to_depth()
+                with self._timer.stage("write"):
+                    self._save_qc_data(filename)
                 self.status_dict["total_obs"] = len(self.ds["DATETIME"])
                 # this is annoying but it didn't want to unpack single tuples...
                 values, counts = np.unique(
@@ -390,14 +685,96 @@ class QcWrapper(object):
             self.logger.error(
                 f"Could not postprocess {filename} due to {exc}")
 
-    def _qc_files(self, test_list, filename):
+    def _qc_step(self, stage, method, filename, ds):
+        """Runs a processing method on ds, as a step of the qc class"""
+        self.ds = ds
+        with self._timer.stage(stage):
+            method(filename)
+        return self.ds
+
+    def _qc_steps(self, filename):
+        """
+        Position processing, run by the qc class once the qc tests it depends
+        on are done (LOCATION_QC and DATETIME_QC are used for good positions)
+        """
+        return {
+            "location_attrs": QcStep(
+                functools.partial(self._qc_step, "location_attrs", self._calc_location_attrs, filename),
+                columns=["LATITUDE", "LONGITUDE"],
+                flags=["LOCATION_QC", "DATETIME_QC"],
+                produces=[
+                    "geospatial_lat_max",
+                    "geospatial_lat_min",
+                    "geospatial_lon_max",
+                    "geospatial_lon_min",
+                    "start_end_dist_m",
+                ],
+            ),
+            "positions": QcStep(
+                functools.partial(self._qc_step, "positions", self._calc_positions, filename),
+                columns=["LATITUDE", "LONGITUDE", "PHASE"],
+                flags=["LOCATION_QC", "DATETIME_QC"],
+                attrs=["gear_class"],
+                modifies=["LATITUDE", "LONGITUDE"],
+            ),
+        }
+
+    def _qc_all(self, filename):
+        """
+        Applies all qc tests and the position steps in one qc class run, or for
+        qc classes that can't run steps (without a steps argument), the
+        test_list_1 tests, the position steps, then the test_list_2 tests for
+        stationary gear
+        """
+        steps_before = sum(self._timer.timings.get(f"time_{step}", 0) for step in ["location_attrs", "positions"])
+        start = time.perf_counter()
+        if getattr(self.qc_class, "runs_steps", False):
+            self._qc_files(
+                self.test_list,
+                filename,
+                steps=self._qc_steps(filename),
+                test_requires=self.test_requires,
+                threads=self.qc_threads,
+            )
+        else:
+            self._qc_files(
+                [name for name in self.test_list if name not in self.test_requires],
+                filename,
+            )
+            with self._timer.stage("location_attrs"):
+                self._calc_location_attrs(filename)
+            with self._timer.stage("positions"):
+                self._calc_positions(filename)
+            if self.test_requires and self.ds.attrs['gear_class'] == 'stationary':
+                self._qc_files(list(self.test_requires), filename)
+        if self._timer.enabled:
+            steps = sum(self._timer.timings.get(f"time_{step}", 0) for step in ["location_attrs", "positions"])
+            self._timer.add("qc", time.perf_counter() - start - (steps - steps_before))
+
+    def _qc_files(self, test_list, filename, **kwargs):
         try:
-            self.ds = self.qc_class(
+            qc_kwargs = dict(kwargs, time_tests=True) if self.time_stages else dict(kwargs)
+            if self._tests_validated:
+                # checked once in run(), not again for every file
+                qc_kwargs["validated"] = True
+            if self.qc_cache_dir:
+                qc_kwargs.update(
+                    cache_dir=self.qc_cache_dir, cache_max_bytes=self.qc_cache_max_bytes)
+            qc = self.qc_class(
                 self.ds,
                 test_list,
                 self.save_flags,
                 self.attr_file,
-                ).run()
+                **qc_kwargs,
+                )
+            self.ds = qc.run()
+            for test_name, seconds in getattr(qc, "test_timings", {}).items():
+                self._timer.add(f"qc_{test_name}", seconds)
+            for test_name, result in getattr(qc, "cache_results", {}).items():
+                self.status_dict[f"cache_{test_name}"] = result
+        except StepError:
+            # position processing failed, which fails the file
+            raise
         except Exception as exc:
             self.status_dict.update(
                 {"failed": "yes", "failure_mode": "Apply QC Tests Failed"})
@@ -405,19 +782,53 @@ class QcWrapper(object):
                 f"Could not qc {filename} due to {exc}")
 
     def _update_status(self, filename):
+        if self._write_queue is not None:
+            # the writer thread saves the file (if any) and then adds the status row,
+            # so rows stay in filelist order
+            self._write_queue.put(functools.partial(
+                self._finish_file, filename, dict(self.status_dict),
+                dict(self._timer.timings), self._pending_write))
+            self._pending_write = None
+            return
+        self._append_status_row(filename, self.status_dict, self._timer.timings)
+
+    def _append_status_row(self, filename, status_dict, timings):
         try:
             status_dict2 = {
-                k: self.status_dict[k]
+                k: status_dict[k]
                 for k in self.status_dict_keys
-                if k in self.status_dict
+                if k in status_dict
             }
             status_dict2['filename'] = filename
-            #self._status_data = self._status_data.append(
-            #    status_dict2, ignore_index=True)
-            self._status_data = pd.concat([self._status_data, pd.DataFrame([status_dict2])], ignore_index=True)
+            status_dict2.update(timings)
+            self._status.append(status_dict2)
+            self._check_status_flush()
         except Exception as exc:
             self.logger.error(f"Could not append status info for {filename} due to {exc}")
 
+    def _finish_file(self, filename, status_dict, timings, pending_write):
+        """
+        Pipeline writer thread job: saves the qc'd dataset (if any), adds the
+        status row and records the file in the journal
+        """
+        status_start, saved_start = len(self._status), len(self._saved_files)
+        if pending_write:
+            savefile, ds = pending_write
+            start = time.perf_counter()
+            self._write_qc_data(ds, savefile, filename, status_dict)
+            if self.time_stages:
+                timings["time_write"] = timings.get("time_write", 0) + time.perf_counter() - start
+        self._append_status_row(filename, status_dict, timings)
+        self._record_journal(filename, status_start, saved_start)
+
+    def _check_status_flush(self):
+        """
+        Saves status rows to the status file every status_flush_every files,
+        so partial progress is kept if the run stops early.
+        """
+        if self.status_flush_every and self._status.pending >= self.status_flush_every:
+            self._save_status_data()
+
     def _status_checks(self, filename):
         check_passed = True
         if not hasattr(self.ds, "expected_deck_unit_serial_number"):
@@ -446,58 +857,295 @@ class QcWrapper(object):
             check_passed = False
         return check_passed
 
-    def _process_files(self):
-        """Read, reprocess, and apply qc"""
-        self._status_data = pd.DataFrame(columns=self.status_dict_keys)
-        self._saved_files = []
-        self._set_filelist()
+    def _read_file(self, filename):
+        """
+        Returns (dataset, exception, seconds) for filename, exception is None
+        if the file was read
+        """
+        start = time.perf_counter()
+        try:
+            ds, exc = self.datareader(filename=filename).run(), None
+        except Exception as read_exc:
+            ds, exc = None, read_exc
+        return ds, exc, time.perf_counter() - start
 
-        # apply qc
-        for filename in self.files_to_qc:
-            self.status_dict = {}
+    def _read_files(self, filelist, read_queue):
+        """Pipeline reader thread, reads files in order into read_queue"""
+        for filename in filelist:
+            read_queue.put((filename, self._read_file(filename)))
+
+    def _run_jobs(self, job_queue):
+        """Pipeline writer thread, runs jobs from job_queue in order until None"""
+        for job in iter(job_queue.get, None):
             try:
-                self.ds = self.datareader(filename=filename).run()
+                job()
+            except Exception as exc:
+                self.logger.error(f"Pipeline writer job failed: {exc}")
+
+    def _process_file(self, filename, prefetched=None):
+        """
+        Read, preprocess, apply qc and save one file.  prefetched is the
+        result of _read_file(filename) if it was already read.
+        """
+        self.status_dict = {}
+        self._timer.reset()
+        self._pending_write = None
+        try:
+            if prefetched:
+                self.ds, exc, seconds = prefetched
+                if self._timer.enabled:
+                    self._timer.add("read", seconds)
+                if exc:
+                    raise exc
+            else:
+                with self._timer.stage("read"):
+                    self.ds = self.datareader(filename=filename).run()
+            with self._timer.stage("preprocess"):
                 self.ds, self.status_dict = self.preprocessor(
                     ds=self.ds,
                     fisher_metadata=self.fisher_metadata,
                     attr_file=self.attr_file,
                     status_dict=self.status_dict
                 ).run()
-                passed = self._status_checks(filename)
-                if not passed:
+            passed = self._status_checks(filename)
+            if not passed:
+                return
+            self._qc_all(filename)
+            self._postprocess(filename)
+            self._update_status(filename)
+        except Exception as exc:
+            if self.splitstring in str(exc):
+                estr = str(exc).split(self.splitstring)
+                self.status_dict.update({"failed": "yes","failure_mode":estr[0],"detailed_error":estr[1]})
+            else:
+                self.status_dict.update({"failed": "yes","failure_mode":str(exc),"detailed_error":"NA"})
+            self._update_status(filename)
+            self.logger.error(
+                "Could not qc data from {}. Traceback: {}".format(
+                    filename, exc)
+            )
+
+    def _config_key(self):
+        """
+        Hash of everything that changes the qc output for a given input file,
+        used to decide whether journal entries from a previous run can be reused.
+        The fisher metadata "Date returned" is only compared to the day, since
+        blank return dates are filled with the current time.
+        """
+        fisher_metadata = getattr(self.fisher_metadata, "fisher_metadata", self.fisher_metadata)
+        fisher_metadata = fisher_metadata.copy()
+        fisher_metadata["Date returned"] = pd.to_datetime(
+            fisher_metadata["Date returned"], errors="coerce"
+        ).dt.normalize()
+        with open(self.attr_file, "rb") as f:
+            attr_file = f.read()
+        classes = [
+            f"{klass.__module__}.{klass.__qualname__}"
+            for klass in [self.datareader, self.preprocessor, self.qc_class]
+        ]
+        return content_key(
+            ops_qc.__version__,
+            self.test_list,
+            sorted(self.test_requires),
+            self.save_flags,
+            self.encoding,
+            self.convert_p_to_z,
+            self.default_latitude,
+            self.depth_latitude,
+            self.output_format,
+            self.stationary_positions,
+            self.out_dir,
+            self.outfile_ext,
+            sorted(self.gear_class.items()),
+            classes,
+            attr_file,
+            pd.util.hash_pandas_object(fisher_metadata).to_numpy().tobytes(),
+        )
+
+    def _load_journal(self):
+        """
+        Opens the completion journal and finds the files in files_to_qc that
+        were already completed with the same contents and configuration.
+        """
+        self._journal = None
+        self._input_hashes = {}
+        self._completed = {}
+        self._status_saved = set()
+        if not self.journal_file:
+            return
+        self._journal = QcJournal(self.journal_file, self._config_key())
+        for filename in self.files_to_qc:
+            try:
+                self._input_hashes[filename] = file_digest(filename)
+            except Exception:
+                # missing or unreadable, the reader will record why
+                self._input_hashes[filename] = None
+            entry = self._journal.completed(filename, self._input_hashes[filename])
+            if entry:
+                self._completed[filename] = entry
+        if self._completed:
+            self.logger.info(
+                f"Skipping {len(self._completed)} files already completed in {self.journal_file}"
+            )
+            if self.status_flush_every:
+                self._status_saved = self._saved_status_filenames()
+
+    def _resume_file(self, filename):
+        """
+        If filename was completed by a previous run, adds its saved files (and
+        its status row, unless the previous run already flushed it to this
+        cycle's status file) and returns True.
+        """
+        entry = self._completed.get(filename)
+        if not entry:
+            return False
+        self._saved_files.extend(entry["saved_files"])
+        # a previous run on another cycle date flushed to another status file
+        self._status.extend(
+            [row for row in entry["status_rows"] if row.get("filename") not in self._status_saved])
+        return True
+
+    def _record_journal(self, filename, status_start, saved_start):
+        """
+        Records the status rows and saved files added for filename since
+        status_start and saved_start in the completion journal
+        """
+        if self._journal:
+            self._journal.record(
+                filename,
+                self._input_hashes.get(filename),
+                self._saved_files[saved_start:],
+                self._status.rows[status_start:],
+            )
+
+    def _process_files_parallel(self):
+        """
+        Sends each file to a pool of self.workers processes.  Each worker
+        gets its own copy of this wrapper (including the fisher metadata)
+        once, when it starts.  Results are collected in filelist order so the
+        status data and saved files are the same as for a serial run.
+        """
+        if not self.out_dir:
+            # a serial run saves everything in the directory of the first
+            # saved file, so fix it here rather than once per worker
+            self.out_dir = os.path.split(self.files_to_qc[0])[0]
+        self._initialize_outdir(self.out_dir)
+        if self.output_format == "zarr":
+            # create the archive before any worker writes to it
+            self._zarr_archive()
+        remaining = [f for f in self.files_to_qc if f not in self._completed]
+        with ProcessPoolExecutor(
+            max_workers=self.workers, initializer=_init_worker, initargs=(self,)
+        ) as executor:
+            results = executor.map(_process_file_in_worker, remaining)
+            for filename in self.files_to_qc:
+                if self._resume_file(filename):
                     continue
-                self._qc_files(self.test_list_1,filename)
-                self._calc_location_attrs(filename)
-                self._calc_positions(filename)
-                if self.ds.attrs['gear_class'] == 'stationary':
-                    self._qc_files(self.test_list_2,filename)
-                self._postprocess(filename)
-                self._update_status(filename)
-            except Exception as exc:
-                if self.splitstring in str(exc):
-                    estr = str(exc).split(self.splitstring)
-                    self.status_dict.update({"failed": "yes","failure_mode":estr[0],"detailed_error":estr[1]})
-                else:
-                    self.status_dict.update({"failed": "yes","failure_mode":str(exc),"detailed_error":"NA"})
-                self._update_status(filename)
-                self.logger.error(
-                    "Could not qc data from {}. Traceback: {}".format(
-                        filename, exc)
-                )
+                status_rows, saved_files = next(results)
+                status_start, saved_start = len(self._status), len(self._saved_files)
+                self._status.extend(status_rows)
+                self._saved_files.extend(saved_files)
+                self._record_journal(filename, status_start, saved_start)
+                self._check_status_flush()
+
+    def _process_files_pipelined(self):
+        """
+        Runs reading, qc and writing as a pipeline.  A reader thread reads the
+        next files into a bounded queue while this thread preprocesses and qc's,
+        and a writer thread saves netcdf files and status rows from a second
+        bounded queue, in filelist order.
+        """
+        remaining = [f for f in self.files_to_qc if f not in self._completed]
+        read_queue = queue.Queue(maxsize=self.pipeline_queue_size)
+        self._write_queue = queue.Queue(maxsize=self.pipeline_queue_size)
+        reader = threading.Thread(
+            target=self._read_files, args=(remaining, read_queue), daemon=True)
+        writer = threading.Thread(
+            target=self._run_jobs, args=(self._write_queue,), daemon=True)
+        reader.start()
+        writer.start()
+        try:
+            for filename in self.files_to_qc:
+                if filename in self._completed:
+                    self._write_queue.put(functools.partial(self._resume_file, filename))
+                    continue
+                read_filename, prefetched = read_queue.get()
+                self._process_file(read_filename, prefetched)
+        finally:
+            self._write_queue.put(None)
+            writer.join()
+            self._write_queue = None
+
+    def _process_files(self):
+        """Read, reprocess, and apply qc"""
+        self._status = StatusRecorder(self.status_dict_keys)
+        self._saved_files = []
+        self._set_filelist()
+        ragged = self.output_format == "ragged"
+        if ragged and (self.workers > 1 or self.journal_file):
+            self.logger.info("Ragged array output runs without workers or journal_file")
+            self.workers, self.journal_file = 1, None
+        self._load_journal()
+
+        # apply qc
+        if self.workers > 1 and len(self.files_to_qc) > 1:
+            self._process_files_parallel()
+        elif self.pipeline:
+            self._process_files_pipelined()
+        else:
+            for filename in self.files_to_qc:
+                if self._resume_file(filename):
+                    continue
+                status_start, saved_start = len(self._status), len(self._saved_files)
+                self._process_file(filename)
+                self._record_journal(filename, status_start, saved_start)
+        if ragged:
+            self._write_ragged_batch()
+        if self._archive is not None:
+            self._archive.consolidate()
         self._save_status_data()
+        if self.time_stages:
+            self._save_timing_summary()
+        if self.qc_cache_dir:
+            self._save_cache_report()
         self._success_files = self._saved_files
 
+    def __getstate__(self):
+        # the default logger is the logging module, which can't be pickled
+        # for the worker processes
+        state = self.__dict__.copy()
+        state.pop("logger", None)
+        # each worker opens the zarr archive itself
+        state["_archive"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging
+
     def run(self):
+        # xarray is only imported when first used, see utils.LazyModule
+        xr.set_options(keep_attrs=True)
         # set all readers/preprocessors
         self.set_cycle(cycle_dt)
         self._set_all_classes()
+        validate_tests = getattr(self.qc_class, "validate_tests", None)
+        self._tests_validated = bool(validate_tests and self.test_list)
+        if self._tests_validated:
+            validate_tests(self.test_list, self.attr_file, logger=self.logger)
         # load metadata common for all files
+        metareader_kwargs = {}
+        if self.metafile_cache_dir:
+            metareader_kwargs["cache_dir"] = self.metafile_cache_dir
         self.fisher_metadata = self.metareader(
             metafile=self.metafile,
             gear_class=self.gear_class,
             username=self.metafile_username,
             token=self.metafile_token,
+            **metareader_kwargs,
         ).run()
+        if self.index_metadata and isinstance(self.fisher_metadata, pd.DataFrame):
+            self.fisher_metadata = FisherMetadataIndex(self.fisher_metadata)
 
         if len(self.filelist) < 1 or not self.filelist:
             self.logger.info(
@@ -507,3 +1155,27 @@ class QcWrapper(object):
         else:
             self._process_files()
         return self._success_files
+
+
+# QcWrapper copy used by each process when running with workers > 1
+_worker_wrapper = None
+
+
+def _init_worker(wrapper):
+    global _worker_wrapper
+    xr.set_options(keep_attrs=True)
+    _worker_wrapper = wrapper
+
+
+def _process_file_in_worker(filename):
+    """
+    Processes one file with this worker's QcWrapper, returns the status
+    rows and saved files for that file only.
+    """
+    wrapper = _worker_wrapper
+    wrapper._status = StatusRecorder(wrapper.status_dict_keys)
+    # the parent process saves the status file
+    wrapper.status_flush_every = None
+    wrapper._saved_files = []
+    wrapper._process_file(filename)
+    return wrapper._status.rows, wrapper._saved_files